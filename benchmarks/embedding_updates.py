@@ -0,0 +1,56 @@
+"""
+Times Classifier training steps with the embeddings trained through dense updates and through row-sparse updates
+(`sparse_embedding_updates=True`), reporting wall and CPU time per step.
+
+    python benchmarks/embedding_updates.py --n-examples 200 --batch-size 8
+"""
+import argparse
+import json
+import os
+import time
+
+from finetune import Classifier
+
+TESTDATA = os.path.join(os.path.dirname(__file__), "..", "tests", "testdata.json")
+
+
+def timed_fit(model, texts, targets):
+    start, start_cpu = time.perf_counter(), time.process_time()
+    model.fit(texts, targets)
+    return time.perf_counter() - start, time.process_time() - start_cpu
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-examples", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-length", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+
+    with open(TESTDATA, "rt") as fp:
+        texts, _ = json.load(fp)
+    texts = [texts[i % len(texts)] for i in range(args.n_examples)]
+    targets = ["dog" in text for text in texts]
+    n_steps = -(-args.n_examples // args.batch_size)
+
+    for repeat in range(args.repeats):
+        for sparse_embedding_updates in [False, True]:
+            model = Classifier(
+                train_embeddings=True,
+                sparse_embedding_updates=sparse_embedding_updates,
+                batch_size=args.batch_size,
+                max_length=args.max_length,
+                n_epochs=1,
+                val_size=0,
+                verbose=False
+            )
+            wall_time, cpu_time = timed_fit(model, texts, targets)
+            print(json.dumps({
+                "repeat": repeat,
+                "sparse_embedding_updates": sparse_embedding_updates,
+                "n_steps": n_steps,
+                "fit_s": round(wall_time, 3),
+                "step_ms": round(1000 * wall_time / n_steps, 1),
+                "step_cpu_ms": round(1000 * cpu_time / n_steps, 1),
+            }))
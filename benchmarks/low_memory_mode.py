@@ -0,0 +1,75 @@
+"""
+Times Classifier training steps under each `recompute_policy` of `low_memory_mode`, reporting the estimated memory
+of the activations kept for the backward pass, the peak resident memory of the training process and the wall time
+per step.  Each policy is trained in a fresh process so that peak memory is not shared between runs.
+
+    python benchmarks/low_memory_mode.py --n-examples 64 --batch-size 8 --budget-mb 1000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+TESTDATA = os.path.join(os.path.dirname(__file__), "..", "tests", "testdata.json")
+
+
+def policy_settings(args):
+    yield "off", {"low_memory_mode": False}
+    yield "all", {"low_memory_mode": True, "recompute_policy": "all"}
+    yield "every_k", {"low_memory_mode": True, "recompute_policy": "every_k", "recompute_every_k": args.every_k}
+    yield "attention", {"low_memory_mode": True, "recompute_policy": "attention"}
+    if args.budget_mb is not None:
+        yield "budget", {"low_memory_mode": True, "recompute_policy": "budget",
+                         "recompute_memory_budget": args.budget_mb}
+
+
+def timed_fit(settings, args):
+    from finetune import Classifier
+    from finetune.network_modules import recompute_plan, block_activation_mb
+
+    with open(TESTDATA, "rt") as fp:
+        texts, _ = json.load(fp)
+    texts = [texts[i % len(texts)] for i in range(args.n_examples)]
+    targets = ["dog" in text for text in texts]
+    model = Classifier(
+        batch_size=args.batch_size,
+        max_length=args.max_length,
+        n_epochs=1,
+        val_size=0,
+        verbose=False,
+        **settings
+    )
+    config = model.config
+    plan = recompute_plan(config, range(config.n_layer - config.num_layers_trained, config.n_layer), args.batch_size)
+    activation_mb = sum(block_activation_mb(config, args.batch_size, recompute=r) for r in plan.values())
+
+    start = time.perf_counter()
+    model.fit(texts, targets)
+    wall_time = time.perf_counter() - start
+    return activation_mb, wall_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-examples", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-length", type=int, default=128)
+    parser.add_argument("--every-k", type=int, default=2)
+    parser.add_argument("--budget-mb", type=float, default=None)
+    args = parser.parse_args()
+
+    n_steps = -(-args.n_examples // args.batch_size)
+    context = multiprocessing.get_context("spawn")
+    for policy, settings in policy_settings(args):
+        with context.Pool(1) as pool:
+            activation_mb, wall_time, peak_rss_mb = pool.apply(timed_fit, (settings, args))
+        print(json.dumps({
+            "policy": policy,
+            "n_steps": n_steps,
+            "activation_mb": round(activation_mb, 1),
+            "peak_rss_mb": round(peak_rss_mb, 1),
+            "fit_s": round(wall_time, 3),
+            "step_ms": round(1000 * wall_time / n_steps, 1),
+        }))
@@ -0,0 +1,65 @@
+"""
+Times SequenceLabeler inference on long documents, split into host-side encoding, graph execution and span assembly.
+
+    python benchmarks/sequence_labeling.py --n-docs 20 --doc-words 5000
+"""
+import argparse
+import json
+import os
+import time
+
+from finetune import SequenceLabeler
+
+TESTDATA = os.path.join(os.path.dirname(__file__), "..", "tests", "testdata.json")
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def long_documents(texts, n_docs, doc_words):
+    words = " ".join(texts).split()
+    return [
+        " ".join(words[(i + j) % len(words)] for j in range(doc_words))
+        for i in range(n_docs)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-docs", type=int, default=20)
+    parser.add_argument("--doc-words", type=int, default=5000)
+    parser.add_argument("--max-length", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with open(TESTDATA, "rt") as fp:
+        texts, labels = json.load(fp)
+
+    model = SequenceLabeler(max_length=args.max_length, n_epochs=1, verbose=False)
+    model.fit(texts, labels)
+    docs = long_documents(texts, args.n_docs, args.doc_words)
+
+    # warm up the shared prediction graph and the encoder
+    model.predict(docs[:1])
+
+    for repeat in range(args.repeats):
+        arr_encoded, encode_time = timed(
+            lambda: [out for doc in docs for out in model.input_pipeline._text_to_ids([doc])]
+        )
+        predictions, graph_time = timed(model._inference, arr_encoded, encoded=True)
+        doc_predictions, stitch_time = timed(model._stitch_chunks, arr_encoded, predictions)
+        _, dict_time = timed(model.predict, docs)
+        _, array_time = timed(model.predict, docs, as_array=True)
+        print(json.dumps({
+            "repeat": repeat,
+            "n_subtokens": sum(len(preds[0]) for preds in doc_predictions),
+            "n_chunks": len(arr_encoded),
+            "encode_s": round(encode_time, 3),
+            "graph_s": round(graph_time, 3),
+            "stitch_s": round(stitch_time, 3),
+            "predict_s": round(dict_time, 3),
+            "predict_as_array_s": round(array_time, 3),
+        }))
@@ -10,6 +10,7 @@ from finetune.sequence_labeling import SequenceLabeler
 from finetune.comparison import Comparison
 from finetune.multi_label_classifier import MultiLabelClassifier
 from finetune.multiple_choice import MultipleChoice
+from finetune.multi_task import MultiTask
 
 __version__, VERSION, version = ("0.5.11",) * 3
 
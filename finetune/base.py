@@ -13,24 +13,31 @@ import time
 import shutil
 import glob
 import pathlib
+import threading
+import contextlib
 
 import tqdm
+import joblib
 import numpy as np
 import tensorflow as tf
-from tensorflow.data import Dataset
 from sklearn.model_selection import train_test_split
 
 from finetune.utils import interpolate_pos_embed, list_transpose
 from finetune.encoding import EncodedOutput
-from finetune.input_pipeline import ENCODER
+from finetune.input_pipeline import ENCODER, FrozenActivationCache
 from finetune.config import get_default_config
 from finetune.saver import Saver
 from finetune.errors import FinetuneError
-from finetune.model import get_model_fn, PredictMode
+from finetune.model import get_model_fn, PredictMode, PredictFeed
 from finetune.download import download_data_if_required
 from finetune.estimator_utils import PatchedParameterServerStrategy
+from finetune.inference import Predictor, FrozenPredictor, ProcessPoolPredictor
 
 JL_BASE = os.path.join(os.path.dirname(__file__), "model", "Base_model.jl")
+EXPORT_GRAPH = "graph.pb"
+EXPORT_STATE = "model.jl"
+# per-thread overrides of inference settings, see `BaseModel.inference_batch_size`
+_INFERENCE_OPTIONS = threading.local()
 
 class BaseModel(object, metaclass=ABCMeta):
     """
@@ -61,6 +68,8 @@ class BaseModel(object, metaclass=ABCMeta):
             raise ValueError("If you are only finetuning a subset of the layers, you cannot finetune embeddings.")
 
         self.input_pipeline = self._get_input_pipeline()
+        if self.config.chunk_long_sequences:
+            self.input_pipeline.chunk_params()
         download_data_if_required()
         self._initialize()
 
@@ -68,10 +77,31 @@ class BaseModel(object, metaclass=ABCMeta):
     def _get_input_pipeline(self):
         pass
 
-    def _initialize(self):
+    @classmethod
+    def _as_task(cls, config):
+        """
+        Creates an instance that provides the target model and input pipeline of one task of a
+        :py:class:`finetune.multi_task.MultiTask` model.  It is initialized by the multi-task model with the saver
+        that holds the shared weights.
+        """
+        task = cls.__new__(cls)
+        task.config = config
+        task.input_pipeline = task._get_input_pipeline()
+        return task
+
+    def _initialize_state(self):
+        # Initializes the non-serialized attributes that do not depend on the graph or the model weights.  Also used
+        # by `load_exported`, which skips the rest of `_initialize`.
+        self.estimator_ = None
+        self._predictor = None
+        self._lm_predictor = None
+        self._process_pool = None
+        self._predictor_lock = threading.Lock()
+
+    def _initialize(self, mmap_mode=None, saver=None):
         # Initializes the non-serialized bits of the class.
         self._set_random_seed(self.config.seed)
-        self.estimator_ = None
+        self._initialize_state()
         if self.config.tensorboard_folder is not None:
             self.estimator_dir = os.path.abspath(
                 os.path.join(self.config.tensorboard_folder, str(int(time.time())))
@@ -82,6 +112,11 @@ class BaseModel(object, metaclass=ABCMeta):
             self.estimator_dir = tempfile.mkdtemp(prefix="Finetune")
             self.cleanup_glob = self.estimator_dir
 
+        if saver is not None:
+            # a task of a multi-task model, sharing its weights
+            self.saver = saver
+            return
+
         def process_embeddings(name, value):
             if "/we:0" not in name:
                 return value
@@ -106,7 +141,8 @@ class BaseModel(object, metaclass=ABCMeta):
             fallback_filename=base_model_path,
             exclude_matches=None if self.config.save_adam_vars else "Adam",
             variable_transforms=[process_embeddings],
-            save_dtype=self.config.save_dtype
+            save_dtype=self.config.save_dtype,
+            mmap_mode=mmap_mode
         )
 
     @abstractmethod
@@ -123,8 +159,9 @@ class BaseModel(object, metaclass=ABCMeta):
         raise NotImplementedError
 
     def _n_steps(self, n_examples, batch_size, n_gpus):
+        # one step is an optimizer update, which sums the gradients of `gradient_accumulation_steps` batches
         steps = int(math.ceil(
-            n_examples / (batch_size * n_gpus)
+            n_examples / (batch_size * n_gpus * self.config.get("gradient_accumulation_steps", 1))
         ))
         return steps
 
@@ -138,6 +175,10 @@ class BaseModel(object, metaclass=ABCMeta):
             )
         batch_size = batch_size or self.config.batch_size
 
+        accumulation_steps = self.config.get("gradient_accumulation_steps", 1)
+        if accumulation_steps > 1 and len(self.config.visible_gpus) > 1:
+            raise FinetuneError("`gradient_accumulation_steps` > 1 is not supported when training on multiple GPUs.")
+
         val_input_fn, train_input_fn, val_size, val_interval = self.input_pipeline.get_train_input_fns(Xs, Y, batch_size=batch_size)
         if val_size <= 10 and self.config.keep_best_model:
             tf.logging.warning(
@@ -162,19 +203,90 @@ class BaseModel(object, metaclass=ABCMeta):
         if val_size > 0:
             train_hooks.append(
                 tf.contrib.estimator.InMemoryEvaluatorHook(
-                    estimator, val_input_fn, every_n_iter=val_interval, steps=val_size // batch_size
+                    # the evaluator counts batches rather than optimizer updates
+                    estimator, val_input_fn, every_n_iter=val_interval * accumulation_steps,
+                    steps=val_size // batch_size
                 )
             )
         
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            estimator.train(train_input_fn, hooks=train_hooks, steps=num_steps)
+        try:
+            if self.config.get("cache_frozen_activations") and self.config.num_layers_trained < self.config.n_layer:
+                self.input_pipeline.frozen_cache = self._cache_frozen_activations(Xs, Y)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                estimator.train(train_input_fn, hooks=train_hooks, steps=num_steps)
+        finally:
+            if self.input_pipeline.frozen_cache is not None:
+                self.input_pipeline.frozen_cache.close()
+                self.input_pipeline.frozen_cache = None
+        self._close_predictor()
+
+    def _cache_frozen_activations(self, Xs, Y=None):
+        """
+        Runs the frozen lower layers of the featurizer once over every training example.  These layers are not
+        updated by training, so their outputs can be reused in every epoch and by validation.
 
-    def get_estimator(self, force_build_lm=False):
-        conf = tf.ConfigProto(
+        :return: A :py:class:`finetune.input_pipeline.FrozenActivationCache` holding the outputs.
+        """
+        pipeline = self.input_pipeline
+        _, shapes = pipeline.feed_shape_type_def()
+        if not shapes[0]["tokens"].is_fully_defined():
+            raise FinetuneError("`cache_frozen_activations` requires inputs of a fixed shape.")
+        cache = FrozenActivationCache(
+            os.path.join(self.estimator_dir, "frozen_activations.bin"),
+            shape=shapes[0]["tokens"].as_list()[:-1] + [self.config.n_embed]
+        )
+        Xs = Xs() if callable(Xs) else Xs
+        if Y is None:
+            encoded = itertools.chain.from_iterable(map(pipeline.text_to_tokens_mask, Xs))
+        else:
+            Y = Y() if callable(Y) else Y
+            encoded = (feats for feats, _ in itertools.chain.from_iterable(map(pipeline.text_to_tokens_mask, Xs, Y)))
+
+        predictor = Predictor(self, predict_frozen_hidden=True)
+        try:
+            batches = pipeline.batch_features(feats for feats in encoded if feats["tokens"] not in cache)
+            for batch in tqdm.tqdm(batches, desc="Caching frozen layers", disable=not self.config.verbose):
+                for tokens, hidden in zip(batch["tokens"], predictor.run([batch], mode=PredictMode.FROZEN_HIDDEN)):
+                    cache.add(tokens, hidden)
+        except BaseException:
+            cache.close()
+            raise
+        finally:
+            predictor.close()
+        cache.finalize()
+        return cache
+
+    def _session_config(self):
+        return tf.ConfigProto(
             allow_soft_placement=self.config.soft_device_placement,
             log_device_placement=self.config.log_device_placement,
+            intra_op_parallelism_threads=self.config.get("intra_op_threads", 0),
+            inter_op_parallelism_threads=self.config.get("inter_op_threads", 0),
+        )
+
+    def _get_model_fn(self, force_build_lm=False, restore=True, predict_frozen_hidden=False):
+        """
+        :param restore: Include an init op in the scaffold that restores the model weights.  When False, variables
+            must be initialized by the caller.
+        :param predict_frozen_hidden: Add the output of the frozen lower layers to the predictions, as
+            `PredictMode.FROZEN_HIDDEN`.
+        """
+        return get_model_fn(
+            target_model_fn=self._target_model,
+            predict_op=self._predict_op,
+            predict_proba_op=self._predict_proba_op,
+            build_target_model=self.input_pipeline.target_dim is not None,
+            build_lm=force_build_lm or self.config.lm_loss_coef > 0.0 or self.input_pipeline.target_dim is None,
+            encoder=ENCODER,
+            target_dim=self.input_pipeline.target_dim,
+            label_encoder=self.input_pipeline.label_encoder,
+            saver=self.saver if restore else None,
+            predict_frozen_hidden=predict_frozen_hidden
         )
+
+    def get_estimator(self, force_build_lm=False, params=None):
+        conf = self._session_config()
         num_gpus = len(self.config.visible_gpus)
         if num_gpus > 1:
             distribute_strategy = PatchedParameterServerStrategy(num_gpus_per_worker=num_gpus)
@@ -193,42 +305,94 @@ class BaseModel(object, metaclass=ABCMeta):
             keep_checkpoint_max=1
         )
 
-        model_fn = get_model_fn(
-            target_model_fn=self._target_model,
-            predict_op=self._predict_op,
-            predict_proba_op=self._predict_proba_op,
-            build_target_model=self.input_pipeline.target_dim is not None,
-            build_lm=force_build_lm or self.config.lm_loss_coef > 0.0 or self.input_pipeline.target_dim is None,
-            encoder=ENCODER,
-            target_dim=self.input_pipeline.target_dim,
-            label_encoder=self.input_pipeline.label_encoder,
-            saver=self.saver
-        )
         return tf.estimator.Estimator(
             model_dir=self.estimator_dir,
-            model_fn=model_fn,
+            model_fn=self._get_model_fn(force_build_lm=force_build_lm),
             config=config,
-            params=self.config
+            params=params or self.config
         )
 
-    def _inference(self, Xs, mode=None):
-        estimator = self.get_estimator()
-        input_func = self.input_pipeline.get_predict_input_fn(Xs)
-        length = len(Xs) if not callable(Xs) else None
+    def _get_predictor(self, build_lm=False):
+        """
+        Returns the predictor shared by all inference calls, building it on first use.
 
-        pred_gen = list(
-            map(
-                lambda y: y[mode] if mode else y,
-                tqdm.tqdm(
-                    estimator.predict(
-                        input_fn=input_func, predict_keys=mode
-                    ),
-                    total=length,
-                    desc="Inference"
+        :param build_lm: Return the predictor whose graph includes the language model, used for text generation and
+            scoring.  It is built and cached separately.
+        """
+        with self._predictor_lock:
+            if build_lm:
+                if self._lm_predictor is None:
+                    self._lm_predictor = Predictor(self, build_lm=True)
+                return self._lm_predictor
+            if self._predictor is None:
+                self._predictor = Predictor(self)
+            return self._predictor
+
+    def _get_process_pool(self):
+        with self._predictor_lock:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolPredictor(
+                    self,
+                    n_processes=self.config.get("inference_processes", 1),
+                    pin_cores=self.config.get("pin_inference_cores", True)
                 )
+            return self._process_pool
+
+    def _close_predictor(self):
+        with self._predictor_lock:
+            if self._predictor is not None:
+                self._predictor.close()
+                self._predictor = None
+            if self._lm_predictor is not None:
+                self._lm_predictor.close()
+                self._lm_predictor = None
+            if self._process_pool is not None:
+                self._process_pool.close()
+                self._process_pool = None
+
+    @contextlib.contextmanager
+    def inference_batch_size(self, batch_size):
+        """
+        Runs the inference calls that the current thread makes within the context in batches of `batch_size`,
+        without modifying the config.  Used by :py:class:`finetune.serving.BatchingPredictor` to run each
+        micro-batch in a single session call.
+        """
+        previous = getattr(_INFERENCE_OPTIONS, "batch_size", None)
+        _INFERENCE_OPTIONS.batch_size = batch_size
+        try:
+            yield
+        finally:
+            _INFERENCE_OPTIONS.batch_size = previous
+
+    def _inference(self, Xs, mode=None, encoded=False):
+        """
+        Runs the shared prediction graph over Xs.
+
+        Safe to call from several threads at once: the graph and session are built once and reused, and calls do
+        not modify the model or its config.  Calls should not overlap with :meth:`finetune`.
+
+        When `inference_processes > 1`, Xs is instead split into contiguous shards that are run by a pool of worker
+        processes, and the predictions are reassembled in input order.
+
+        :param encoded: If True, Xs has already been encoded by `input_pipeline._text_to_ids`.
+        """
+        batch_size = getattr(_INFERENCE_OPTIONS, "batch_size", None)
+        if self.config.get("inference_processes", 1) > 1 and not callable(Xs):
+            return self._get_process_pool().run(Xs, mode=mode, encoded=encoded, batch_size=batch_size)
+        return self._local_inference(Xs, mode=mode, encoded=encoded, batch_size=batch_size)
+
+    def _local_inference(self, Xs, mode=None, encoded=False, batch_size=None):
+        predictor = self._get_predictor()
+        length = len(Xs) if not callable(Xs) else None
+        batches = self.input_pipeline.get_predict_batches(Xs, batch_size=batch_size, encoded=encoded)
+        return list(
+            tqdm.tqdm(
+                predictor.run(batches, mode=mode),
+                total=length,
+                desc="Inference",
+                disable=not self.config.verbose
             )
         )
-        return pred_gen
 
     def fit(self, *args, **kwargs):
         """ An alias for finetune. """
@@ -248,12 +412,18 @@ class BaseModel(object, metaclass=ABCMeta):
         raw_preds = self._inference(Xs, PredictMode.PROBAS)
         return raw_preds
 
-    def predict_proba(self, *args, **kwargs):
+    def predict_proba(self, *args, as_array=False, **kwargs):
         """
         The base method for predicting from the model.
+
+        :param as_array: If True, return a numpy array of shape [n_examples, n_classes] whose columns are ordered
+            as in `classes_`, rather than a list of dictionaries.
         """
         raw_probas = self._predict_proba(*args, **kwargs)
-        classes = self.input_pipeline.label_encoder.classes_
+        if as_array:
+            return np.asarray(raw_probas)
+
+        classes = self.classes_
 
         formatted_predictions = []
         for probas in raw_probas:
@@ -262,6 +432,13 @@ class BaseModel(object, metaclass=ABCMeta):
             )
         return formatted_predictions
 
+    @property
+    def classes_(self):
+        """
+        Class labels known to the model, in the order used by `predict_proba(..., as_array=True)`.
+        """
+        return self.input_pipeline.label_encoder.classes_
+
     def _featurize(self, Xs):
         raw_preds = self._inference(Xs, PredictMode.FEATURIZE)
         return np.asarray(raw_preds)
@@ -293,46 +470,98 @@ class BaseModel(object, metaclass=ABCMeta):
     def generate_text(self, seed_text='', max_length=None, use_extra_toks=True):
         """
         Performs a prediction on the Language modeling objective given some seed text. It uses a noisy greedy decoding.
-        Temperature parameter for decoding is set in the config.
+        Temperature parameter for decoding is set in the config.  Keys and values of previous tokens are cached, so each
+        generated token costs a single step of the model.
         :param max_length: The maximum length to decode to.
         :param seed_text: Defaults to the empty string. This will form the starting point to begin modelling
         :return: A string containing the generated text.
         """
-        def dataset_encoded():
-            while not dataset_encoded.finished:
-                yield {"tokens": arr_encoded.token_ids, "mask": arr_encoded.mask}
-
-        dataset_encoded.finished = False
+        return self.generate_texts([seed_text], max_length=max_length, use_extra_toks=use_extra_toks)[0]
 
-        def get_input_fn():
-            types, shapes = self.input_pipeline.feed_shape_type_def()
-            tf_dataset = Dataset.from_generator(dataset_encoded, types[0], shapes[0])
-            return tf_dataset.batch(1)
+    def generate_texts(self, seeds, max_length=None, use_extra_toks=True, temperature=None):
+        """
+        Performs predictions on the Language modeling objective for many seed texts at once.  Seeds are decoded in
+        parallel in batches of `predict_batch_size` and each sequence stops at its own end token.
+        :param seeds: A list of seed texts, each forms the starting point of one generated text.
+        :param max_length: The maximum length to decode to.
+        :param use_extra_toks: Allow the start, delimiter and classify tokens in the seeds and generated texts.
+        :param temperature: The sampling temperature, `0.0` gives greedy decoding.  Defaults to `lm_temp` from the
+            config.
+        :return: A list of strings containing the generated texts, in the order of `seeds`.
+        """
+        feed = {PredictFeed.USE_EXTRA_TOKS: use_extra_toks}
+        if max_length is not None:
+            feed[PredictFeed.DECODE_LENGTH] = max_length
+        if temperature is not None:
+            feed[PredictFeed.LM_TEMPERATURE] = temperature
 
-        self.config.use_extra_toks = use_extra_toks
-        encoded = ENCODER._encode([seed_text])
-        if encoded == [] and not use_extra_toks:
-            raise ValueError("If you are not using the extra tokens, you must provide some non-empty seed text")
         start = [ENCODER.start] if use_extra_toks else []
-        encoded = EncodedOutput(token_ids=start + encoded.token_ids[0])
-
-        estimator = self.get_estimator(force_build_lm=True)
-        predict = estimator.predict(input_fn=get_input_fn,)
+        prompts = [start + token_ids for token_ids in ENCODER._encode(seeds).token_ids]
+        if not all(prompts):
+            raise ValueError("If you are not using the extra tokens, you must provide some non-empty seed text")
 
-        EOS = ENCODER.clf_token
+        # batching prompts of similar length together reduces the prompt tokens that are fed one step at a time
+        order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]))
+        features = (
+            {"tokens": arr_encoded.token_ids, "mask": arr_encoded.mask}
+            for arr_encoded in (
+                self.input_pipeline._array_format(EncodedOutput(token_ids=prompts[i])) for i in order
+            )
+        )
+        predictor = self._get_predictor(build_lm=True)
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore")
-            for i in range(len(encoded.token_ids), (max_length or self.config.max_length) - 2):
-                arr_encoded = self.input_pipeline._array_format(encoded)
-                class_idx = next(predict)[PredictMode.GENERATE_TEXT]
-                encoded.token_ids.append(class_idx[i])
-                if encoded.token_ids[-1] == EOS:
-                    break
-            dataset_encoded.finished = True
-
-        del self.config["use_extra_toks"]
+            outputs = list(predictor.run(
+                self.input_pipeline.batch_features(features), mode=PredictMode.GENERATE_TEXT, feed=feed
+            ))
 
-        return ENCODER.decode(encoded.token_ids)
+        EOS = ENCODER.clf_token
+        texts = [None] * len(prompts)
+        for i, token_ids in zip(order, outputs):
+            generated = list(token_ids[len(prompts[i]):])
+            if EOS in generated:
+                generated = generated[:generated.index(EOS) + 1]
+            texts[i] = ENCODER.decode(prompts[i] + generated)
+        return texts
+
+    def score(self, texts):
+        """
+        Scores texts with the language model.  Texts are run in batches of `predict_batch_size` and only the logits of
+        the observed tokens are computed in full.
+
+        :param texts: A list of texts.  Texts longer than `max_length - 1` byte-pair encoded tokens are truncated.
+        :return: A list with a dict for each text, containing:
+            tokens: The byte-pair encoded tokens of the text.
+            token_log_likelihoods: The natural log-likelihood of each token given the tokens before it.
+            log_likelihood: The log-likelihood of the text, the sum of `token_log_likelihoods`.
+            perplexity: The exponential of the negative mean token log-likelihood.
+        """
+        encoded = ENCODER._encode(texts)
+        max_tokens = self.config.max_length - 1
+        if any(len(token_ids) > max_tokens for token_ids in encoded.token_ids):
+            warnings.warn("Some texts are longer than max_length, only their first {} tokens are scored.".format(
+                max_tokens
+            ))
+        token_ids = [token_ids[:max_tokens] for token_ids in encoded.token_ids]
+        features = (
+            {"tokens": arr_encoded.token_ids, "mask": arr_encoded.mask}
+            for arr_encoded in (
+                self.input_pipeline._array_format(EncodedOutput(token_ids=[ENCODER.start] + ids)) for ids in token_ids
+            )
+        )
+        outputs = self._get_predictor(build_lm=True).run(
+            self.input_pipeline.batch_features(features), mode=PredictMode.LM_SCORE
+        )
+        scores = []
+        for tokens, ids, log_likelihoods in zip(encoded.tokens, token_ids, outputs):
+            log_likelihoods = log_likelihoods[:len(ids)]
+            scores.append({
+                "tokens": tokens[:len(ids)],
+                "token_log_likelihoods": log_likelihoods,
+                "log_likelihood": float(np.sum(log_likelihoods)),
+                "perplexity": float(np.exp(-np.mean(log_likelihoods))) if len(ids) else float("nan"),
+            })
+        return scores
 
     def __getstate__(self):
         """
@@ -366,18 +595,69 @@ class BaseModel(object, metaclass=ABCMeta):
         self.saver.save(self, path)
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, mmap_mode=None):
         """
         Load a saved fine-tuned model from disk.  Path provided should be a folder which contains .pkl and tf.Saver() files
 
         :param path: string path name to load model from.  Same value as previously provided to :meth:`save`. Must be a folder.
+        :param mmap_mode: Passed to `joblib.load`.  Use "r" to memory-map saved weights read-only, so that processes
+            loading the same file share its pages.
         """
         saver = Saver(JL_BASE)
-        model = saver.load(path)
-        model._initialize()
+        model = saver.load(path, mmap_mode=mmap_mode)
+        model._initialize(mmap_mode=mmap_mode)
         model.saver.variables = saver.variables
         return model
 
+    def export(self, path):
+        """
+        Exports a self-contained inference graph to the folder specified by `path`.  The model weights are folded
+        into the graph as constants and operations that are not needed at inference time are pruned.  The exported
+        folder also holds the tokenizer vocabulary and the state needed to decode predictions.
+
+        The export is loaded with :meth:`load_exported`, which skips building the model and loading the base model
+        weights.
+
+        :param path: Folder to write the export to.  Auto-created if it does not exist.
+        """
+        path = os.path.abspath(path)
+        pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+        predictor = Predictor(self)
+        try:
+            graph_def, inputs, outputs = predictor.freeze()
+        finally:
+            predictor.close()
+
+        with open(os.path.join(path, EXPORT_GRAPH), "wb") as f:
+            f.write(graph_def.SerializeToString())
+        joblib.dump((self, inputs, outputs), os.path.join(path, EXPORT_STATE))
+        for asset in (ENCODER.encoder_path, ENCODER.bpe_path):
+            shutil.copy(asset, path)
+
+    @classmethod
+    def load_exported(cls, path):
+        """
+        Load a model previously written by :meth:`export`.  The returned model supports `predict`, `predict_proba`
+        and `featurize` but cannot be trained or saved.
+
+        :param path: Same value as previously provided to :meth:`export`.
+        """
+        model, inputs, outputs = joblib.load(os.path.join(path, EXPORT_STATE))
+        if not ENCODER.initialized:
+            ENCODER.encoder_path = os.path.join(path, os.path.basename(ENCODER.encoder_path))
+            ENCODER.bpe_path = os.path.join(path, os.path.basename(ENCODER.bpe_path))
+
+        graph_def = tf.GraphDef()
+        with open(os.path.join(path, EXPORT_GRAPH), "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        model.config.inference_processes = 1
+        model._initialize_state()
+        model.saver = None
+        model.cleanup_glob = None
+        model._predictor = FrozenPredictor(graph_def, inputs, outputs, session_config=model._session_config())
+        return model
+
     @classmethod
     def finetune_grid_search(cls, Xs, Y, *, test_size, config=None, eval_fn=None, probs=False, return_all=False):
         """
@@ -473,6 +753,12 @@ class BaseModel(object, metaclass=ABCMeta):
         return max(aggregated_results, key=lambda x: x[1])[0]
 
     def __del__(self):
+        if getattr(self, '_predictor', None) is not None:
+            self._predictor.close()
+        if getattr(self, '_lm_predictor', None) is not None:
+            self._lm_predictor.close()
+        if getattr(self, '_process_pool', None) is not None:
+            self._process_pool.close()
         if hasattr(self, 'cleanup_glob') and self.cleanup_glob is not None:
             for file_or_folder in glob.glob(self.cleanup_glob):
                 try:
@@ -49,14 +49,15 @@ class Classifier(BaseModel):
         """
         return super().predict(X)
 
-    def predict_proba(self, X):
+    def predict_proba(self, X, as_array=False):
         """
         Produces a probability distribution over classes for each example in X.
 
         :param X: list or array of text to embed.
+        :param as_array: If True, return an array of shape [n_examples, n_classes] with columns ordered as `classes_`.
         :returns: list of dictionaries.  Each dictionary maps from a class label to its assigned class probability.
         """
-        return super().predict_proba(X)
+        return super().predict_proba(X, as_array=as_array)
 
     def finetune(self, X, Y=None, batch_size=None):
         """
@@ -65,15 +65,16 @@ class Comparison(Classifier):
         """
         return BaseModel.predict(self, pairs)
 
-    def predict_proba(self, pairs):
+    def predict_proba(self, pairs, as_array=False):
         """
         Produces a probability distribution over classes for each example in X.
 
 
         :param pairs: Array of text, shape [batch, 2]
+        :param as_array: If True, return an array of shape [n_examples, n_classes] with columns ordered as `classes_`.
         :returns: list of dictionaries.  Each dictionary maps from a class label to its assigned class probability.
         """
-        return BaseModel.predict_proba(self, pairs)
+        return BaseModel.predict_proba(self, pairs, as_array=as_array)
 
     def featurize(self, pairs):
         """
@@ -63,6 +63,12 @@ class Settings(dict):
     Model configuration options
 
     :param batch_size: Number of examples per batch, defaults to `2`.
+    :param gradient_accumulation_steps: Number of batches whose gradients are averaged before each optimizer update,
+        so that an update sees `batch_size * gradient_accumulation_steps` examples while only `batch_size` examples are
+        in memory.  The learning rate schedule, `val_interval` and `early_stopping_steps` count optimizer updates.
+        Sparse embedding gradients stay sparse across accumulated batches.  Not supported with more than one GPU in
+        `visible_gpus`.  Defaults to `1`.
+    :param predict_batch_size: Number of examples per batch at inference time, defaults to `batch_size`.
     :param visible_gpus: List of integer GPU ids to spread out computation across, defaults to all available GPUs.
     :param n_epochs: Number of iterations through training data, defaults to `3`.
     :param random_seed: Random seed to use for repeatability purposes, defaults to `42`.
@@ -71,8 +77,26 @@ class Settings(dict):
     :param weight_stddev: Standard deviation of initial weights.  Defaults to `0.02`.
     :param chunk_long_sequences: When True, use a sliding window approach to predict on 
         examples that are longer than max length.  Defaults to `False`.
+    :param chunk_stride: Number of subtokens between the starts of consecutive windows when `chunk_long_sequences=True`.
+        Larger strides run fewer windows per document at the cost of less context around each prediction.
+        Defaults to `(max_length - 2) // 3`.
+    :param chunk_context: Number of leading subtokens of each window that are only used as context, predictions are
+        kept for the `chunk_stride` subtokens that follow.  Defaults to `chunk_stride`, or less if needed to fit a
+        window.
     :param low_memory_mode: When True, only store partial gradients on forward pass
         and recompute remaining gradients incrementally in order to save memory.  Defaults to `False`.
+    :param recompute_policy: Which blocks recompute their activations on the backward pass when `low_memory_mode=True`.
+        `"all"` recomputes every trained block, `"every_k"` recomputes every `recompute_every_k`-th trained block,
+        `"attention"` recomputes only the attention sublayer of each block and `"budget"` keeps the activations of as
+        many blocks nearest the output as fit in `recompute_memory_budget` and recomputes the rest.  The selected
+        blocks and an estimate of their activation memory are logged when the training graph is built.
+        Defaults to `"all"`.
+    :param recompute_every_k: Period of the blocks recomputed by `recompute_policy="every_k"`.  Defaults to `2`.
+    :param recompute_memory_budget: Memory in MB for the activations of the trained blocks under
+        `recompute_policy="budget"`.  The estimate counts `batch_size` sequences per batch, so models whose examples
+        hold a varying number of sequences, such as `MultipleChoice`, should divide the budget by the most answers in
+        a batch.  The attention layer of `SequenceLabeler` only keeps its activations when they fit in the memory
+        left by the trained blocks.  Defaults to `None`.
     :param interpolate_pos_embed: Interpolate positional embeddings when `max_length` differs from it's original value of 
         `512`. Defaults to `False`.
     :param embed_p_drop: Embedding dropout probability.  Defaults to `0.1`.
@@ -96,10 +120,20 @@ class Settings(dict):
 
     :param val_size: Validation set size as a percentage of all training data.  Validation will not be run by default if n_examples < 50.
         If n_examples > 50, defaults to max(5, min(100, 0.05 * n_examples))
-    :param val_interval: Evaluate on validation set after `val_interval` batches.  
-        Defaults to 4 * val_size / batch_size to ensure that too much time is not spent on validation.
+    :param val_interval: Evaluate on validation set after `val_interval` optimizer updates.  
+        Defaults to 4 * val_size / (batch_size * gradient_accumulation_steps) to ensure that too much time is not spent on validation.
     :param lm_temp: Language model temperature -- a value of `0.0` corresponds to greedy maximum likelihood predictions
         while a value of `1.0` corresponds to random predictions. Defaults to `0.2`. 
+    :param lm_loss_softmax: How the language model loss is computed during training.  `"full"` computes logits over
+        the whole embedding matrix.  `"sampled"` uses a sampled softmax over `lm_num_sampled` negative tokens.
+        `"chunked"` computes the exact loss over the vocabulary `lm_vocab_chunk_size` entries at a time, and
+        recomputes those logits for the gradient.  Evaluation and prediction always use full logits.
+        Defaults to `"full"`.
+    :param lm_num_sampled: Number of negative tokens sampled per batch when `lm_loss_softmax="sampled"`.
+        Defaults to `4096`.
+    :param lm_vocab_chunk_size: Number of vocabulary entries the language model computes logits for at a time when
+        scoring texts or when `lm_loss_softmax="chunked"`, which bounds memory to `lm_vocab_chunk_size` logits per
+        token.  Defaults to `8192`.
     :param seq_num_heads: Number of attention heads of final attention layer. Defaults to `16`.
     :param subtoken_predictions: Return predictions at subtoken granularity or token granularity?  Defaults to `False`.
     :param multi_label_sequences: Use a multi-labeling approach to sequence labeling to allow overlapping labels.
@@ -113,12 +147,26 @@ class Settings(dict):
     :param save_adam_vars: Save adam parameters when calling `model.save()`.  Defaults to `True`.
     :param num_layers_trained: How many layers to finetune.  Specifying a value less than 12 will train layers starting from model output. Defaults to `12`.
     :param train_embeddings: Should embedding layer be finetuned? Defaults to `True`.
+    :param sparse_embedding_updates: When `train_embeddings=True`, apply embedding dropout to the rows gathered for
+        each batch instead of to the whole embedding matrix, and update the embeddings with a lazy variant of AdamW
+        that only touches those rows.  Updates are dense while the language model loss is used, since its output
+        layer shares the embedding matrix.  Defaults to `False`.
+    :param cache_frozen_activations: When `num_layers_trained` is less than `n_layer`, run the frozen lower layers once
+        per training example before training starts and feed the cached hidden states to the trained layers in every
+        epoch.  The cache is a temporary file of `max_length * n_embed` float32 values per example.  Defaults to `False`.
     :param class_weights: One of 'log', 'linear', or 'sqrt'. Auto-scales gradient updates based on class frequency.  Can also be a dictionary that maps from true class name to loss coefficient. Defaults to `None`.
     :param oversample: Should rare classes be oversampled?  Defaults to `False`.
     :param params_device: Which device should gradient updates be aggregated on?
         If you are using a single GPU and have more than 4Gb of GPU memory you should set this to GPU PCI number (0, 1, 2, etc.). Defaults to `"cpu"`.
     :param eval_acc: if True, calculates accuracy and writes it to the tensorboard summary files for valudation runs.
     :param save_dtype: specifies what precision to save model weights with.  Defaults to `np.float32`.
+    :param inference_processes: Number of worker processes to shard `predict`, `predict_proba` and `featurize` across.
+        Each worker holds its own session.  Defaults to `1` (inference runs in this process).
+    :param pin_inference_cores: When `inference_processes > 1`, pin each worker process to its own group of cores.
+        Defaults to `True`.
+    :param intra_op_threads: Threads used within a single tf op.  Defaults to `0` (chosen by tf).  Workers with
+        pinned cores default to the size of their core group.
+    :param inter_op_threads: Threads used to run independent tf ops in parallel.  Defaults to `0` (chosen by tf).
     """
     def get_grid_searchable(self):
         return self.grid_searchable
@@ -155,13 +203,20 @@ def get_default_config():
     return Settings(
         dataset_size=None,
         batch_size=2,
+        gradient_accumulation_steps=1,
+        predict_batch_size=None,
         visible_gpus=all_gpus(),
         n_epochs=GridSearchable(3, [1, 2, 3, 4]),
         seed=42,
         max_length=512,
         weight_stddev=0.02,
         chunk_long_sequences=False,
+        chunk_stride=None,
+        chunk_context=None,
         low_memory_mode=False,
+        recompute_policy="all",
+        recompute_every_k=2,
+        recompute_memory_budget=None,
         interpolate_pos_embed=True,
         embed_p_drop=0.1,
         attn_p_drop=0.1,
@@ -182,6 +237,9 @@ def get_default_config():
         val_size=None,
         val_interval=None,
         lm_temp=0.2,
+        lm_loss_softmax="full",
+        lm_num_sampled=4096,
+        lm_vocab_chunk_size=8192,
         seq_num_heads=16,
         pad_token="<PAD>",
         subtoken_predictions=False,
@@ -198,11 +256,17 @@ def get_default_config():
         save_adam_vars=True,
         num_layers_trained=12,
         train_embeddings=True,
+        sparse_embedding_updates=False,
+        cache_frozen_activations=False,
         class_weights=None,
         oversample=False,
         params_device="cpu",
         eval_acc=False,
         save_dtype=None,
+        inference_processes=1,
+        pin_inference_cores=True,
+        intra_op_threads=0,
+        inter_op_threads=0,
 
         # Must remain fixed
         n_heads=12,
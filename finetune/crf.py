@@ -8,40 +8,100 @@ def viterbi_decode(score, transition_params):
     """Decode the highest scoring sequence of tags outside of TensorFlow.
     This should only be used at test time.
     Args:
-        score: A [seq_len, num_tags] matrix of unary potentials.
-        transition_params: A [num_tags, num_tags] matrix of binary potentials.
+        score: A [..., seq_len, num_tags] array of unary potentials.  Leading dimensions are decoded independently.
+        transition_params: A [..., num_tags, num_tags] array of binary potentials, broadcastable against the leading
+            dimensions of `score`.
     Returns:
-        viterbi: A [seq_len] list of integers containing the highest scoring tag
-            indices.
-        viterbi_score: A float containing the score for the Viterbi sequence.
+        viterbi: A [..., seq_len] array of integers containing the highest scoring tag indices.
+        viterbi_probas: A [..., seq_len, num_tags] array, the softmax of the viterbi trellis.
     """
+    score = np.asarray(score)
     trellis = np.zeros_like(score)
-    backpointers = np.zeros_like(score, dtype=np.int32)
-    trellis[0] = score[0]
+    backpointers = np.zeros(score.shape, dtype=np.int32)
+    trellis[..., 0, :] = score[..., 0, :]
 
-    for t in range(1, score.shape[0]):
-        v = np.expand_dims(trellis[t - 1], 1) + transition_params
-        trellis[t] = score[t] + np.max(v, 0)
-        backpointers[t] = np.argmax(v, 0)
+    for t in range(1, score.shape[-2]):
+        v = np.expand_dims(trellis[..., t - 1, :], -1) + transition_params
+        trellis[..., t, :] = score[..., t, :] + np.max(v, -2)
+        backpointers[..., t, :] = np.argmax(v, -2)
 
-    viterbi = [np.argmax(trellis[-1])]
-    for bp in reversed(backpointers[1:]):
-        viterbi.append(bp[viterbi[-1]])
-    viterbi.reverse()
+    viterbi = np.zeros(score.shape[:-1], dtype=np.int32)
+    viterbi[..., -1] = np.argmax(trellis[..., -1, :], -1)
+    leading = np.ix_(*[np.arange(dim) for dim in score.shape[:-2]])
+    for t in range(score.shape[-2] - 1, 0, -1):
+        viterbi[..., t - 1] = backpointers[..., t, :][leading + (viterbi[..., t],)]
 
     return viterbi, np_softmax(trellis, axis=-1)
 
 
 def sequence_decode(logits, transition_matrix):
-    """ A simple py_func wrapper around the Viterbi decode allowing it to be included in the tensorflow graph. """
-
-    def _sequence_decode(logits, transition_matrix):
-        all_predictions = []
-        all_logits = []
-        for logit in logits:
-            viterbi_sequence, viterbi_logits = viterbi_decode(logit, transition_matrix)
-            all_predictions.append(viterbi_sequence)
-            all_logits.append(viterbi_logits)
-        return np.array(all_predictions, dtype=np.int32), np.array(all_logits, dtype=np.float32)
-
-    return tf.py_func(_sequence_decode, [logits, transition_matrix], [tf.int32, tf.float32])
+    """
+    In-graph Viterbi decode, equivalent to `viterbi_decode`.
+
+    :param logits: A [..., seq_len, num_tags] tensor of unary potentials.  Leading dimensions are decoded independently.
+    :param transition_matrix: A [..., num_tags, num_tags] tensor of binary potentials, broadcastable against the
+        leading dimensions of `logits`.
+    :return: A [..., seq_len] int32 tensor of the highest scoring tag indices and a [..., seq_len, num_tags] tensor of
+        the softmax of the viterbi trellis.
+    """
+    rank = logits.shape.ndims
+    # scan runs over the leading dimension, so move time to the front.
+    time_major = [rank - 2] + list(range(rank - 2)) + [rank - 1]
+    batch_major = list(range(1, rank - 1)) + [0, rank - 1]
+    scores = tf.transpose(logits, time_major)
+    num_tags = tf.shape(scores)[-1]
+
+    def forward(state, score_t):
+        trellis, _ = state
+        v = tf.expand_dims(trellis, -1) + transition_matrix
+        return score_t + tf.reduce_max(v, -2), tf.argmax(v, -2, output_type=tf.int32)
+
+    trellis, backpointers = tf.scan(
+        forward, scores[1:], initializer=(scores[0], tf.zeros_like(scores[0], dtype=tf.int32))
+    )
+    trellis = tf.concat([scores[:1], trellis], 0)
+
+    def backward(tag, backpointers_t):
+        return tf.reduce_sum(backpointers_t * tf.one_hot(tag, num_tags, dtype=tf.int32), -1)
+
+    last = tf.argmax(trellis[-1], -1, output_type=tf.int32)
+    viterbi = tf.scan(backward, tf.reverse(backpointers, [0]), initializer=last)
+    viterbi = tf.reverse(tf.concat([tf.expand_dims(last, 0), viterbi], 0), [0])
+
+    return (
+        tf.transpose(viterbi, batch_major[:-1]),
+        tf.transpose(tf.nn.softmax(trellis, -1), batch_major)
+    )
+
+
+def crf_log_likelihood(inputs, tag_indices, transition_params):
+    """
+    Log-likelihood of tag sequences under a linear-chain CRF, equivalent to `tf.contrib.crf.crf_log_likelihood` with
+    every sequence running the full length of `inputs`, but vectorised over any number of leading dimensions so that
+    many independent CRFs can be computed in a single op.
+
+    :param inputs: A [..., seq_len, num_tags] tensor of unary potentials.
+    :param tag_indices: A [..., seq_len] int tensor of the tags to compute the likelihood of.
+    :param transition_params: A [..., num_tags, num_tags] tensor of binary potentials, broadcastable against the
+        leading dimensions of `inputs`.
+    :return: A [...] tensor of log-likelihoods.
+    """
+    num_tags = tf.shape(inputs)[-1]
+    tags = tf.one_hot(tag_indices, num_tags, dtype=inputs.dtype)
+    unary_scores = tf.reduce_sum(inputs * tags, [-2, -1])
+    binary_scores = tf.reduce_sum(
+        tf.expand_dims(tags[..., :-1, :], -1) *
+        tf.expand_dims(transition_params, -3) *
+        tf.expand_dims(tags[..., 1:, :], -2),
+        [-3, -2, -1]
+    )
+
+    rank = inputs.shape.ndims
+    time_major = tf.transpose(inputs, [rank - 2] + list(range(rank - 2)) + [rank - 1])
+
+    def forward(alpha, score_t):
+        return score_t + tf.reduce_logsumexp(tf.expand_dims(alpha, -1) + transition_params, -2)
+
+    alphas = tf.scan(forward, time_major[1:], initializer=time_major[0])
+    log_norm = tf.reduce_logsumexp(alphas[-1], -1)
+    return unary_scores + binary_scores - log_norm
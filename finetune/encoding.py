@@ -6,6 +6,7 @@ import json
 import os
 import warnings
 import functools
+import threading
 from collections import namedtuple
 import codecs
 
@@ -20,6 +21,14 @@ ENCODER_PATH = os.path.join(os.path.dirname(__file__), 'model/encoder_bpe_40000.
 BPE_PATH = os.path.join(os.path.dirname(__file__), 'model/vocab_40000.bpe')
 NLP = spacy.load('en', disable=['parser', 'tagger', 'ner', 'textcat'])
 
+TOKENIZATION_CACHE_SIZE = 4096
+
+Tokenization = namedtuple("Tokenization", [
+    "texts",  # tuple of token strings
+    "starts", # tuple of character offsets of the start of each token
+    "ends",   # tuple of character offsets of the end of each token
+])
+
 EncodedOutput = namedtuple("EncodedOutput", [
     "token_ids", # list of list of subtoken ids (ints)
     "tokens",    # list of list of subtokens (strs)
@@ -62,6 +71,22 @@ def _get_pairs(word):
     return pairs
 
 
+@functools.lru_cache(maxsize=TOKENIZATION_CACHE_SIZE)
+def tokenize(text):
+    """
+    Splits text into spacy tokens.  Results are cached by text, so that converting annotations, encoding, decoding
+    predictions and computing metrics for the same document only runs spacy once.
+
+    :return: A `Tokenization` of immutable tuples.
+    """
+    tokens = NLP(text)
+    return Tokenization(
+        texts=tuple(token.text for token in tokens),
+        starts=tuple(token.idx for token in tokens),
+        ends=tuple(token.idx + len(token.text) for token in tokens),
+    )
+
+
 def _text_standardize(text):
     """
     Fixes some issues the spacy tokenizer had on books corpus
@@ -80,14 +105,22 @@ class TextEncoder(object):
     """
     UNK_IDX = 0
 
-    def __init__(self):
+    def __init__(self, encoder_path=ENCODER_PATH, bpe_path=BPE_PATH):
+        self.encoder_path = encoder_path
+        self.bpe_path = bpe_path
         self.initialized = False
+        self._init_lock = threading.Lock()
 
     def _lazy_init(self):
         if self.initialized:
             return
 
-        self.encoder = json.load(open(ENCODER_PATH))
+        with self._init_lock:
+            if not self.initialized:
+                self._load_vocab()
+
+    def _load_vocab(self):
+        self.encoder = json.load(open(self.encoder_path))
         self.decoder = {v: k for k, v in self.encoder.items()}
 
         self.special_tokens = ['_start_', '_delimiter_', '_classify_']
@@ -96,7 +129,7 @@ class TextEncoder(object):
 
         self.decoder = {v: k for k, v in self.encoder.items()}
 
-        merges = codecs.open(BPE_PATH, encoding='utf8').read().split('\n')[1:-1]
+        merges = codecs.open(self.bpe_path, encoding='utf8').read().split('\n')[1:-1]
         merges = [tuple(merge.split()) for merge in merges]
         self.bpe_ranks = dict(zip(merges, range(len(merges))))
         self.cache = {}
@@ -174,39 +207,11 @@ class TextEncoder(object):
         for i, text in enumerate(texts):
             if labels is not None:
                 label = labels[i]
-            raw_text = text.lower()
-            tokens = NLP(_text_standardize(text))
-            subtokens = []
-            subtoken_idxs = []
-            tok_pos = []
-            token_start = 0
+            subtokens, subtoken_idxs, tok_pos = self._encode_text(text)
 
-            for j, token in enumerate(tokens):
-                bpe_toks = self.bpe(token.text).split(' ')
-
-                try:
-                    if token.text.strip():
-                        token_start = raw_text.index(token.text, token_start)
-                except:
-                    # text_standardization oddity
-                    continue
-
-                subtokens.extend(bpe_toks)
-                subtoken_idxs.extend([
-                    self.encoder.get(SUBS.get(t, t), self.UNK_IDX)
-                    for t in bpe_toks
-                ])
-                
-                assert len("".join(bpe_toks).replace("</w>", "")) == len(token.text.replace(' ', ''))
-                subtoken_positions = np.cumsum([len(tok.replace("</w>", '')) for tok in bpe_toks]) + token_start
-
-                token_start += len(token.text.strip())
-                
-                tok_pos.extend(subtoken_positions)
-            
-            batch_tokens.append(subtokens)
-            batch_token_idxs.append(subtoken_idxs)
-            batch_character_locs.append(tok_pos)
+            batch_tokens.append(list(subtokens))
+            batch_token_idxs.append(list(subtoken_idxs))
+            batch_character_locs.append(list(tok_pos))
             if labels is not None:
                 batch_label_idxs.append([label] * len(subtoken_idxs))
 
@@ -217,6 +222,45 @@ class TextEncoder(object):
             char_locs=batch_character_locs,
         )
 
+    @functools.lru_cache(maxsize=TOKENIZATION_CACHE_SIZE)
+    def _encode_text(self, text):
+        """
+        Byte-pair encodes a single text, cached by text.
+
+        :return: Tuples of subtokens, subtoken ids and the character offset of the end of each subtoken.
+        """
+        raw_text = text.lower()
+        tokens = tokenize(_text_standardize(text))
+        subtokens = []
+        subtoken_idxs = []
+        tok_pos = []
+        token_start = 0
+
+        for token_text in tokens.texts:
+            bpe_toks = self.bpe(token_text).split(' ')
+
+            try:
+                if token_text.strip():
+                    token_start = raw_text.index(token_text, token_start)
+            except:
+                # text_standardization oddity
+                continue
+
+            subtokens.extend(bpe_toks)
+            subtoken_idxs.extend([
+                self.encoder.get(SUBS.get(t, t), self.UNK_IDX)
+                for t in bpe_toks
+            ])
+
+            assert len("".join(bpe_toks).replace("</w>", "")) == len(token_text.replace(' ', ''))
+            subtoken_positions = np.cumsum([len(tok.replace("</w>", '')) for tok in bpe_toks]) + token_start
+
+            token_start += len(token_text.strip())
+
+            tok_pos.extend(subtoken_positions)
+
+        return tuple(subtokens), tuple(subtoken_idxs), tuple(tok_pos)
+
     def decode(self, ids):
         """
         Convert a batch of ids [batch_size, id] into text(ish).
@@ -0,0 +1,370 @@
+"""
+Inference on a prediction graph that is built once per model and shared between calls.
+"""
+import copy
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import joblib
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from finetune.errors import FinetuneError
+from finetune.input_pipeline import ENCODER
+from finetune.model import PredictMode
+from finetune.network_modules import featurizer
+
+LOGGER = logging.getLogger('finetune')
+
+
+def _select(predictions, mode):
+    if mode is None:
+        return predictions
+    if isinstance(mode, (list, tuple)):
+        return {key: predictions[key] for key in mode}
+    return predictions[mode]
+
+
+def _per_example(outputs):
+    if not isinstance(outputs, dict):
+        return list(outputs)
+    batch_size = len(next(iter(outputs.values())))
+    return [{key: value[i] for key, value in outputs.items()} for i in range(batch_size)]
+
+
+class Predictor:
+    """
+    Holds the prediction graph of a model along with a session that has the model weights loaded.
+
+    `tf.Session.run` is thread-safe and releases the GIL while running, so a single predictor serves concurrent
+    callers in parallel.  All per-call state lives in the arguments to :meth:`run`.
+
+    :param model: A :py:class:`finetune.base.BaseModel` instance.
+    :param build_lm: Include the language model in the prediction graph.
+    :param params: The config the graph is built with.  Defaults to the config of the model.
+    :param predict_frozen_hidden: Include the output of the frozen lower layers in the predictions.
+    """
+
+    def __init__(self, model, build_lm=False, params=None, predict_frozen_hidden=False):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.set_random_seed(model.config.seed)
+            types, shapes = model.input_pipeline.feed_shape_type_def()
+            self.placeholders = {
+                name: tf.placeholder(dtype, shape=[None] + shapes[0][name].as_list(), name=name)
+                for name, dtype in types[0].items()
+            }
+            model_fn = model._get_model_fn(force_build_lm=build_lm, predict_frozen_hidden=predict_frozen_hidden)
+            spec = model_fn(
+                features=dict(self.placeholders),
+                labels=None,
+                mode=tf.estimator.ModeKeys.PREDICT,
+                params=params or model.config
+            )
+            self.predictions = spec.predictions
+            self.session = tf.Session(graph=self.graph, config=model._session_config())
+            self.session.run(spec.scaffold.init_op)
+        self.graph.finalize()
+
+    def run(self, batches, mode=None, feed=None):
+        """
+        Runs the prediction graph on batches of encoded examples.
+
+        :param batches: An iterable of feature dictionaries, each mapping a feature name to an array of shape
+            [batch_size, ...] as produced by :meth:`BasePipeline.get_predict_batches`.
+        :param mode: A :py:class:`finetune.model.PredictMode`, or a list of them. When None, all predictions are
+            returned.
+        :param feed: A dict mapping :py:class:`finetune.model.PredictFeed` names to values that override the config
+            for this call.
+        :return: A generator of per-example predictions.  Each is a dict keyed by `PredictMode` when `mode` is None
+            or a list, otherwise the value for `mode`.
+        """
+        fetches = _select(self.predictions, mode)
+        try:
+            feed = {self.graph.get_tensor_by_name(name + ":0"): value for name, value in (feed or {}).items()}
+        except KeyError as e:
+            raise FinetuneError("The prediction graph has no placeholder for {}".format(e))
+        for batch in batches:
+            feed_dict = {self.placeholders[name]: value for name, value in batch.items()}
+            feed_dict.update(feed)
+            outputs = self.session.run(fetches, feed_dict=feed_dict)
+            yield from _per_example(outputs)
+
+    def close(self):
+        self.session.close()
+
+    def freeze(self):
+        """
+        Folds the model weights into the prediction graph as constants and prunes everything that is not needed to
+        compute the predictions.
+
+        :return: A tuple of the frozen `GraphDef`, a dict mapping feature names to input tensor names and a dict
+            mapping `PredictMode` to output tensor names.
+        """
+        inputs = {name: placeholder.name for name, placeholder in self.placeholders.items()}
+        outputs = {mode: tensor.name for mode, tensor in self.predictions.items()}
+        output_ops = [name.split(":")[0] for name in outputs.values()]
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            self.session, self.graph.as_graph_def(), output_ops
+        )
+        unexportable = {node.op for node in graph_def.node} & {"PyFunc", "PyFuncStateless", "EagerPyFunc"}
+        if unexportable:
+            raise FinetuneError(
+                "The prediction graph calls back into python ({}) and cannot be exported.".format(
+                    ", ".join(sorted(unexportable))
+                )
+            )
+        graph_def = TransformGraph(
+            graph_def,
+            [name.split(":")[0] for name in inputs.values()],
+            output_ops,
+            ["strip_unused_nodes", "fold_constants(ignore_errors=true)", "sort_by_execution_order"]
+        )
+        return graph_def, inputs, outputs
+
+
+class FrozenPredictor(Predictor):
+    """
+    Runs a graph written by :meth:`Predictor.freeze`.  Has the same interface as :py:class:`Predictor`, but needs
+    neither the model code nor its variables.
+
+    :param graph_def: A frozen `GraphDef`.
+    :param inputs: A dict mapping feature names to input tensor names.
+    :param outputs: A dict mapping `PredictMode` to output tensor names.
+    :param session_config: A `tf.ConfigProto`.
+    """
+
+    def __init__(self, graph_def, inputs, outputs, session_config=None):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.placeholders = {name: self.graph.get_tensor_by_name(tensor) for name, tensor in inputs.items()}
+        self.predictions = {mode: self.graph.get_tensor_by_name(tensor) for mode, tensor in outputs.items()}
+        self.session = tf.Session(graph=self.graph, config=session_config)
+        self.graph.finalize()
+
+
+def shared_featurizer_layers(models):
+    """
+    Counts the lower featurizer layers whose weights, along with the embedding, are identical across all `models`.
+    These layers compute the same outputs for every model, so only need to be run once.
+    """
+    reference, others = models[0], models[1:]
+
+    def identical(name):
+        value = reference.saver.get_saved_value(name)
+        return all(np.array_equal(value, model.saver.get_saved_value(name)) for model in others)
+
+    if not identical("model/featurizer/we:0"):
+        return 0
+    for layer in range(reference.config.n_layer):
+        prefix = "model/featurizer/h%d_/" % layer
+        if not all(identical(name) for name in reference.saver.fallback if name.startswith(prefix)):
+            return layer
+    return reference.config.n_layer
+
+
+class MultiHeadPredictor(Predictor):
+    """
+    Runs the target models of several fitted models over one shared featurizer pass.
+
+    Lower featurizer layers that hold the same weights in every model, such as those left frozen by
+    `num_layers_trained`, are run once per batch.  Each model then runs its own remaining layers and target model on
+    top, so the outputs of all models come from a single session call.
+
+    :param models: A list of fitted :py:class:`finetune.base.BaseModel` instances that take the same inputs, for
+        example a `Classifier`, a `MultiLabelClassifier` and a `Regressor` trained with the same `max_length`.
+    """
+
+    def __init__(self, models):
+        if not models:
+            raise FinetuneError("MultiHeadPredictor needs at least one model.")
+        self.models = list(models)
+        reference = self.models[0]
+        types, shapes = reference.input_pipeline.feed_shape_type_def()
+        for model in self.models[1:]:
+            if model.input_pipeline.feed_shape_type_def()[1][0] != shapes[0]:
+                raise FinetuneError("{} and {} take different inputs and cannot share a featurizer.".format(
+                    type(reference).__name__, type(model).__name__
+                ))
+            for key in ("n_layer", "n_embed", "n_heads", "act_fn"):
+                if model.config[key] != reference.config[key]:
+                    raise FinetuneError("Models with different `{}` cannot share a featurizer.".format(key))
+        self.shared_layers = shared_featurizer_layers(self.models)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.set_random_seed(reference.config.seed)
+            self.placeholders = {
+                name: tf.placeholder(dtype, shape=[None] + shapes[0][name].as_list(), name=name)
+                for name, dtype in types[0].items()
+            }
+            features = dict(self.placeholders)
+            restore = []
+            custom_getter = None
+            if self.shared_layers:
+                shared_config = copy.deepcopy(reference.config)
+                shared_config.update(n_layer=self.shared_layers, num_layers_trained=0, train_embeddings=False)
+                features["frozen_hidden"] = featurizer(
+                    self.placeholders["tokens"], encoder=ENCODER, config=shared_config
+                )["frozen_hidden"]
+                restore.extend((var, reference.saver.get_saved_value(var.name)) for var in tf.global_variables())
+                shared_embedding = next(var for var in tf.global_variables() if var.name == "model/featurizer/we:0")
+
+                def custom_getter(getter, name, *args, **kwargs):
+                    # the embedding is identical in every model, so the heads use the shared one
+                    if name.endswith("/model/featurizer/we"):
+                        return shared_embedding
+                    return getter(name, *args, **kwargs)
+
+            self.predictions = []
+            for i, model in enumerate(self.models):
+                params = copy.deepcopy(model.config)
+                params.num_layers_trained = params.n_layer - self.shared_layers
+                scope = "head_%d" % i
+                with tf.variable_scope(scope, custom_getter=custom_getter):
+                    spec = model._get_model_fn(restore=False)(
+                        features=features, labels=None, mode=tf.estimator.ModeKeys.PREDICT, params=params
+                    )
+                self.predictions.append(spec.predictions)
+                restore.extend(
+                    (var, model.saver.get_saved_value(var.name[len(scope) + 1:]))
+                    for var in tf.global_variables(scope=scope + "/")
+                )
+
+            self.session = tf.Session(graph=self.graph, config=reference._session_config())
+            self.session.run(tf.variables_initializer([var for var, value in restore if value is None]))
+            for var, value in restore:
+                if value is not None:
+                    # fed to the initializer rather than stored in the graph, which would hold a copy of every weight
+                    var.load(value, self.session)
+        self.graph.finalize()
+
+    def run(self, batches, mode=None):
+        """
+        Runs every model on batches of encoded examples.
+
+        :param batches: As for :meth:`Predictor.run`, encoded by the pipeline of any of the models.
+        :param mode: As for :meth:`Predictor.run`.
+        :return: A generator of per-example predictions.  Each is a list with one entry per model, holding what
+            :meth:`Predictor.run` would yield for that model.
+        """
+        fetches = [_select(predictions, mode) for predictions in self.predictions]
+        for batch in batches:
+            outputs = self.session.run(
+                fetches,
+                feed_dict={self.placeholders[name]: value for name, value in batch.items()}
+            )
+            yield from map(list, zip(*map(_per_example, outputs)))
+
+    def _run_models(self, Xs, mode):
+        batches = self.models[0].input_pipeline.get_predict_batches(Xs)
+        outputs = list(self.run(batches, mode=mode))
+        return [np.asarray([example[i] for example in outputs]) for i in range(len(self.models))]
+
+    def predict(self, Xs):
+        """
+        Predicts with every model from a single featurizer pass.
+
+        :param Xs: As for the `predict` method of the models.
+        :return: A list with one entry per model, holding the predicted labels for Xs as decoded by the label encoder
+            of that model.  Thresholds for multi-label models are taken from their config.
+        """
+        return [
+            model.input_pipeline.label_encoder.inverse_transform(outputs)
+            for model, outputs in zip(self.models, self._run_models(Xs, PredictMode.NORMAL))
+        ]
+
+    def predict_proba(self, Xs):
+        """
+        :param Xs: As for the `predict_proba` method of the models.
+        :return: A list with one entry per model, holding what `predict_proba(Xs, as_array=True)` returns for that
+            model.  Regression models hold their predicted values.
+        """
+        return self._run_models(Xs, PredictMode.PROBAS)
+
+
+_WORKER_MODEL = None
+
+
+def _init_worker(model_path, core_groups, intra_op_threads, inter_op_threads):
+    global _WORKER_MODEL
+    from finetune.base import BaseModel
+
+    cores = core_groups.get() if core_groups is not None else None
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+    model = BaseModel.load(model_path, mmap_mode="r")
+    model.config.inference_processes = 1
+    model.config.verbose = False
+    model.config.intra_op_threads = intra_op_threads or (len(cores) if cores else 0)
+    model.config.inter_op_threads = inter_op_threads
+    _WORKER_MODEL = model
+
+
+def _run_shard(Xs, mode, encoded, batch_size=None):
+    return _WORKER_MODEL._local_inference(Xs, mode=mode, encoded=encoded, batch_size=batch_size)
+
+
+class ProcessPoolPredictor:
+    """
+    Shards inference across worker processes, each holding its own session.
+
+    The model is written to disk once and every worker loads it with `mmap_mode="r"`, so the saved weights are read
+    through the shared page cache rather than deserialized into each process.  When `pin_cores` is set and the
+    platform supports it, the cores available to this process are split into contiguous groups and each worker is
+    pinned to one group, with its intra-op thread pool sized to match.
+
+    :param model: A :py:class:`finetune.base.BaseModel` instance.
+    :param n_processes: Number of worker processes.
+    :param pin_cores: Pin each worker to its own group of cores.
+    """
+
+    def __init__(self, model, n_processes, pin_cores=True):
+        self.n_processes = n_processes
+        self.tmp_dir = tempfile.mkdtemp(prefix="FinetuneInference")
+        model_path = os.path.join(self.tmp_dir, "model.jl")
+        # unfitted models have no weights of their own and are restored from the base model
+        joblib.dump((model.saver.variables or {}, model), model_path)
+
+        ctx = multiprocessing.get_context("spawn")
+        core_groups = None
+        if pin_cores and hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+            if len(cores) >= n_processes:
+                core_groups = ctx.Queue()
+                for group in np.array_split(cores, n_processes):
+                    core_groups.put([int(core) for core in group])
+
+        self.pool = ctx.Pool(
+            n_processes,
+            initializer=_init_worker,
+            initargs=(
+                model_path, core_groups, model.config.get("intra_op_threads", 0), model.config.get("inter_op_threads", 0)
+            )
+        )
+
+    def run(self, Xs, mode=None, encoded=False, batch_size=None):
+        """
+        Splits Xs into one contiguous shard per worker and returns the per-example predictions in input order.
+
+        :param batch_size: Number of examples per session call in each worker.  Defaults to the config.
+        """
+        n_shards = min(self.n_processes, len(Xs))
+        bounds = np.linspace(0, len(Xs), n_shards + 1).astype(int)
+        results = [
+            self.pool.apply_async(_run_shard, (list(Xs[start:end]), mode, encoded, batch_size))
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        return list(itertools.chain.from_iterable(result.get() for result in results))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
@@ -1,5 +1,7 @@
+import hashlib
 import itertools
 import logging
+import os
 import sys
 import math
 
@@ -16,11 +18,61 @@ from finetune.errors import FinetuneError
 from finetune.config import PAD_TOKEN
 from finetune.encoding import TextEncoder, ArrayEncodedOutput, EncodedOutput
 from finetune.imbalance import compute_class_weights
+from finetune.utils import pad_stack
 
 ENCODER = TextEncoder()
 LOGGER = logging.getLogger('finetune')
 
 
+class FrozenActivationCache:
+    """
+    Hidden states of the frozen lower layers of the featurizer, keyed by the token ids of each example.  Rows are
+    appended to a file on disk while the cache is filled, then read back through a read-only memory map.
+
+    :param path: File to store the hidden states in.  Removed by :meth:`close`.
+    :param shape: Shape of the hidden states of a single example.
+    """
+
+    def __init__(self, path, shape, dtype=np.float32):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.rows = dict()
+        self.hidden = None
+        self._file = open(path, "wb")
+
+    @staticmethod
+    def key(tokens):
+        return hashlib.sha1(np.ascontiguousarray(tokens).tobytes()).digest()
+
+    def __contains__(self, tokens):
+        return self.key(tokens) in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, tokens, hidden):
+        key = self.key(tokens)
+        if key in self.rows:
+            return
+        self.rows[key] = len(self.rows)
+        self._file.write(np.ascontiguousarray(hidden, dtype=self.dtype).tobytes())
+
+    def finalize(self):
+        self._file.close()
+        if self.rows:
+            self.hidden = np.memmap(self.path, dtype=self.dtype, mode="r", shape=(len(self.rows),) + self.shape)
+
+    def __getitem__(self, tokens):
+        return self.hidden[self.rows[self.key(tokens)]]
+
+    def close(self):
+        self._file.close()
+        self.hidden = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
 class BasePipeline(metaclass=ABCMeta):
     def __init__(self, config):
         self.config = config
@@ -29,6 +81,7 @@ class BasePipeline(metaclass=ABCMeta):
         self.pad_idx_ = None
         self.rebuild = False
         self.epoch = 0
+        self.frozen_cache = None
 
     @abstractmethod
     def _target_encoder(self):
@@ -40,6 +93,27 @@ class BasePipeline(metaclass=ABCMeta):
         return ({"tokens": tf.int32, "mask": tf.float32}, tf.float32), (
             {"tokens": TS([self.config.max_length, 2]), "mask": TS([self.config.max_length])}, TS([self.target_dim]))
 
+    def _dataset_shape_type_def(self):
+        """
+        `feed_shape_type_def`, plus the cached frozen activations while a :py:class:`FrozenActivationCache` is set.
+        """
+        (types, target_type), (shapes, target_shape) = self.feed_shape_type_def()
+        if self.frozen_cache is not None:
+            types = dict(types, frozen_hidden=tf.float32)
+            shapes = dict(shapes, frozen_hidden=tf.TensorShape(self.frozen_cache.shape))
+        return (types, target_type), (shapes, target_shape)
+
+    def _add_frozen_hidden(self, encoded):
+        if self.frozen_cache is None:
+            return encoded
+
+        def add(example):
+            feats = example[0] if isinstance(example, tuple) else example
+            feats["frozen_hidden"] = self.frozen_cache[feats["tokens"]]
+            return example
+
+        return map(add, encoded)
+
     def _array_format(self, encoded_output, pad_token=PAD_TOKEN):
         """
         Returns numpy array of token idxs and corresponding mask
@@ -107,9 +181,9 @@ class BasePipeline(metaclass=ABCMeta):
         else:
             raise ValueError("Either neither or both of Xs and Y should be callable, not a mixture")
 
-        dataset_encoded = lambda: itertools.chain.from_iterable(
-            map(lambda xy: self.text_to_tokens_mask(*xy), dataset()))
-        shape_def = self.feed_shape_type_def()
+        dataset_encoded = lambda: self._add_frozen_hidden(itertools.chain.from_iterable(
+            map(lambda xy: self.text_to_tokens_mask(*xy), dataset())))
+        shape_def = self._dataset_shape_type_def()
         if not callable(Y) and self.config.chunk_long_sequences:
             dataset_encoded_list = list(dataset_encoded())  # come up with a more principled way to do this .
             self.config.dataset_size = len(dataset_encoded_list)
@@ -121,8 +195,10 @@ class BasePipeline(metaclass=ABCMeta):
         else:
             Xs_fn = lambda: self.wrap_tqdm(Xs(), train)
 
-        dataset_encoded = lambda: itertools.chain.from_iterable(map(self.text_to_tokens_mask, Xs_fn()))
-        types, shapes = self.feed_shape_type_def()
+        dataset_encoded = lambda: self._add_frozen_hidden(
+            itertools.chain.from_iterable(map(self.text_to_tokens_mask, Xs_fn()))
+        )
+        types, shapes = self._dataset_shape_type_def()
         return Dataset.from_generator(dataset_encoded, types[0], shapes[0])  # 0s cut out the targets
 
     def _integer_val_size(self, val_size):
@@ -151,7 +227,8 @@ class BasePipeline(metaclass=ABCMeta):
         if self.config.val_interval is None:
             # sys.maxsize corresponds to never running validation
             # and is used when val_size is set to 0
-            val_interval = 4 * int(math.ceil(val_size / batch_size)) or sys.maxsize
+            accumulation_steps = self.config.get("gradient_accumulation_steps", 1)
+            val_interval = 4 * int(math.ceil(val_size / (batch_size * accumulation_steps))) or sys.maxsize
         else:
             val_interval = self.config.val_interval
 
@@ -248,8 +325,8 @@ class BasePipeline(metaclass=ABCMeta):
         if self.config.chunk_long_sequences:
             train_dataset_unbatched()
 
-        val_dataset = lambda: val_dataset_unbatched().batch(batch_size, drop_remainder=False).cache().prefetch(prefetch_buffer)
-        train_dataset = lambda: train_dataset_unbatched().batch(batch_size, drop_remainder=False).repeat(
+        val_dataset = lambda: self._batch(val_dataset_unbatched(), batch_size).cache().prefetch(prefetch_buffer)
+        train_dataset = lambda: self._batch(train_dataset_unbatched(), batch_size).repeat(
             self.config.n_epochs).prefetch(prefetch_buffer)
 
         return val_dataset, train_dataset, self.config.val_size, self.config.val_interval
@@ -258,7 +335,41 @@ class BasePipeline(metaclass=ABCMeta):
         batch_size = batch_size or self.config.batch_size
         prefetch_buffer = 2  # breaks the pipeline to allow concurrency
         tf_dataset = lambda: self._dataset_without_targets(Xs, train=None)
-        return lambda: tf_dataset().batch(batch_size).prefetch(prefetch_buffer)
+        return lambda: self._batch(tf_dataset(), batch_size).prefetch(prefetch_buffer)
+
+    def _batch(self, dataset, batch_size):
+        """
+        Combines consecutive examples of a dataset into batches.  Overridden by pipelines whose examples vary in shape.
+        """
+        return dataset.batch(batch_size, drop_remainder=False)
+
+    def get_predict_batches(self, Xs, batch_size=None, encoded=False):
+        """
+        Encodes Xs on the host and yields feature dictionaries of stacked arrays, ready to be fed to a
+        :py:class:`finetune.inference.Predictor`.
+
+        :param encoded: If True, Xs is a list of `ArrayEncodedOutput` as returned by `_text_to_ids`, and is batched
+            without being encoded again.
+        """
+        if encoded:
+            encoded = ({"tokens": out.token_ids, "mask": out.mask} for out in Xs)
+        else:
+            Xs = Xs() if callable(Xs) else Xs
+            encoded = itertools.chain.from_iterable(map(self.text_to_tokens_mask, Xs))
+        return self.batch_features(encoded, batch_size=batch_size)
+
+    def batch_features(self, features, batch_size=None):
+        """
+        Stacks an iterable of feature dictionaries into batches.  Features whose shape varies between examples are
+        zero padded to the largest in the batch.
+        """
+        batch_size = batch_size or self.config.get("predict_batch_size") or self.config.batch_size
+        features = iter(features)
+        while True:
+            batch = list(itertools.islice(features, batch_size))
+            if not batch:
+                return
+            yield {name: pad_stack([feats[name] for feats in batch]) for name in batch[0]}
 
     @property
     def pad_idx(self):
@@ -278,12 +389,31 @@ class BasePipeline(metaclass=ABCMeta):
         """
         return [[X]]
 
+    def chunk_params(self):
+        """
+        Window layout used when `chunk_long_sequences` is set.  Windows of `chunk_size` subtokens start every `stride`
+        subtokens, and predictions for a window are kept for the `stride` subtokens that follow its first `context`
+        subtokens (the first and last windows of a document also keep their leading and trailing subtokens).
+
+        :return: A tuple of (chunk_size, stride, context).
+        """
+        chunk_size = self.config.max_length - 2
+        stride = self.config.get("chunk_stride") or chunk_size // 3
+        context = self.config.get("chunk_context")
+        if context is None:
+            context = min(stride, (chunk_size - stride) // 2)
+        if not 0 < stride <= chunk_size or context < 0 or context + stride > chunk_size:
+            raise ValueError(
+                "chunk_stride ({}) and chunk_context ({}) must be positive and sum to at most max_length - 2 "
+                "({}).".format(stride, context, chunk_size)
+            )
+        return chunk_size, stride, context
+
     def _text_to_ids(self, Xs, Y=None, pad_token=PAD_TOKEN):
         Xs = self._format_for_encoding(Xs)
         if self.config.chunk_long_sequences and len(Xs) == 1:
             # can only chunk single sequence inputs
-            chunk_size = self.config.max_length - 2
-            step_size = chunk_size // 3
+            chunk_size, stride, _ = self.chunk_params()
             encoded = ENCODER.encode_multi_input(
                 Xs,
                 Y=Y,
@@ -291,7 +421,9 @@ class BasePipeline(metaclass=ABCMeta):
                 pad_token=pad_token
             )
             length = len(encoded.token_ids)
-            starts = list(range(0, length, step_size))
+            starts = [0]
+            while starts[-1] + chunk_size < length:
+                starts.append(starts[-1] + stride)
             for start in starts:
                 d = dict()
                 end = start + chunk_size
@@ -1,9 +1,11 @@
+import bisect
+import itertools
 from collections import defaultdict
 
 from sklearn.metrics import accuracy_score, recall_score, precision_score
 import numpy as np
 
-from finetune.encoding import NLP
+from finetune.encoding import tokenize
 
 
 def _convert_to_token_list(annotations, doc_idx=None):
@@ -11,15 +13,18 @@ def _convert_to_token_list(annotations, doc_idx=None):
 
     for annotation in annotations:
         start_idx = annotation.get('start')
+        annotation_tokens = tokenize(annotation.get('text'))
         tokens.extend([
             {
-                'start': start_idx + token.idx,
-                'end': start_idx + token.idx + len(token.text),
-                'text': token.text,
+                'start': start_idx + token_start,
+                'end': start_idx + token_end,
+                'text': token_text,
                 'label': annotation.get('label'),
                 'doc_idx': doc_idx
             }
-            for token in NLP(annotation.get('text'))
+            for token_text, token_start, token_end in zip(
+                annotation_tokens.texts, annotation_tokens.starts, annotation_tokens.ends
+            )
         ])
 
     return tokens
@@ -45,36 +50,32 @@ def sequence_labeling_token_counts(true, predicted):
         true_tokens = _convert_to_token_list(true_list, doc_idx=i)
         pred_tokens = _convert_to_token_list(pred_list, doc_idx=i)
 
+        # the first predicted token at each span, and the spans of true tokens
+        pred_by_span = {}
+        for pred_token in pred_tokens:
+            pred_by_span.setdefault((pred_token['start'], pred_token['end']), pred_token)
+        true_spans = set((true_token['start'], true_token['end']) for true_token in true_tokens)
+
         # correct + false negatives
         for true_token in true_tokens:
-            for pred_token in pred_tokens:
-                if (pred_token['start'] == true_token['start'] and 
-                    pred_token['end'] == true_token['end']):
-
-                    if pred_token['label'] == true_token['label']:
-                        d[true_token['label']]['correct'].append(true_token)
-                    else:
-                        d[true_token['label']]['false_negatives'].append(true_token)
-                        d[pred_token['label']]['false_positives'].append(pred_token)
-                    
-                    break
+            pred_token = pred_by_span.get((true_token['start'], true_token['end']))
+            if pred_token is None:
+                d[true_token['label']]['false_negatives'].append(true_token)
+            elif pred_token['label'] == true_token['label']:
+                d[true_token['label']]['correct'].append(true_token)
             else:
                 d[true_token['label']]['false_negatives'].append(true_token)
+                d[pred_token['label']]['false_positives'].append(pred_token)
 
         # false positives
         for pred_token in pred_tokens:
-            for true_token in true_tokens:
-                if (pred_token['start'] == true_token['start'] and 
-                    pred_token['end'] == true_token['end']):
-                    break
-            else:
+            if (pred_token['start'], pred_token['end']) not in true_spans:
                 d[pred_token['label']]['false_positives'].append(pred_token)
     
     return d
 
 
-def seq_recall(true, predicted, count_fn):
-    class_counts = count_fn(true, predicted)
+def _recall_from_counts(class_counts):
     results = {}
     for cls_, counts in class_counts.items():
         FN = len(counts['false_negatives'])
@@ -86,8 +87,7 @@ def seq_recall(true, predicted, count_fn):
     return results
 
 
-def seq_precision(true, predicted, count_fn):
-    class_counts = count_fn(true, predicted)
+def _precision_from_counts(class_counts):
     results = {}
     for cls_, counts in class_counts.items():
         FP = len(counts['false_positives'])
@@ -98,6 +98,14 @@ def seq_precision(true, predicted, count_fn):
             results[cls_] = 0.
     return results
 
+
+def seq_recall(true, predicted, count_fn):
+    return _recall_from_counts(count_fn(true, predicted))
+
+
+def seq_precision(true, predicted, count_fn):
+    return _precision_from_counts(count_fn(true, predicted))
+
 def micro_f1(true, predicted, count_fn):
     class_counts = count_fn(true, predicted)
     TP, FP, FN = 0, 0, 0
@@ -138,6 +146,50 @@ def sequences_overlap(true_seq, pred_seq):
     return start_contained or end_contained
 
 
+class _OverlapIndex(object):
+    """
+    Predicted annotations sorted by start and by end, to find the first one (in list order) that
+    `sequences_overlap` a true annotation without comparing against every prediction.
+    """
+
+    def __init__(self, annotations):
+        self.by_start = sorted(range(len(annotations)), key=lambda i: annotations[i]['start'])
+        self.starts = [annotations[i]['start'] for i in self.by_start]
+        self.by_end = sorted(range(len(annotations)), key=lambda i: annotations[i]['end'])
+        self.ends = [annotations[i]['end'] for i in self.by_end]
+
+    def first_overlap(self, true_seq):
+        # predictions starting within [start, end) or ending within (start, end]
+        start_contained = self.by_start[
+            bisect.bisect_left(self.starts, true_seq['start']):bisect.bisect_left(self.starts, true_seq['end'])
+        ]
+        end_contained = self.by_end[
+            bisect.bisect_right(self.ends, true_seq['start']):bisect.bisect_right(self.ends, true_seq['end'])
+        ]
+        return min(start_contained + end_contained, default=None)
+
+
+class _CoverageIndex(object):
+    """
+    True annotations sorted by start along with the running maximum of their ends, to check whether any of them
+    `sequences_overlap` a predicted annotation.
+    """
+
+    def __init__(self, annotations):
+        annotations = sorted(annotations, key=lambda annotation: annotation['start'])
+        self.starts = [annotation['start'] for annotation in annotations]
+        self.max_ends = list(itertools.accumulate((annotation['end'] for annotation in annotations), max))
+
+    def overlaps(self, pred_seq):
+        # a true annotation contains the predicted start: start <= pred start < end
+        n_before_start = bisect.bisect_right(self.starts, pred_seq['start'])
+        if n_before_start and self.max_ends[n_before_start - 1] > pred_seq['start']:
+            return True
+        # a true annotation contains the predicted end: start < pred end <= end
+        n_before_end = bisect.bisect_left(self.starts, pred_seq['end'])
+        return bool(n_before_end) and self.max_ends[n_before_end - 1] >= pred_seq['end']
+
+
 def sequence_labeling_overlaps(true, predicted):
     """
     Return FP, FN, and TP counts
@@ -159,24 +211,26 @@ def sequence_labeling_overlaps(true, predicted):
             for annotation in annotations:
                 annotation['doc_idx'] = i
         
+        pred_index = _OverlapIndex(predicted_annotations)
         for true_annotation in true_annotations:
-            for pred_annotation in predicted_annotations:
-                if sequences_overlap(true_annotation, pred_annotation):
-                    if pred_annotation['label'] == true_annotation['label']:
-                        d[true_annotation['label']]['correct'].append(true_annotation)
-                    else:
-                        d[true_annotation['label']]['false_negatives'].append(true_annotation)
-                        d[pred_annotation['label']]['false_positives'].append(pred_annotation)
-                    break
+            pred_idx = pred_index.first_overlap(true_annotation)
+            if pred_idx is None:
+                d[true_annotation['label']]['false_negatives'].append(true_annotation)
+                continue
+            pred_annotation = predicted_annotations[pred_idx]
+            if pred_annotation['label'] == true_annotation['label']:
+                d[true_annotation['label']]['correct'].append(true_annotation)
             else:
                 d[true_annotation['label']]['false_negatives'].append(true_annotation)
+                d[pred_annotation['label']]['false_positives'].append(pred_annotation)
 
+        true_by_label = defaultdict(list)
+        for true_annotation in true_annotations:
+            true_by_label[true_annotation['label']].append(true_annotation)
+        true_indexes = {label: _CoverageIndex(annotations) for label, annotations in true_by_label.items()}
         for pred_annotation in predicted_annotations:
-            for true_annotation in true_annotations:
-                if (sequences_overlap(true_annotation, pred_annotation) and
-                        true_annotation['label'] == pred_annotation['label']):
-                    break
-            else:
+            true_index = true_indexes.get(pred_annotation['label'])
+            if true_index is None or not true_index.overlaps(pred_annotation):
                 d[pred_annotation['label']]['false_positives'].append(pred_annotation)
 
     return d
@@ -196,12 +250,53 @@ def sequence_labeling_overlap_recall(true, predicted):
     return seq_recall(true, predicted, count_fn=sequence_labeling_overlaps)
 
 
+def multi_label_threshold_curve(y_true, probas, thresholds):
+    """
+    Per-class and micro-averaged precision / recall of a multi-label classifier at each threshold.
+    A class is predicted when its probability is strictly greater than the threshold.
+
+    :param y_true: Binary indicator array of true labels, shape [n_examples, n_classes].
+    :param probas: Predicted probabilities, shape [n_examples, n_classes].
+    :param thresholds: 1D list or array of thresholds, shape [n_thresholds].
+    :return: dict containing:
+        thresholds: The thresholds evaluated.
+        precision, recall: Per-class arrays of shape [n_thresholds, n_classes].
+        micro_precision, micro_recall: Arrays of shape [n_thresholds].
+    """
+    y_true = np.asarray(y_true).astype(bool)
+    probas = np.asarray(probas)
+    thresholds = np.asarray(thresholds, dtype=probas.dtype)
+    n_classes = y_true.shape[1]
+
+    true_positives = np.zeros([len(thresholds), n_classes], dtype=np.int64)
+    false_positives = np.zeros([len(thresholds), n_classes], dtype=np.int64)
+    n_positives = y_true.sum(axis=0)
+    for cls_idx in range(n_classes):
+        positive_probas = np.sort(probas[y_true[:, cls_idx], cls_idx])
+        negative_probas = np.sort(probas[~y_true[:, cls_idx], cls_idx])
+        true_positives[:, cls_idx] = len(positive_probas) - np.searchsorted(positive_probas, thresholds, side='right')
+        false_positives[:, cls_idx] = len(negative_probas) - np.searchsorted(negative_probas, thresholds, side='right')
+
+    def safe_divide(a, b):
+        return np.divide(a, b, out=np.zeros(np.shape(a), dtype=np.float64), where=np.asarray(b) > 0)
+
+    return {
+        'thresholds': thresholds,
+        'precision': safe_divide(true_positives, true_positives + false_positives),
+        'recall': safe_divide(true_positives, np.broadcast_to(n_positives, true_positives.shape)),
+        'micro_precision': safe_divide(true_positives.sum(1), (true_positives + false_positives).sum(1)),
+        'micro_recall': safe_divide(true_positives.sum(1), np.full(len(thresholds), n_positives.sum())),
+    }
+
+
 def annotation_report(y_true, y_pred, labels=None, target_names=None, sample_weight=None, digits=2, width=20):
     # Adaptation of https://github.com/scikit-learn/scikit-learn/blob/f0ab589f/sklearn/metrics/classification.py#L1363
-    token_precision = sequence_labeling_token_precision(y_true, y_pred)
-    token_recall = sequence_labeling_token_recall(y_true, y_pred)
-    overlap_precision = sequence_labeling_overlap_precision(y_true, y_pred)
-    overlap_recall = sequence_labeling_overlap_recall(y_true, y_pred)
+    token_counts = sequence_labeling_token_counts(y_true, y_pred)
+    overlap_counts = sequence_labeling_overlaps(y_true, y_pred)
+    token_precision = _precision_from_counts(token_counts)
+    token_recall = _recall_from_counts(token_counts)
+    overlap_precision = _precision_from_counts(overlap_counts)
+    overlap_recall = _recall_from_counts(overlap_counts)
 
     count_dict = defaultdict(int)
     for annotation_seq in y_true:
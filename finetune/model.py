@@ -3,46 +3,258 @@ import logging
 import numpy as np
 import tensorflow as tf
 from tensorflow.train import Scaffold
-from tensorflow.contrib.opt.python.training.weight_decay_optimizers import AdamWOptimizer
+from tensorflow.contrib.opt.python.training.weight_decay_optimizers import AdamWOptimizer, \
+    extend_with_decoupled_weight_decay
+from tensorflow.contrib.opt.python.training.lazy_adam_optimizer import LazyAdamOptimizer
 
-from finetune.network_modules import featurizer, language_model
-from finetune.utils import sample_with_temperature
+from finetune.network_modules import featurizer, language_model, language_model_step, language_model_log_likelihood
+from finetune.utils import sample_with_temperature, shape_list
 from finetune.optimizers import schedules
 from finetune.imbalance import class_weight_tensor
 
 LOGGER = logging.getLogger('finetune')
 
+# only updates the moments and weights of the embedding rows a batch gathers
+LazyAdamWOptimizer = extend_with_decoupled_weight_decay(LazyAdamOptimizer)
+
 class PredictMode:
     FEATURIZE = "FEAT"
     NORMAL = "NORM"
     PROBAS = "PROBA"
     GENERATE_TEXT = "GEN_TEXT"
+    FROZEN_HIDDEN = "FROZEN"
+    LM_SCORE = "LM_SCORE"
+
+    @staticmethod
+    def for_task(mode, task):
+        """
+        Key of the predictions of one task of a :py:class:`finetune.multi_task.MultiTask` model.
+        """
+        return "{}/{}".format(mode, task)
+
+
+class PredictFeed:
+    """
+    Names of the placeholders of the prediction graph that can be fed to :meth:`finetune.inference.Predictor.run` to
+    override a config value for a single call.
+    """
+    LM_TEMPERATURE = "lm_temperature"
+    DECODE_LENGTH = "decode_length"
+    USE_EXTRA_TOKS = "use_extra_toks"
+
+
+def cached_decode(X, M, step_fn, empty_past, logit_mask, temperature, decode_length, eos_token, position_offset):
+    """
+    The decoding loop of text generation.  Runs the shortest prompt in one step, then feeds one token per step:
+    the next prompt token of sequences whose prompt is longer, otherwise a sample from the logits of the previous
+    step.  A sequence is done once it samples `eos_token` and is then padded with `eos_token`.  Stops when every
+    sequence is done or after `decode_length` tokens.
+
+    :param X: Prompt tokens and positions, [batch, max_length, 2].
+    :param M: Prompt mask, excluding the first token, [batch, max_length].
+    :param step_fn: Maps (tokens, past) to a dict containing the "logits" of the last of `tokens` and the "present"
+        keys and values of `tokens`, which are concatenated to past along axis -2.
+    :param empty_past: The past of the first step, with an empty axis -2.
+    :param position_offset: Token id of the first position embedding.
+    :return: The prompt and generated tokens, [batch, n_tokens].
+    """
+    batch_size = shape_list(X)[0]
+    lengths = tf.cast(tf.reduce_sum(M, 1), tf.int32) + 1
+    prompt_length = tf.reduce_min(lengths)
+    prompt_state = step_fn(X[:, :prompt_length], empty_past)
+
+    def body(i, past, logits, tokens, done):
+        sampled = tf.cast(sample_with_temperature(logits + logit_mask, temperature), tf.int32)
+        in_prompt = i < lengths
+        next_token = tf.where(in_prompt, X[:, i, 0], sampled)
+        # finished sequences are padded with further end tokens
+        next_token = tf.where(done, tf.fill([batch_size], eos_token), next_token)
+        tokens = tf.concat([tokens, tf.expand_dims(next_token, 1)], axis=1)
+        done = tf.logical_or(done, tf.logical_and(tf.logical_not(in_prompt), tf.equal(next_token, eos_token)))
+        position = tf.fill([batch_size], position_offset + i)
+        step_state = step_fn(tf.reshape(tf.stack([next_token, position], axis=-1), [batch_size, 1, 2]), past)
+        return i + 1, tf.concat([past, step_state["present"]], axis=-2), step_state["logits"], tokens, done
+
+    past_shape = empty_past.get_shape().as_list()
+    past_shape[0], past_shape[-2] = None, None
+    _, _, _, tokens, _ = tf.while_loop(
+        cond=lambda i, past, logits, tokens, done: tf.logical_and(i < decode_length,
+                                                                  tf.logical_not(tf.reduce_all(done))),
+        body=body,
+        loop_vars=(
+            prompt_length,
+            prompt_state["present"],
+            prompt_state["logits"],
+            X[:, :prompt_length, 0],
+            tf.zeros([batch_size], dtype=tf.bool)
+        ),
+        shape_invariants=(
+            tf.TensorShape([]),
+            tf.TensorShape(past_shape),
+            tf.TensorShape([None, None]),
+            tf.TensorShape([None, None]),
+            tf.TensorShape([None])
+        ),
+        back_prop=False
+    )
+    return tokens
 
 
 def get_model_fn(target_model_fn, predict_op, predict_proba_op, build_target_model, build_lm, encoder, target_dim,
-                 label_encoder, saver):
-    def language_model_op(X, M, params, featurizer_state):
+                 label_encoder, saver, predict_frozen_hidden=False):
+    def language_model_op(X, M, params, featurizer_state, train=False):
         language_model_state = language_model(
             X=X,
             M=M,
             config=params,
             embed_weights=featurizer_state['embed_weights'],
             hidden=featurizer_state['sequence_features'],
+            train=train
         )
 
-        lm_logits = language_model_state["logits"]
+        lm_logits = language_model_state["logits"] + lm_logit_mask(params)
+        lm_predict_op = sample_with_temperature(lm_logits, params.lm_temp)
+        return lm_predict_op, language_model_state
 
-        lm_logit_mask = np.zeros([1, lm_logits.get_shape().as_list()[-1]], dtype=np.float32)
-        lm_logit_mask[:, encoder.vocab_size:] = -np.inf
+    def lm_logit_mask(params, use_extra_toks=None):
+        mask = np.zeros([1, encoder.vocab_size + params.max_length], dtype=np.float32)
+        mask[:, encoder.vocab_size:] = -np.inf
 
-        if "use_extra_toks" in params and not params.use_extra_toks:
-            lm_logit_mask[:, encoder.start] = -np.inf
-            lm_logit_mask[:, encoder.delimiter] = -np.inf
-            lm_logit_mask[:, encoder.clf_token] = -np.inf
+        if use_extra_toks is None:
+            use_extra_toks = params.get("use_extra_toks", True)
+        if not use_extra_toks:
+            mask[:, encoder.start] = -np.inf
+            mask[:, encoder.delimiter] = -np.inf
+            mask[:, encoder.clf_token] = -np.inf
+        return mask
 
-        lm_logits += lm_logit_mask
-        lm_predict_op = sample_with_temperature(lm_logits, params.lm_temp)
-        return lm_predict_op, language_model_state
+    def generate_text_op(X, M, params):
+        """
+        Continues each sequence in X one token at a time until it produces `encoder.clf_token`, or until
+        `decode_length` tokens (`max_length - 2` by default).  Sequences may have prompts of different lengths: the
+        shortest prompt is run in one step and the remaining prompt tokens are fed in place of samples.  The keys
+        and values of every position are cached, so each step only runs the featurizer and the language model on
+        the newest token.
+
+        The sampling temperature, `decode_length` and `use_extra_toks` default to the values in params and can be fed
+        through the placeholders named in :py:class:`PredictFeed`, so one graph serves calls with different values.
+        """
+        head_dim = params.n_embed // params.n_heads
+        temperature = tf.placeholder_with_default(float(params.lm_temp), [], name=PredictFeed.LM_TEMPERATURE)
+        decode_length = tf.minimum(
+            tf.placeholder_with_default(
+                params.get("decode_length") or params.max_length - 2, [], name=PredictFeed.DECODE_LENGTH
+            ),
+            params.max_length
+        )
+        use_extra_toks = tf.placeholder_with_default(
+            bool(params.get("use_extra_toks", True)), [], name=PredictFeed.USE_EXTRA_TOKS
+        )
+        logit_mask = tf.cond(
+            use_extra_toks,
+            lambda: tf.constant(lm_logit_mask(params, use_extra_toks=True)),
+            lambda: tf.constant(lm_logit_mask(params, use_extra_toks=False))
+        )
+        step_fn = lambda tokens, past: language_model_step(tokens, past=past, encoder=encoder, config=params)
+        return cached_decode(
+            X, M,
+            step_fn=step_fn,
+            empty_past=tf.zeros([shape_list(X)[0], params.n_layer, 2, params.n_heads, 0, head_dim]),
+            logit_mask=logit_mask,
+            temperature=temperature,
+            decode_length=decode_length,
+            eos_token=encoder.clf_token,
+            position_offset=encoder.vocab_size
+        )
+
+    def accumulate_gradients_op(loss, optimizer, lr_decay, params, accumulation_steps):
+        """
+        Adds the gradients of each batch to an accumulator and applies their mean every `accumulation_steps` batches,
+        so an update sees `batch_size * accumulation_steps` examples while only one batch is held in memory.  The
+        global step is incremented by the update, the accumulators are local variables and are not saved.
+
+        Sparse gradients, such as those of the embedding matrix, are added to the rows they touch and applied as
+        `tf.IndexedSlices` over the rows touched since the last update, so lazy updates stay sparse.
+        """
+        global_step = tf.train.get_or_create_global_step()
+        lr = lr_decay(params.lr, global_step)
+        tf.summary.scalar("learning_rate", lr)
+        tf.summary.scalar("loss", loss)
+
+        variables = tf.trainable_variables()
+        grads_and_vars = [(g, var) for g, var in zip(tf.gradients(loss, variables), variables) if g is not None]
+
+        def local_variable(name, shape, dtype):
+            return tf.get_variable(
+                name, shape=shape, dtype=dtype, initializer=tf.zeros_initializer(), trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES]
+            )
+
+        accumulators, accumulate_ops = [], []
+        with tf.variable_scope("gradient_accumulation"):
+            micro_step = local_variable("micro_step", [], tf.int64)
+            for gradient, var in grads_and_vars:
+                accumulator = local_variable(var.op.name, shape_list(var), var.dtype.base_dtype)
+                if isinstance(gradient, tf.IndexedSlices):
+                    touched = local_variable(var.op.name + "_touched", shape_list(var)[:1], tf.bool)
+                    accumulate_ops.append(tf.scatter_add(accumulator, gradient.indices, gradient.values))
+                    accumulate_ops.append(
+                        tf.scatter_update(touched, gradient.indices, tf.fill(tf.shape(gradient.indices), True))
+                    )
+                else:
+                    touched = None
+                    accumulate_ops.append(tf.assign_add(accumulator, gradient))
+                accumulators.append((accumulator, touched, var))
+
+        def mean_gradient(accumulator, touched, n_accumulated):
+            if touched is None:
+                return accumulator / n_accumulated
+            rows = tf.reshape(tf.to_int32(tf.where(touched)), [-1])
+            return tf.IndexedSlices(
+                tf.gather(accumulator, rows) / n_accumulated, rows, dense_shape=tf.shape(accumulator)
+            )
+
+        def apply_update():
+            mean_gradients = [
+                mean_gradient(accumulator, touched, accumulation_steps) for accumulator, touched, _ in accumulators
+            ]
+            clipped, _ = tf.clip_by_global_norm(mean_gradients, float(params.max_grad_norm))
+            update_op = optimizer(lr).apply_gradients(
+                zip(clipped, [var for _, _, var in accumulators]), global_step=global_step
+            )
+            reset_ops = []
+            with tf.control_dependencies([update_op]):
+                for (accumulator, touched, _), gradient in zip(accumulators, mean_gradients):
+                    if touched is None:
+                        reset_ops.append(tf.assign(accumulator, tf.zeros_like(accumulator)))
+                    else:
+                        reset_ops.append(
+                            tf.scatter_update(accumulator, gradient.indices, tf.zeros_like(gradient.values))
+                        )
+                        reset_ops.append(
+                            tf.scatter_update(touched, gradient.indices, tf.fill(tf.shape(gradient.indices), False))
+                        )
+            return tf.group(*reset_ops)
+
+        with tf.control_dependencies(accumulate_ops):
+            step = tf.assign_add(micro_step, 1)
+        apply = tf.equal(step % accumulation_steps, 0)
+
+        summary_reads = []
+        if params.summarize_grads:
+            # the mean of the gradients accumulated towards the next update, which is the applied mean before
+            # clipping on the batch that applies it.  Read before the accumulators are reset.
+            with tf.control_dependencies([step]):
+                n_accumulated = tf.to_float((step - 1) % accumulation_steps + 1)
+                for accumulator, touched, var in accumulators:
+                    gradient = mean_gradient(accumulator, touched, n_accumulated)
+                    if isinstance(gradient, tf.IndexedSlices):
+                        gradient = gradient.values
+                    tf.summary.histogram("gradients/{}".format(var.op.name), gradient)
+                    summary_reads.append(gradient)
+
+        with tf.control_dependencies(summary_reads):
+            return tf.cond(apply, apply_update, tf.no_op)
 
     def target_model_op(featurizer_state, Y, params, mode):
         weighted_tensor = None
@@ -82,8 +294,12 @@ def get_model_fn(target_model_fn, predict_op, predict_proba_op, build_target_mod
 
         with tf.variable_scope(tf.get_variable_scope()):
             train_loss = 0.0
-            featurizer_state = featurizer(X, config=params, encoder=encoder, train=train)
+            featurizer_state = featurizer(
+                X, config=params, encoder=encoder, train=train, frozen_hidden=features.get("frozen_hidden")
+            )
             predictions = {PredictMode.FEATURIZE: featurizer_state["features"]}
+            if predict_frozen_hidden and "frozen_hidden" in featurizer_state:
+                predictions[PredictMode.FROZEN_HIDDEN] = featurizer_state["frozen_hidden"]
 
             if build_target_model:
                 target_model_state = target_model_op(featurizer_state=featurizer_state, Y=Y, params=params, mode=mode)
@@ -94,32 +310,50 @@ def get_model_fn(target_model_fn, predict_op, predict_proba_op, build_target_mod
                 if mode == tf.estimator.ModeKeys.PREDICT or tf.estimator.ModeKeys.EVAL:
                     logits = target_model_state["logits"]
                     predict_params = target_model_state.get("predict_params", {})
-                    if "_threshold" in params:
-                        predict_params["threshold"] = params._threshold
                     pred_op = predict_op(logits, **predict_params)
                     if type(pred_op) == tuple:
                         pred_op, pred_proba_op = pred_op
                     else:
                         pred_proba_op = predict_proba_op(logits, **predict_params)
 
-                    predictions[PredictMode.NORMAL] = pred_op
-                    predictions[PredictMode.PROBAS] = pred_proba_op
+                    for predict_mode, op in ((PredictMode.NORMAL, pred_op), (PredictMode.PROBAS, pred_proba_op)):
+                        if isinstance(op, dict):
+                            # one output per task of a multi-task model
+                            predictions.update(
+                                {PredictMode.for_task(predict_mode, task): task_op for task, task_op in op.items()}
+                            )
+                        else:
+                            predictions[predict_mode] = op
 
             if build_lm:
                 lm_predict_op, language_model_state = language_model_op(X=X, M=M, params=params,
-                                                                        featurizer_state=featurizer_state)
+                                                                        featurizer_state=featurizer_state,
+                                                                        train=train)
                 if mode == tf.estimator.ModeKeys.TRAIN or mode == tf.estimator.ModeKeys.EVAL:
                     lm_loss = tf.reduce_mean(language_model_state["losses"])
                     train_loss += lm_loss_coef * lm_loss
                     tf.summary.scalar("LanguageModelLoss", lm_loss)
                 if mode == tf.estimator.ModeKeys.PREDICT:
-                    predictions[PredictMode.GENERATE_TEXT] = lm_predict_op
+                    predictions[PredictMode.GENERATE_TEXT] = generate_text_op(X=X, M=M, params=params)
+                    predictions[PredictMode.LM_SCORE] = language_model_log_likelihood(
+                        X=X,
+                        embed_weights=featurizer_state['embed_weights'],
+                        hidden=featurizer_state['sequence_features'],
+                        encoder=encoder,
+                        config=params
+                    )
 
         if mode == tf.estimator.ModeKeys.TRAIN:
-            total_num_steps = params.n_epochs * params.dataset_size//params.batch_size
+            accumulation_steps = params.get("gradient_accumulation_steps", 1)
+            # the global step counts optimizer updates rather than batches
+            total_num_steps = max(params.n_epochs * params.dataset_size // params.batch_size // accumulation_steps, 1)
             lr_decay = lambda lr, global_step: lr * schedules[params.lr_schedule](tf.to_float(global_step) / total_num_steps)
             
-            optimizer = lambda lr: AdamWOptimizer(
+            if params.train_embeddings and params.get("sparse_embedding_updates"):
+                optimizer_cls = LazyAdamWOptimizer
+            else:
+                optimizer_cls = AdamWOptimizer
+            optimizer = lambda lr: optimizer_cls(
                 learning_rate=lr,
                 beta1=params.b1,
                 beta2=params.b2,
@@ -127,20 +361,32 @@ def get_model_fn(target_model_fn, predict_op, predict_proba_op, build_target_mod
                 weight_decay=params.l2_reg * lr
             )
 
-            summaries = tf.contrib.layers.OPTIMIZER_SUMMARIES if params.summarize_grads else None
-            train_op = tf.contrib.layers.optimize_loss(
-                loss=train_loss,
-                global_step=tf.train.get_or_create_global_step(),
-                learning_rate=params.lr,
-                optimizer=optimizer,
-                clip_gradients=float(params.max_grad_norm),
-                learning_rate_decay_fn=lr_decay,
-                increment_global_step=True,
-                summaries=summaries
-            )
+            if accumulation_steps > 1:
+                train_op = accumulate_gradients_op(
+                    loss=train_loss,
+                    optimizer=optimizer,
+                    lr_decay=lr_decay,
+                    params=params,
+                    accumulation_steps=accumulation_steps
+                )
+            else:
+                summaries = tf.contrib.layers.OPTIMIZER_SUMMARIES if params.summarize_grads else None
+                train_op = tf.contrib.layers.optimize_loss(
+                    loss=train_loss,
+                    global_step=tf.train.get_or_create_global_step(),
+                    learning_rate=params.lr,
+                    optimizer=optimizer,
+                    clip_gradients=float(params.max_grad_norm),
+                    learning_rate_decay_fn=lr_decay,
+                    increment_global_step=True,
+                    summaries=summaries
+                )
 
-        init_op = saver.get_scaffold_init_op()
-        scaffold = Scaffold(init_op=init_op)
+        if saver is not None:
+            scaffold = Scaffold(init_op=saver.get_scaffold_init_op())
+        else:
+            # variables are restored by the caller
+            scaffold = None
 
         if mode == tf.estimator.ModeKeys.PREDICT:
             return tf.estimator.EstimatorSpec(
@@ -153,7 +399,7 @@ def get_model_fn(target_model_fn, predict_op, predict_proba_op, build_target_mod
             return tf.estimator.EstimatorSpec(mode=mode, loss=train_loss, train_op=train_op, scaffold=scaffold)
 
         assert mode == tf.estimator.ModeKeys.EVAL, "The mode is actually {}".format(mode)
-        if params.eval_acc and pred_op is not None:
+        if params.eval_acc and pred_op is not None and not isinstance(pred_op, dict):
             LOGGER.info("Adding evaluation metrics, Accuracy")
             labels_dense = tf.argmax(labels)
             metrics = {
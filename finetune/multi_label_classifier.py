@@ -1,8 +1,11 @@
 import warnings
 
+import numpy as np
 import tensorflow as tf
 
 from finetune.base import BaseModel
+from finetune.errors import FinetuneError
+from finetune.metrics import multi_label_threshold_curve
 from finetune.target_encoders import MultilabelClassificationEncoder
 from finetune.network_modules import multi_classifier
 
@@ -43,19 +46,77 @@ class MultiLabelClassifier(BaseModel):
         Produces a list of most likely class labels as determined by the fine-tuned model.
 
         :param X: list or array of text to embed.
+        :param threshold: Either a float applied to all classes, a list of floats (one per class, in the order of
+            `label_encoder.classes_`) or a dictionary mapping from class label to threshold.
+            Defaults to `config.multi_label_threshold`.
         :returns: list of class labels.
         """
-        self.config._threshold = threshold or self.config.multi_label_threshold
-        return self._predict(X)
+        return self.apply_threshold(self._predict_proba(X), threshold=threshold)
 
-    def predict_proba(self, X):
+    def apply_threshold(self, probas, threshold=None):
+        """
+        Converts cached probabilities to class labels without re-running the model.
+
+        :param probas: Output of :meth:`predict_proba` or an array of probabilities of shape [n_examples, n_classes].
+        :param threshold: See :meth:`predict`.
+        :returns: list of class labels.
+        """
+        probas = self._probas_to_array(probas)
+        thresholds = self._class_thresholds(threshold)
+        return self.input_pipeline.label_encoder.inverse_transform((probas > thresholds).astype(np.int32))
+
+    def threshold_sweep(self, X, Y, thresholds=None):
+        """
+        Computes precision and recall at many thresholds from a single call to :meth:`predict_proba`.
+
+        :param X: list or array of text.
+        :param Y: A list of lists containing the true labels for the corresponding X.
+        :param thresholds: 1D list or array of thresholds to evaluate.  Defaults to 99 evenly spaced values in (0, 1).
+        :returns: see :func:`finetune.metrics.multi_label_threshold_curve`.
+        """
+        if thresholds is None:
+            thresholds = np.linspace(0.01, 0.99, 99)
+        probas = self._probas_to_array(self._predict_proba(X))
+        y_true = self.input_pipeline.label_encoder.transform(Y)
+        return multi_label_threshold_curve(y_true, probas, thresholds)
+
+    def _probas_to_array(self, probas):
+        if len(probas) and isinstance(probas[0], dict):
+            classes = self.input_pipeline.label_encoder.classes_
+            return np.asarray([[proba[cls_] for cls_ in classes] for proba in probas], dtype=np.float32)
+        return np.asarray(probas, dtype=np.float32)
+
+    def _class_thresholds(self, threshold=None):
+        classes = self.input_pipeline.label_encoder.classes_
+        if threshold is None:
+            threshold = self.config.multi_label_threshold
+
+        if isinstance(threshold, dict):
+            unknown = set(threshold) - set(classes)
+            if unknown:
+                raise FinetuneError("Thresholds provided for unknown classes: {}".format(sorted(unknown)))
+            return np.asarray(
+                [threshold.get(cls_, self.config.multi_label_threshold) for cls_ in classes], dtype=np.float32
+            )
+
+        thresholds = np.asarray(threshold, dtype=np.float32)
+        if thresholds.ndim > 1 or (thresholds.ndim == 1 and len(thresholds) != len(classes)):
+            raise FinetuneError(
+                "Expected a single threshold or one threshold per class ({}), got shape {}.".format(
+                    len(classes), thresholds.shape
+                )
+            )
+        return thresholds
+
+    def predict_proba(self, X, as_array=False):
         """
         Produces a probability distribution over classes for each example in X.
 
         :param X: list or array of text to embed.
+        :param as_array: If True, return an array of shape [n_examples, n_classes] with columns ordered as `classes_`.
         :returns: list of dictionaries.  Each dictionary maps from a class label to its assigned class probability.
         """
-        return super().predict_proba(X)
+        return super().predict_proba(X, as_array=as_array)
 
     def finetune(self, X, Y=None, batch_size=None):
         """
@@ -0,0 +1,277 @@
+import itertools
+
+import tensorflow as tf
+
+from finetune.base import BaseModel, PredictMode
+from finetune.errors import FinetuneError
+from finetune.input_pipeline import BasePipeline
+from finetune.regressor import Regressor
+from finetune.sequence_labeling import SequencePipeline
+from finetune.utils import indico_to_finetune_sequence
+
+
+class MultiTaskPipeline(BasePipeline):
+    """
+    Encodes each example once and attaches the targets of every task.
+
+    :param config: A config object.
+    :param tasks: A dict mapping task names to the input pipelines of their models.
+    """
+
+    def __init__(self, config, tasks):
+        super().__init__(config)
+        self.tasks = tasks
+
+    @property
+    def sequence_task(self):
+        return next((name for name, pipeline in self.tasks.items() if isinstance(pipeline, SequencePipeline)), None)
+
+    def _target_encoder(self):
+        # targets are encoded by the pipeline of each task
+        return None
+
+    def _post_data_initialization(self, Y):
+        if callable(Y):
+            Y = list(itertools.islice(Y(), 10000))
+        for name, pipeline in self.tasks.items():
+            pipeline._post_data_initialization([y[name] for y in Y])
+        self.target_dim = {name: pipeline.target_dim for name, pipeline in self.tasks.items()}
+        self.lm_loss_coef = self.config.lm_loss_coef
+
+    def feed_shape_type_def(self):
+        TS = tf.TensorShape
+        target_types, target_shapes = {}, {}
+        for name, pipeline in self.tasks.items():
+            (_, target_types[name]), (_, target_shapes[name]) = pipeline.feed_shape_type_def()
+        return ({"tokens": tf.int32, "mask": tf.float32}, target_types), (
+            {"tokens": TS([self.config.max_length, 2]), "mask": TS([self.config.max_length])}, target_shapes)
+
+    def _format_for_encoding(self, X):
+        if self.sequence_task is not None:
+            # text is split into labeled segments by `indico_to_finetune_sequence`
+            return [X]
+        return [[X]]
+
+    def text_to_tokens_mask(self, X, Y=None):
+        sequence_task = self.sequence_task
+        pad_token = self.config.pad_token
+        sequence_labels = None
+        if sequence_task is not None:
+            if self.tasks[sequence_task].multi_label:
+                pad_token = [pad_token]
+            if Y is not None:
+                sequence_labels = Y[sequence_task]
+
+        for out in self._text_to_ids(X, Y=sequence_labels, pad_token=pad_token):
+            feats = {"tokens": out.token_ids, "mask": out.mask}
+            if Y is None:
+                yield feats
+                continue
+            targets = {}
+            for name, pipeline in self.tasks.items():
+                if name == sequence_task:
+                    targets[name] = pipeline.label_encoder.transform(out.labels)
+                else:
+                    targets[name] = pipeline.label_encoder.transform([Y[name]])[0]
+            yield feats, targets
+
+
+class TaskPredictor:
+    """
+    Serves the predictions of one task from the prediction graph of a :py:class:`MultiTask` model, so that the model
+    of that task can decode them as it would its own.
+
+    :param predictor: The :py:class:`finetune.inference.Predictor` of the multi-task model.
+    :param task: Name of the task.
+    """
+
+    def __init__(self, predictor, task):
+        self.predictor = predictor
+        self.task = task
+
+    def _mode(self, mode):
+        task_mode = PredictMode.for_task(mode, self.task)
+        return task_mode if task_mode in self.predictor.predictions else mode
+
+    def run(self, batches, mode=None):
+        if mode is None:
+            mode = [PredictMode.FEATURIZE, PredictMode.NORMAL, PredictMode.PROBAS]
+        if not isinstance(mode, (list, tuple)):
+            yield from self.predictor.run(batches, mode=self._mode(mode))
+            return
+        for output in self.predictor.run(batches, mode=[self._mode(key) for key in mode]):
+            yield {key: output[self._mode(key)] for key in mode}
+
+    def close(self):
+        # the predictor is owned by the multi-task model
+        pass
+
+
+class MultiTask(BaseModel):
+    """
+    Trains the target models of several tasks together on top of a single featurizer.  Each batch runs the
+    featurizer once and the loss is a weighted sum of the losses of every task.
+
+    The tasks share this model's config, so options such as `chunk_long_sequences` apply to all of them.  At most
+    one task may be a sequence labeling task.
+
+    :param tasks: A dict mapping task names to model classes, for example
+        `{"sentiment": Classifier, "score": Regressor, "entities": SequenceLabeler}`.
+    :param task_weights: A dict mapping task names to the coefficient of their loss.  Defaults to `1.0` per task.
+    :param config: A :py:class:`finetune.config.Settings` object or None (for default config).
+    :param \**kwargs: key-value pairs of config items to override.
+    """
+
+    def __init__(self, tasks, task_weights=None, config=None, **kwargs):
+        if not tasks:
+            raise FinetuneError("MultiTask needs at least one task.")
+        unknown = set(task_weights or {}) - set(tasks)
+        if unknown:
+            raise FinetuneError("Weights provided for unknown tasks: {}".format(sorted(unknown)))
+        self.task_types = dict(tasks)
+        self.task_weights = {name: 1.0 for name in tasks}
+        self.task_weights.update(task_weights or {})
+        super().__init__(config=config, **kwargs)
+        if self.config.class_weights is not None:
+            raise FinetuneError("`class_weights` are not supported by MultiTask.")
+        if self.config.get("inference_processes", 1) > 1:
+            raise FinetuneError("`inference_processes` > 1 is not supported by MultiTask.")
+
+    def _get_input_pipeline(self):
+        self.tasks = {name: model_type._as_task(self.config) for name, model_type in self.task_types.items()}
+        pipeline = MultiTaskPipeline(self.config, {name: task.input_pipeline for name, task in self.tasks.items()})
+        sequence_tasks = [name for name, task in pipeline.tasks.items() if isinstance(task, SequencePipeline)]
+        if len(sequence_tasks) > 1:
+            raise FinetuneError(
+                "At most one sequence labeling task is supported, got {}.".format(", ".join(sequence_tasks))
+            )
+        return pipeline
+
+    def _initialize_state(self):
+        super()._initialize_state()
+        for task in self.tasks.values():
+            task._initialize_state()
+
+    def _initialize(self, **kwargs):
+        super()._initialize(**kwargs)
+        for task in self.tasks.values():
+            task._initialize(saver=self.saver)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.update(
+            task_types=self.task_types,
+            task_weights=self.task_weights,
+            tasks=self.tasks
+        )
+        return state
+
+    def finetune(self, X, Y=None, batch_size=None):
+        """
+        :param X: list or array of text.
+        :param Y: A dict mapping each task name to its targets for X, in the format the model of that task takes.
+        :param batch_size: integer number of examples per batch. When N_GPUS > 1, this number
+                           corresponds to the number of training examples provided to each GPU.
+        """
+        sequence_task = self.input_pipeline.sequence_task
+        if Y is not None:
+            missing = set(self.tasks) - set(Y)
+            if missing:
+                raise FinetuneError("No targets provided for tasks: {}".format(sorted(missing)))
+            Y = {name: list(Y[name]) for name in self.tasks}
+            for name, targets in Y.items():
+                if len(targets) != len(X):
+                    raise FinetuneError(
+                        "Mismatch between number of examples ({}) and number of targets for {} ({}).".format(
+                            len(X), name, len(targets)
+                        )
+                    )
+        if sequence_task is not None:
+            X, sequence_labels = indico_to_finetune_sequence(
+                X,
+                labels=Y[sequence_task] if Y is not None else None,
+                multi_label=self.tasks[sequence_task].multi_label,
+                none_value=self.config.pad_token
+            )
+            if Y is not None:
+                Y[sequence_task] = sequence_labels
+        if Y is not None:
+            # one dict of targets per example, so that examples can be split and shuffled together with their targets
+            Y = [dict(zip(Y, targets)) for targets in zip(*Y.values())]
+        return super().finetune(X, Y=Y, batch_size=batch_size)
+
+    def _tasks_for_inference(self):
+        predictor = self._get_predictor()
+        for name, task in self.tasks.items():
+            task._predictor = TaskPredictor(predictor, name)
+        return self.tasks
+
+    def predict(self, X):
+        """
+        Produces predictions for every task.
+
+        :param X: list or array of text.
+        :returns: A dict mapping each task name to what the `predict` method of its model returns for X.
+        """
+        return {name: task.predict(X) for name, task in self._tasks_for_inference().items()}
+
+    def predict_proba(self, X):
+        """
+        Produces class probabilities for every task that supports them.
+
+        :param X: list or array of text.
+        :returns: A dict mapping task names to what the `predict_proba` method of their model returns for X.  Tasks
+            whose model does not support `predict_proba`, such as `Regressor`, are left out.
+        """
+        return {
+            name: task.predict_proba(X)
+            for name, task in self._tasks_for_inference().items()
+            if not isinstance(task, Regressor)
+        }
+
+    def featurize(self, X):
+        """
+        Embeds inputs in learned feature space. Can be called before or after calling :meth:`finetune`.
+
+        :param X: list or array of text to embed.
+        :returns: np.array of features of shape (n_examples, embedding_size).
+        """
+        return self._featurize(X)
+
+    def _target_model(self, featurizer_state, targets, n_outputs, train=False, reuse=None, **kwargs):
+        logits, predict_params, loss = {}, {}, 0.0
+        for name, task in self.tasks.items():
+            with tf.variable_scope(name):
+                task_state = task._target_model(
+                    featurizer_state=featurizer_state,
+                    targets=targets[name] if targets is not None else None,
+                    n_outputs=task.input_pipeline.target_dim,
+                    train=train,
+                    reuse=reuse,
+                    **kwargs
+                )
+            logits[name] = task_state["logits"]
+            predict_params[name] = task_state.get("predict_params", {})
+            if targets is not None:
+                task_loss = tf.reduce_mean(task_state["losses"])
+                tf.summary.scalar("TaskLoss/{}".format(name), task_loss)
+                loss += self.task_weights[name] * task_loss
+        return {
+            "logits": logits,
+            "losses": loss,
+            "predict_params": {"task_params": predict_params}
+        }
+
+    def _predict_op(self, logits, task_params=None):
+        preds, probas = {}, {}
+        for name, task in self.tasks.items():
+            params = task_params[name]
+            pred = task._predict_op(logits[name], **params)
+            if type(pred) == tuple:
+                preds[name], probas[name] = pred
+            else:
+                preds[name], probas[name] = pred, task._predict_proba_op(logits[name], **params)
+        return preds, probas
+
+    def _predict_proba_op(self, logits, task_params=None):
+        return self._predict_op(logits, task_params=task_params)[1]
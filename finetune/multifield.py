@@ -41,14 +41,15 @@ class MultiFieldClassifier(Classifier):
         """
         return BaseModel.predict(self, Xs)
 
-    def predict_proba(self, Xs):
+    def predict_proba(self, Xs, as_array=False):
         """
         Produces probability distribution over classes for each example in X.
 
         :param \*Xs: lists of text inputs, shape [batch, n_fields]
+        :param as_array: If True, return an array of shape [n_examples, n_classes] with columns ordered as `classes_`.
         :returns: list of dictionaries.  Each dictionary maps from X2 class label to its assigned class probability.
         """
-        return BaseModel.predict_proba(self, Xs)
+        return BaseModel.predict_proba(self, Xs, as_array=as_array)
 
     def featurize(self, Xs):
         """
@@ -1,19 +1,15 @@
 import numpy as np
 
-from finetune.base import BaseModel
+from finetune.base import BaseModel, PredictMode
 from finetune.input_pipeline import BasePipeline
 from finetune.encoding import ArrayEncodedOutput
 from finetune.target_encoders import IDEncoder
 import tensorflow as tf
 
 from finetune.network_modules import multi_choice_question
-from finetune.utils import list_transpose
+from finetune.utils import pad_stack
 
 class MultipleChoicePipeline(BasePipeline):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.num_answers = None
-
 
     def _text_to_ids(self, Xs, Y=None, pad_token=None):
         """
@@ -37,7 +33,11 @@ class MultipleChoicePipeline(BasePipeline):
     def feed_shape_type_def(self):
         TS = tf.TensorShape
         return ({"tokens": tf.int32, "mask": tf.float32}, tf.int32), (
-            {"tokens": TS([self.num_answers, self.config.max_length, 2]), "mask": TS([self.num_answers, self.config.max_length])}, TS([]))
+            {"tokens": TS([None, self.config.max_length, 2]), "mask": TS([None, self.config.max_length])}, TS([]))
+
+    def _batch(self, dataset, batch_size):
+        # questions are padded to the largest number of answers in their batch
+        return dataset.padded_batch(batch_size, padded_shapes=dataset.output_shapes)
 
     def _target_encoder(self):
         return IDEncoder()
@@ -45,15 +45,11 @@ class MultipleChoicePipeline(BasePipeline):
 
 class MultipleChoice(BaseModel):
     """
-    Multi choice question finetune model.
+    Multi choice question finetune model.  Questions may have different numbers of answers.
     
     :param config: A :py:class:`finetune.config.Settings` object or None (for default config).
     """
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.num_answers = None
-
     def _get_input_pipeline(self):
         return MultipleChoicePipeline(self.config)
 
@@ -87,8 +83,6 @@ class MultipleChoice(BaseModel):
                     raise ValueError(
                         "Correct answer {} is not contained in possible answers {}".format(correct, others))
 
-        self.num_answers = len(answers[0])
-        self.input_pipeline.num_answers = self.num_answers #TODO(BEN) factor this inside the post_data_init
         labels = None if fit_lm_only else answer_idx
         return super().finetune(list(zip(questions, answers)), Y=labels)
 
@@ -96,7 +90,7 @@ class MultipleChoice(BaseModel):
         return multi_choice_question(
             hidden=featurizer_state['features'],
             targets=targets,
-            n_targets=self.num_answers,
+            answer_mask=featurizer_state['sequence_mask'],
             config=self.config,
             train=train,
             reuse=reuse,
@@ -121,20 +115,26 @@ class MultipleChoice(BaseModel):
         raw_ids = BaseModel.predict(self, list(zip(questions, answers)))
         return [ans[i] for ans, i in zip(answers, raw_ids)]
 
-    def predict_proba(self, questions, answers):
+    def predict_proba(self, questions, answers, as_array=False):
         """
         Produces a probability distribution over classes for each example in X.
 
 
         :param question: List or array of text, shape [batch]
         :param answers: List or array of text, shape [batch, n_answers]
+        :param as_array: If True, return an array of shape [batch, n_answers] with columns ordered as in `answers`.
+            Questions with fewer answers than the most in `answers` are padded with zeros.
         :returns: list of dictionaries.  Each dictionary maps from a class label to its assigned class probability.
         """
-        answers = list_transpose(answers)
-        raw_probas = self._predict_proba(zip(questions, answers))
+        raw_probas = [
+            probas[:len(answers_per_sample)]
+            for probas, answers_per_sample in zip(self._predict_proba(list(zip(questions, answers))), answers)
+        ]
+        if as_array:
+            return pad_stack(raw_probas)
 
         formatted_predictions = []
-        for probas, *answers_per_sample in zip(raw_probas, *answers):
+        for probas, answers_per_sample in zip(raw_probas, answers):
             formatted_predictions.append(
                 dict(zip(answers_per_sample, probas))
             )
@@ -146,6 +146,11 @@ class MultipleChoice(BaseModel):
 
         :param questions: List or array of text, shape [batch]
         :param answers: List or array of text, shape [n_answers, batch]
-        :returns: np.array of features of shape (n_examples, embedding_size).
+        :returns: np.array of features of shape (n_examples, n_answers, embedding_size).  Questions with fewer answers
+            than the most in `answers` are padded with zeros.
         """
-        return BaseModel.featurize(self, zip(questions, answers))
+        features = self._inference(list(zip(questions, answers)), PredictMode.FEATURIZE)
+        return pad_stack([
+            features_per_sample[:len(answers_per_sample)]
+            for features_per_sample, answers_per_sample in zip(features, answers)
+        ])
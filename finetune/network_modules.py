@@ -1,11 +1,118 @@
 import functools
+import logging
 
 import tensorflow as tf
 from tensorflow.contrib.crf import crf_log_likelihood
 
 from finetune.transformer import dropout, embed, block, attn, norm
 from finetune.utils import shape_list, merge_leading_dims
+from finetune.errors import FinetuneError
 from finetune.recompute_grads import recompute_grad
+from finetune.crf import crf_log_likelihood as batched_crf_log_likelihood
+
+LOGGER = logging.getLogger('finetune')
+
+
+def block_activation_mb(config, batch_size, recompute=None):
+    """
+    Rough estimate of the memory held between the forward and backward pass by the activations of one transformer
+    block, in MB of float32 values.
+
+    :param config: A config object.
+    :param batch_size: Number of sequences the block is run on.
+    :param recompute: `None` when every activation is kept, `"attention"` when the attention sublayer is recomputed
+        and `"block"` when only the input of the block is kept.
+    """
+    floats_per_token = config.n_embed
+    if recompute != "block":
+        # layer norms, the feed-forward layer and the output of each sublayer
+        floats_per_token += 16 * config.n_embed
+        if recompute != "attention":
+            # queries, keys and values, and the attention weights of every head before and after softmax and dropout
+            floats_per_token += 3 * config.n_embed + 4 * config.n_heads * config.max_length
+    return 4 * batch_size * config.max_length * floats_per_token / 2 ** 20
+
+
+def sequence_labeler_activation_mb(config, batch_size, n_targets, recompute=None):
+    """
+    Rough estimate of the memory held between the forward and backward pass by the activations of the attention
+    layer of :func:`sequence_labeler`, in MB of float32 values.
+
+    :param config: A config object.
+    :param batch_size: Number of sequences the labeler is run on.
+    :param n_targets: Number of classes predicted by the labeler.
+    :param recompute: As in :func:`block_activation_mb`.
+    """
+    floats_per_token = config.n_embed
+    if recompute != "block":
+        # the output of the attention sublayer, the residual and its layer norm, and the logits
+        floats_per_token += 4 * config.n_embed + n_targets
+        if recompute != "attention":
+            floats_per_token += 3 * config.n_embed + 4 * config.seq_num_heads * config.max_length
+    return 4 * batch_size * config.max_length * floats_per_token / 2 ** 20
+
+
+def recompute_plan(config, layers, batch_size, head_mb=None):
+    """
+    Selects which of `layers` recompute their activations on the backward pass according to `low_memory_mode`
+    and `recompute_policy`.
+
+    :param config: A config object.
+    :param layers: The indices of the trained layers, from input to output.
+    :param batch_size: Number of sequences the layers are run on, used by the `"budget"` policy.
+    :param head_mb: Optionally, a function of `recompute` estimating the activation memory of a target model run on
+        top of `layers`, such as :func:`sequence_labeler_activation_mb`.  The head is then added to the plan under
+        the key `"head"`.  The plan of `layers` is unchanged, so under the `"budget"` policy the head only keeps the
+        activations that fit in the memory left by the layers.
+    :return: A dict mapping each layer to `None`, `"attention"` or `"block"`, see :func:`block_activation_mb`.
+    """
+    layers = list(layers)
+    plan = _layer_plan(config, layers, batch_size)
+    if head_mb is not None:
+        plan["head"] = _head_plan(config, layers, batch_size, plan, head_mb)
+    return plan
+
+
+def _head_plan(config, layers, batch_size, plan, head_mb):
+    if not config.low_memory_mode:
+        return None
+    policy = config.get("recompute_policy", "all")
+    if policy == "every_k":
+        # the head continues the period of the layers below it
+        return "block" if len(layers) % config.recompute_every_k == 0 else None
+    if policy == "budget":
+        used_mb = sum(block_activation_mb(config, batch_size, recompute=recompute) for recompute in plan.values())
+        for recompute in [None, "attention"]:
+            if used_mb + head_mb(recompute=recompute) <= config.recompute_memory_budget:
+                return recompute
+        return "block"
+    return "attention" if policy == "attention" else "block"
+
+
+def _layer_plan(config, layers, batch_size):
+    if not config.low_memory_mode:
+        return {layer: None for layer in layers}
+
+    policy = config.get("recompute_policy", "all")
+    if policy == "all":
+        return {layer: "block" for layer in layers}
+    if policy == "attention":
+        return {layer: "attention" for layer in layers}
+    if policy == "every_k":
+        k = config.recompute_every_k
+        return {layer: "block" if i % k == 0 else None for i, layer in enumerate(layers)}
+    if policy == "budget":
+        if config.recompute_memory_budget is None:
+            raise FinetuneError("`recompute_memory_budget` must be set to use recompute_policy='budget'.")
+        kept_mb = block_activation_mb(config, batch_size)
+        recomputed_mb = block_activation_mb(config, batch_size, recompute="block")
+        n_kept = int((config.recompute_memory_budget - len(layers) * recomputed_mb) // (kept_mb - recomputed_mb))
+        n_recomputed = len(layers) - min(max(n_kept, 0), len(layers))
+        # the blocks nearest the output keep their activations
+        return {layer: "block" if i < n_recomputed else None for i, layer in enumerate(layers)}
+    raise FinetuneError(
+        "Unknown recompute_policy {!r}, expected one of 'all', 'every_k', 'attention' or 'budget'.".format(policy)
+    )
 
 
 def perceptron(x, ny, config, w_init=None, b_init=None):
@@ -27,48 +134,134 @@ def perceptron(x, ny, config, w_init=None, b_init=None):
         return tf.matmul(x, w) + b
 
 
-def featurizer(X, encoder, config, train=False, reuse=None):
+def featurizer(X, encoder, config, train=False, reuse=None, frozen_hidden=None):
     """
     The transformer element of the finetuning model. Maps from tokens ids to a dense, embedding of the sequence.
 
-    :param X: A tensor of token indexes with shape [batch_size, sequence_length, token_idx]
+    When `config.num_layers_trained` is less than `config.n_layer`, the lower layers are run without dropout and
+    no gradient flows through them.
+
+    When X holds several sequences per example, such as a question paired with each of its answers, the leading
+    positions that every sequence of an example shares are only run once.  Examples may have different numbers of
+    sequences, padded with sequences of zeros which are not run through the model.
+
+    :param X: A tensor of token indexes with shape [batch_size, sequence_length, token_idx] or
+        [batch_size, n_sequences, sequence_length, token_idx]
     :param encoder: A TextEncoder object.
     :param config: A config object, containing all parameters for the featurizer.
     :param train: If this flag is true, dropout and losses are added to the graph.
     :param reuse: Should reuse be set within this scope.
+    :param frozen_hidden: Optional. The output of the frozen lower layers for X, as previously returned in
+        `frozen_hidden`.  When given, only the trained layers are run.
     :return: A dict containing;
         embed_weights: the word embedding matrix.
         features: The output of the featurizer_final state.
         sequence_features: The output of the featurizer at each timestep.
+        frozen_hidden: The output of the frozen lower layers at each timestep.  Only present when some layers are
+            frozen and `frozen_hidden` was not given.
+        sequence_mask: 1 for the sequences of each example and 0 for padding.  Only present when X holds several
+            sequences per example.
     """
     initial_shape = [a or -1 for a in X.get_shape().as_list()]
+    if initial_shape.count(-1) > 1:
+        initial_shape = shape_list(X)
+    multi_sequence = len(initial_shape) == 4
+    n_sequences = shape_list(X)[1] if multi_sequence else 1
+    static_sequences = n_sequences if isinstance(n_sequences, int) else 1
+    shared_prefix = multi_sequence and X.get_shape().as_list()[1] != 1
     X = tf.reshape(X, shape=[-1] + initial_shape[-2:])
+    n_frozen = config.n_layer - config.num_layers_trained
 
     with tf.variable_scope('model/featurizer', reuse=reuse):
         embed_weights = tf.get_variable("we", [encoder.vocab_size + config.max_length, config.n_embed],
                                         initializer=tf.random_normal_initializer(stddev=config.weight_stddev))
-        if config.train_embeddings:
+        embed_fn = embed
+        if config.train_embeddings and config.get("sparse_embedding_updates"):
+            embed_fn = functools.partial(embed, pdrop=config.embed_p_drop, train=train)
+        elif config.train_embeddings:
             embed_weights = dropout(embed_weights, config.embed_p_drop, train)
         else:
             embed_weights = tf.stop_gradient(embed_weights)
 
         X = tf.reshape(X, [-1, config.max_length, 2])
 
-        h = embed(X, embed_weights)
-        for layer in range(config.n_layer):
-            if (layer - config.n_layer) == config.num_layers_trained and config.num_layers_trained != 12:
-                h = tf.stop_gradient(h)
-                train_layer = False
-            else:
-                train_layer = train
+        def run_layers(h, layers, train_layers):
+            # the number of sequences per example is unknown when it is padded per batch, as for MultipleChoice, in
+            # which case the estimate counts one sequence per example
+            batch_size = config.batch_size * static_sequences
+            plan = recompute_plan(config, layers, batch_size=batch_size) if train_layers else {}
+            if config.low_memory_mode and plan:
+                LOGGER.info(
+                    "Recomputing blocks {} and the attention of blocks {}, estimated activation memory {:.1f}MB".format(
+                        [layer for layer, recompute in plan.items() if recompute == "block"],
+                        [layer for layer, recompute in plan.items() if recompute == "attention"],
+                        sum(block_activation_mb(config, batch_size, recompute=r) for r in plan.values())
+                    )
+                )
+            for layer in layers:
+                with tf.variable_scope('h%d_' % layer):
+                    block_fn = functools.partial(block, n_head=config.n_heads, act_fn=config.act_fn,
+                                                 resid_pdrop=config.resid_p_drop, attn_pdrop=config.attn_p_drop,
+                                                 scope='h%d' % layer, train=train_layers, scale=True,
+                                                 recompute_attn=plan.get(layer) == "attention")
+                    if plan.get(layer) == "block":
+                        block_fn = recompute_grad(block_fn, use_entire_scope=True)
+                    h = block_fn(h)
+            return h
+
+        def run_layers_shared_prefix(X):
+            # causal attention means positions before the first that differs between sequences have the same
+            # hidden states in every sequence, so they are computed once and their keys and values are reused.
+            X_seq = tf.reshape(X, [-1, n_sequences, config.max_length, 2])
+            batch_size = shape_list(X_seq)[0]
+            shared = tf.logical_or(
+                tf.equal(X_seq, X_seq[:, :1]),
+                tf.logical_not(tf.reshape(sequence_mask, [batch_size, n_sequences, 1, 1]))
+            )
+            shared = tf.to_int32(tf.reduce_all(shared, axis=[1, 3]))
+            prefix_length = tf.reduce_min(tf.reduce_sum(tf.cumprod(shared, axis=1), axis=1))
+            prefix_length = tf.minimum(prefix_length, config.max_length - 1)
 
-            with tf.variable_scope('h%d_' % layer):
+            # only the sequences that are present are run past the shared prefix
+            present_idx = tf.to_int32(tf.where(sequence_mask))
+
+            def tile(t):
+                t = tf.tile(tf.expand_dims(t, 1), [1, n_sequences] + [1] * (len(t.get_shape()) - 1))
+                return tf.gather_nd(tf.reshape(t, [-1] + shape_list(t)[2:]), present_idx)
+
+            def scatter(t):
+                return tf.scatter_nd(present_idx, t, [shape_list(X)[0]] + shape_list(t)[1:])
+
+            prefix_h = embed_fn(X_seq[:, 0, :prefix_length], embed_weights)
+            h = embed_fn(tf.gather_nd(X, present_idx)[:, prefix_length:], embed_weights)
+            empty_past = tf.zeros([batch_size, 2, config.n_heads, 0, config.n_embed // config.n_heads])
+            frozen_h = None
+            for layer in range(config.n_layer):
                 block_fn = functools.partial(block, n_head=config.n_heads, act_fn=config.act_fn,
                                              resid_pdrop=config.resid_p_drop, attn_pdrop=config.attn_p_drop,
-                                             scope='h%d' % layer, train=train_layer, scale=True)
-                if config.low_memory_mode and train_layer:
-                    block_fn = recompute_grad(block_fn, use_entire_scope=True)
-                h = block_fn(h)
+                                             scope='h%d' % layer, train=train and layer >= n_frozen, scale=True)
+                with tf.variable_scope('h%d_' % layer):
+                    prefix_h, present = block_fn(prefix_h, past=empty_past)
+                with tf.variable_scope('h%d_' % layer, reuse=True):
+                    h, _ = block_fn(h, past=tile(present))
+                if layer + 1 == n_frozen:
+                    prefix_h, h = tf.stop_gradient(prefix_h), tf.stop_gradient(h)
+                    frozen_h = scatter(tf.concat([tile(prefix_h), h], axis=1))
+            return scatter(tf.concat([tile(prefix_h), h], axis=1)), frozen_h
+
+        if multi_sequence:
+            sequence_mask = tf.reduce_any(tf.not_equal(X, 0), axis=[1, 2])
+        if frozen_hidden is None and shared_prefix and not (config.low_memory_mode and train):
+            h, frozen_h = run_layers_shared_prefix(X)
+        else:
+            if frozen_hidden is None:
+                h = run_layers(embed_fn(X, embed_weights), range(n_frozen), train_layers=False)
+                if n_frozen > 0:
+                    h = tf.stop_gradient(h)
+                    frozen_h = h
+            else:
+                h = tf.reshape(frozen_hidden, [-1, config.max_length, config.n_embed])
+            h = run_layers(h, range(n_frozen, config.n_layer), train_layers=train)
 
         # Use hidden state at classifier token as input to final proj. + softmax
         clf_h = tf.reshape(h, [-1, config.n_embed])  # [batch * seq_len, embed]
@@ -78,14 +271,129 @@ def featurizer(X, encoder, config, train=False, reuse=None):
         clf_h = tf.reshape(clf_h, shape=initial_shape[: -2] + [config.n_embed])
         seq_feats = tf.reshape(h, shape=initial_shape[:-1] + [config.n_embed])
 
-        return {
+        featurizer_state = {
             'embed_weights': embed_weights,
             'features': clf_h,
             'sequence_features': seq_feats
         }
+        if frozen_hidden is None and n_frozen > 0:
+            featurizer_state['frozen_hidden'] = tf.reshape(frozen_h, shape=initial_shape[:-1] + [config.n_embed])
+        if multi_sequence:
+            featurizer_state['sequence_mask'] = tf.to_float(tf.reshape(sequence_mask, initial_shape[:2]))
+        return featurizer_state
+
+
+def language_model_step(X, past, encoder, config):
+    """
+    Runs the featurizer and language model on the next positions of a batch of sequences, attending to the cached
+    keys and values of the positions before them.  Cost does not depend on `config.max_length`, so sequences can be
+    decoded one token at a time.
+    :param X: A tensor of token indexes with shape [batch_size, n_new, 2].
+    :param past: The keys and values of the previous positions at every layer with shape
+        [batch_size, n_layer, 2, n_heads, n_past, n_embed // n_heads].  Use a n_past of 0 to start a sequence.
+    :param encoder: A TextEncoder object.
+    :param config: A config object.
+    :return: A dict containing:
+        logits: The un-normalised log-probabilities over the next word, predicted from the last position of X.
+        present: The keys and values of the positions of X, to be appended to `past` on the next step.
+    """
+    with tf.variable_scope('model/featurizer', reuse=tf.AUTO_REUSE):
+        embed_weights = tf.get_variable("we", [encoder.vocab_size + config.max_length, config.n_embed])
+        h = embed(X, embed_weights)
+        presents = []
+        for layer, layer_past in enumerate(tf.unstack(past, num=config.n_layer, axis=1)):
+            with tf.variable_scope('h%d_' % layer):
+                h, present = block(h, n_head=config.n_heads, act_fn=config.act_fn, resid_pdrop=config.resid_p_drop,
+                                   attn_pdrop=config.attn_p_drop, scope='h%d' % layer, train=False, scale=True,
+                                   past=layer_past)
+            presents.append(present)
 
+    with tf.variable_scope('model/language-model'):
+        lm_logits = tf.matmul(h[:, -1], embed_weights, transpose_b=True)  # tied weights
+    return {
+        'logits': lm_logits,
+        'present': tf.stack(presents, axis=1)
+    }
 
-def language_model(*, X, M, embed_weights, hidden, config, reuse=None):
+
+def chunked_logsumexp(h, weights, chunk_size):
+    """
+    Computes `log(sum(exp(h @ weights^T), -1))` over chunks of `chunk_size` rows of weights at a time, so that the
+    full matrix of logits is never materialised.  The gradient recomputes the logits of each chunk rather than
+    storing them.
+    :param h: Hidden states with shape [n, embed_dim].
+    :param weights: Output weights with shape [n_outputs, embed_dim].
+    :param chunk_size: Number of rows of weights used per chunk.
+    :return: A tensor of shape [n].
+    """
+    n_chunks = -(-shape_list(weights)[0] // chunk_size)
+
+    def chunk_logits(h, weights, i):
+        w = weights[i * chunk_size: (i + 1) * chunk_size]
+        return w, tf.matmul(h, w, transpose_b=True)
+
+    @tf.custom_gradient
+    def logsumexp(h, weights):
+        def body(i, lse):
+            _, logits = chunk_logits(h, weights, i)
+            return i + 1, tf.reduce_logsumexp(tf.stack([lse, tf.reduce_logsumexp(logits, -1)], -1), -1)
+
+        _, lse = tf.while_loop(
+            cond=lambda i, lse: i < n_chunks,
+            body=body,
+            loop_vars=(tf.constant(0), tf.fill(shape_list(h)[:1], -float("inf"))),
+            back_prop=False
+        )
+
+        def grad(dy):
+            def grad_body(i, dh, dweights):
+                w, logits = chunk_logits(h, weights, i)
+                # d lse / d logits is the softmax over all chunks
+                dlogits = tf.exp(logits - tf.expand_dims(lse, -1)) * tf.expand_dims(dy, -1)
+                return i + 1, dh + tf.matmul(dlogits, w), dweights.write(i, tf.matmul(dlogits, h, transpose_a=True))
+
+            _, dh, dweights = tf.while_loop(
+                cond=lambda i, dh, dweights: i < n_chunks,
+                body=grad_body,
+                loop_vars=(
+                    tf.constant(0),
+                    tf.zeros_like(h),
+                    tf.TensorArray(weights.dtype, size=n_chunks, infer_shape=False)
+                ),
+                back_prop=False
+            )
+            return dh, dweights.concat()
+
+        return lse, grad
+
+    return logsumexp(h, weights)
+
+
+def language_model_log_likelihood(*, X, embed_weights, hidden, encoder, config):
+    """
+    The log-likelihood the language model assigns to each token of X given the tokens before it.  Logits are only
+    gathered for the target tokens and the normaliser is computed over chunks of `config.lm_vocab_chunk_size`
+    entries of the vocabulary.
+    :param X: The raw token ids fed to the featurizer.
+    :param embed_weights: The word embedding matrix, normally the one returned by the featurizer.
+    :param hidden: Output of the featurizer.
+    :param encoder: A TextEncoder object.
+    :param config: A config object.
+    :return: A tensor of shape [batch_size, sequence_length - 1] with the log-likelihood of tokens 1 onwards.
+    """
+    X = merge_leading_dims(X, 3)
+    hidden = merge_leading_dims(hidden, 3)
+
+    with tf.variable_scope('model/language-model'):
+        lm_h = tf.reshape(hidden[:, :-1], [-1, config.n_embed])
+        targets = tf.reshape(X[:, 1:, 0], [-1])
+        target_logits = tf.reduce_sum(lm_h * tf.gather(embed_weights, targets), -1)
+        # positional embeddings share the matrix but are never predicted
+        lse = chunked_logsumexp(lm_h, embed_weights[:encoder.vocab_size], config.get("lm_vocab_chunk_size", 8192))
+        return tf.reshape(target_logits - lse, [shape_list(X)[0], shape_list(X)[1] - 1])
+
+
+def language_model(*, X, M, embed_weights, hidden, config, train=False, reuse=None):
     """
     A language model output and loss for the language modelling objective described in the original finetune paper.
     This language model uses weights that are tied to the input embedding.
@@ -94,6 +402,7 @@ def language_model(*, X, M, embed_weights, hidden, config, reuse=None):
     :param embed_weights: The word embedding matrix, normally the one returned by the featurizer.
     :param hidden: Output of the featurizer.
     :param config: A config object.
+    :param train: If this flag is true, the loss is computed as set by `config.lm_loss_softmax`.
     :param reuse: A Flag passed through to the tf.variable_scope context manager.
     :return: A dict containing:
         logits: The un-normalised log-probabilities over each word in the vocabulary.
@@ -109,10 +418,31 @@ def language_model(*, X, M, embed_weights, hidden, config, reuse=None):
         sliced_hidden = hidden[:, :-1]
         lm_h = tf.reshape(sliced_hidden, [-1, config.n_embed])  # [batch, seq_len, embed] --> [batch * seq_len, embed]
         lm_logits = tf.matmul(lm_h, embed_weights, transpose_b=True)  # tied weights
-        lm_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
-            logits=lm_logits,
-            labels=tf.reshape(X[:, 1:, 0], [-1])
-        )
+        targets = tf.reshape(X[:, 1:, 0], [-1])
+        # the rows after the vocabulary hold positional embeddings, which are never predicted
+        vocab_weights = embed_weights[:shape_list(embed_weights)[0] - config.max_length]
+        lm_loss_softmax = config.get("lm_loss_softmax", "full") if train else "full"
+        if lm_loss_softmax == "sampled":
+            lm_losses = tf.nn.sampled_softmax_loss(
+                weights=vocab_weights,
+                biases=tf.zeros(shape_list(vocab_weights)[:1]),
+                labels=tf.expand_dims(tf.to_int64(targets), -1),
+                inputs=lm_h,
+                num_sampled=config.lm_num_sampled,
+                num_classes=shape_list(vocab_weights)[0]
+            )
+        elif lm_loss_softmax == "chunked":
+            target_logits = tf.reduce_sum(lm_h * tf.gather(vocab_weights, targets), -1)
+            lm_losses = chunked_logsumexp(lm_h, vocab_weights, config.lm_vocab_chunk_size) - target_logits
+        elif lm_loss_softmax == "full":
+            lm_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                logits=lm_logits,
+                labels=targets
+            )
+        else:
+            raise FinetuneError("Unknown lm_loss_softmax {!r}, expected one of 'full', 'sampled' or 'chunked'.".format(
+                lm_loss_softmax
+            ))
 
         lm_losses = tf.reshape(lm_losses, [shape_list(X)[0], shape_list(X)[1] - 1])
 
@@ -170,15 +500,29 @@ def classifier(hidden, targets, n_targets, config, train=False, reuse=None, **kw
         }
 
 
-def multi_choice_question(hidden, targets, n_targets, config, train=False, reuse=None, **kwargs):
+def multi_choice_question(hidden, targets, config, answer_mask=None, train=False, reuse=None, **kwargs):
+    """
+    Scores each answer to a question and normalises over the answers.
+
+    :param hidden: The output of the featurizer for each answer. [batch_size, n_answers, embed_dim]
+    :param targets: The index of the correct answer to each question. [batch_size]
+    :param config: A config object, containing all parameters for the featurizer.
+    :param answer_mask: Optional. 1 for the answers of each question and 0 for padding. [batch_size, n_answers]
+    :param train: If this flag is true, dropout and losses are added to the graph.
+    :param reuse: Should reuse be set within this scope.
+    :param kwargs: Spare arguments.
+    :return: dict containing:
+        logits: The unnormalised log probabilities of each answer, -1e9 for padding.
+        losses: The loss for the classifier.
+    """
     with tf.variable_scope("model", reuse=reuse):
         hidden = dropout(hidden, config.clf_p_drop, train)
-        hidden = tf.unstack(hidden, num=n_targets, axis=1)
-        hidden = tf.concat(hidden, axis=0)
+        hidden_shape = shape_list(hidden)
 
-        clf_out = perceptron(hidden, 1, config)
-        clf_out = tf.split(clf_out, n_targets, axis=0)
-        clf_out = tf.concat(clf_out, 1)
+        clf_out = perceptron(tf.reshape(hidden, [-1, config.n_embed]), 1, config)
+        clf_out = tf.reshape(clf_out, hidden_shape[:-1])
+        if answer_mask is not None:
+            clf_out = clf_out * answer_mask + -1e9 * (1 - answer_mask)
 
         if targets is None:
             clf_losses = None
@@ -289,17 +633,29 @@ def sequence_labeler(hidden, targets, n_targets, config, pad_id, multilabel=Fals
     """
     with tf.variable_scope('sequence-labeler', reuse=reuse):
         nx = config.n_embed
+        # the labeler is planned as a head on top of the trained layers of the featurizer
+        recompute = None
+        if train:
+            recompute = recompute_plan(
+                config,
+                range(config.n_layer - config.num_layers_trained, config.n_layer),
+                batch_size=config.batch_size,
+                head_mb=functools.partial(sequence_labeler_activation_mb, config, config.batch_size, n_targets)
+            )["head"]
+
         def seq_lab_internal(hidden):
             attn_fn = functools.partial(attn, scope="seq_label_attn", n_state=nx, n_head=config.seq_num_heads,
                                             resid_pdrop=config.resid_p_drop, attn_pdrop=config.attn_p_drop,
                                             train=train, scale=False, mask=False)
+            if recompute == "attention":
+                attn_fn = recompute_grad(attn_fn, use_entire_scope=True)
             n = norm(attn_fn(hidden) + hidden, 'seq_label_residual')
             flat_logits = tf.layers.dense(n, n_targets)
             logits = tf.reshape(flat_logits, tf.concat([tf.shape(hidden)[:2], [n_targets]], 0))
             return logits
 
         with tf.variable_scope('seq_lab_attn'):
-            if config.low_memory_mode and train:
+            if recompute == "block":
                 seq_lab_internal = recompute_grad(seq_lab_internal, use_entire_scope=True)
             logits = seq_lab_internal(hidden)
 
@@ -309,22 +665,21 @@ def sequence_labeler(hidden, targets, n_targets, config, pad_id, multilabel=Fals
 
         log_likelihood = 0.0
         if multilabel:
-            transition_params = []
-            logits_individual = tf.unstack(logits, n_targets, axis=-1)
-            if targets is not None:
-                targets_individual = tf.unstack(targets, n_targets, axis=-1)
-            logits = []
-            for i in range(n_targets):
-                transition_params.append(tf.get_variable("Transition_matrix_{}".format(i), shape=[2, 2]))
-                logits.append(tf.stack((logits_individual[pad_id], logits_individual[i]), axis=-1))
-                if targets is not None and train and i != pad_id:
-                    log_likelihood += crf_log_likelihood(
-                        logits[-1],
-                        targets_individual[i],
-                        kwargs.get('max_length') * tf.ones(tf.shape(targets)[0]),
-                        transition_params=transition_params[-1]
-                    )[0]
-            logits = tf.stack(logits, axis=-1)
+            # one binary CRF per label, scoring the label against the pad class, computed together as a batch over
+            # labels.  Variables are kept per label so that existing checkpoints still load.
+            transition_params = tf.stack(
+                [tf.get_variable("Transition_matrix_{}".format(i), shape=[2, 2]) for i in range(n_targets)]
+            )
+            pad_logits = tf.tile(logits[:, :, pad_id:pad_id + 1], [1, 1, n_targets])
+            logits = tf.stack((pad_logits, logits), axis=2)
+            if targets is not None and train:
+                label_log_likelihood = batched_crf_log_likelihood(
+                    tf.transpose(logits, [0, 3, 1, 2]),
+                    tf.transpose(targets, [0, 2, 1]),
+                    transition_params
+                )
+                not_pad = tf.cast(tf.not_equal(tf.range(n_targets), pad_id), label_log_likelihood.dtype)
+                log_likelihood = tf.reduce_sum(label_log_likelihood * not_pad, axis=1)
         else:
             transition_params = tf.get_variable("Transition_matrix", shape=[n_targets, n_targets])
             if train and targets is not None:
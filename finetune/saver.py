@@ -1,6 +1,5 @@
 import os
 from concurrent.futures import ThreadPoolExecutor
-import itertools
 import logging
 
 import joblib
@@ -59,12 +58,13 @@ class SaverHook(_StopOnPredicateHook):
 
 
 class Saver:
-    def __init__(self, fallback_filename, exclude_matches=None, variable_transforms=None, save_dtype=None):
+    def __init__(self, fallback_filename, exclude_matches=None, variable_transforms=None, save_dtype=None,
+                 mmap_mode=None):
         self.variable_transforms = variable_transforms or []
         self.fallback_filename = fallback_filename
         self.exclude_matches = exclude_matches
         self.tpe = ThreadPoolExecutor()
-        self.fallback_future = self.tpe.submit(joblib.load, fallback_filename)
+        self.fallback_future = self.tpe.submit(joblib.load, fallback_filename, mmap_mode=mmap_mode)
         self.variables = None
         self.save_dtype = save_dtype
         self.fallback_ = None
@@ -104,8 +104,8 @@ class Saver:
         assert len(vals_reduced) == len(var_names_reduced) == len(var_dict)
         joblib.dump((var_dict, finetune_obj), path)
 
-    def load(self, path):
-        self.variables, finetune_obj = joblib.load(path)
+    def load(self, path, mmap_mode=None):
+        self.variables, finetune_obj = joblib.load(path, mmap_mode=mmap_mode)
         return finetune_obj
 
     def get_scaffold_init_op(self):
@@ -115,11 +115,6 @@ class Saver:
         """
         _get_or_create_stop_var()  # TODO(BEN): This is currently required to force the stop var to get initialized.
 
-        if self.variables is not None:
-            variables_sv = self.variables
-        else:
-            variables_sv = dict()
-
         if tf.contrib.distribute.get_tower_context():
             def assign(var, val):
                 def update(var_):
@@ -138,22 +133,29 @@ class Saver:
         init_vals = []
         default_init = []
         for var in all_vars:
-            var_init = None
-            for saved_var_name, saved_var in itertools.chain(variables_sv.items(), self.fallback.items()):
-                if saved_var_name == var.name:
-                    var_init = (var, saved_var)
-                    break
-
-            if var_init is None:
+            saved_var = self.get_saved_value(var.name)
+            if saved_var is None:
                 default_init.append(var)
             else:
-                var, saved_var = var_init
-                for func in self.variable_transforms:
-                    saved_var = func(var.name, saved_var)
                 init_vals.append(assign(var, saved_var))
         init_vals.append(tf.variables_initializer(default_init))
         return tf.group(init_vals)
 
+    def get_saved_value(self, name):
+        """
+        Returns the value a variable called `name` is restored to, taken from the saved variables if present and the
+        fallback otherwise, with `variable_transforms` applied.  Returns None if neither holds the variable.
+        """
+        if self.variables is not None and name in self.variables:
+            saved_var = self.variables[name]
+        elif name in self.fallback:
+            saved_var = self.fallback[name]
+        else:
+            return None
+        for func in self.variable_transforms:
+            saved_var = func(name, saved_var)
+        return saved_var
+
     def remove_unchanged(self, variable_names, variable_values, fallback_vars):
         skips = []
         for var_val, var_name in zip(variable_values, variable_names):
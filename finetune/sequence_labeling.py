@@ -11,10 +11,108 @@ from finetune.target_encoders import SequenceLabelingEncoder, SequenceMultiLabel
 from finetune.network_modules import sequence_labeler
 from finetune.crf import sequence_decode
 from finetune.utils import indico_to_finetune_sequence, finetune_to_indico_sequence
+from finetune.encoding import tokenize
 from finetune.input_pipeline import BasePipeline, ENCODER
 from finetune.estimator_utils import ProgressHook
 
 
+def columnar_spans(raw_texts, doc_predictions, pad_idx, multi_label=False, subtoken_predictions=False):
+    """
+    Converts per-subtoken predictions to flat arrays of labeled character spans.
+
+    :param raw_texts: The raw text of each document.
+    :param doc_predictions: A (label_idxs, probas, char_locs) tuple of arrays per document, as returned by
+        :meth:`SequenceLabeler._stitch_chunks`. `char_locs` holds the character offset of the end of each subtoken.
+    :param pad_idx: The class index that marks unlabeled text.
+    :param multi_label: True if `label_idxs` is a [n_subtokens, n_classes] indicator array.
+    :param subtoken_predictions: If False, span boundaries are rounded out to the nearest full token.
+    :return: dict of arrays with one entry per span: doc_idx, start, end, label_idx, confidence.
+    """
+    doc_idxs, starts, ends, span_labels, confidences, n_subtokens = [], [], [], [], [], []
+    for doc_idx, (label_idxs, probas, char_locs) in enumerate(doc_predictions):
+        if multi_label:
+            indicators = label_idxs.astype(np.int8)
+        else:
+            indicators = np.zeros([len(label_idxs), probas.shape[1]], dtype=np.int8)
+            indicators[np.arange(len(label_idxs)), label_idxs] = 1
+        indicators[:, pad_idx] = 0
+
+        # runs of consecutive subtokens assigned to the same class
+        edges = np.diff(np.pad(indicators, [(1, 1), (0, 0)], mode='constant'), axis=0)
+        run_labels, run_starts = np.nonzero(edges.T == 1)
+        _, run_ends = np.nonzero(edges.T == -1)
+
+        token_starts = np.concatenate([[0], char_locs[:-1]])
+        cumulative_probas = np.concatenate([np.zeros([1, probas.shape[1]]), np.cumsum(probas, axis=0)])
+        run_lengths = run_ends - run_starts
+
+        text = raw_texts[doc_idx]
+        span_starts = token_starts[run_starts]
+        span_ends = char_locs[run_ends - 1]
+        for i in range(len(span_starts)):
+            start, end = span_starts[i], span_ends[i]
+            while start < end and text[start].isspace():
+                start += 1
+            while end > start and text[end - 1].isspace():
+                end -= 1
+            span_starts[i], span_ends[i] = start, end
+
+        if not subtoken_predictions and len(span_starts):
+            tokens = tokenize(text)
+            token_char_starts = np.asarray(tokens.starts)
+            token_char_ends = np.asarray(tokens.ends)
+            start_token = np.maximum(np.searchsorted(token_char_starts, span_starts, side='right') - 1, 0)
+            end_token = np.minimum(np.searchsorted(token_char_ends, span_ends, side='left'), len(token_char_ends) - 1)
+            span_starts = np.minimum(token_char_starts[start_token], span_starts)
+            span_ends = np.maximum(token_char_ends[end_token], span_ends)
+
+        doc_idxs.append(np.full(len(run_labels), doc_idx))
+        starts.append(span_starts)
+        ends.append(span_ends)
+        span_labels.append(run_labels)
+        confidences.append((cumulative_probas[run_ends] - cumulative_probas[run_starts]) / run_lengths[:, None])
+        n_subtokens.append(run_lengths)
+
+    n_classes = doc_predictions[0][1].shape[1] if doc_predictions else 0
+    doc_idxs, starts, ends, span_labels, n_subtokens = (
+        np.concatenate(field).astype(np.int64) if field else np.zeros([0], dtype=np.int64)
+        for field in (doc_idxs, starts, ends, span_labels, n_subtokens)
+    )
+    confidences = np.concatenate(confidences) if confidences else np.zeros([0, n_classes])
+
+    # merge spans of the same class that are adjacent or separated by a single character
+    order = np.lexsort((starts, span_labels, doc_idxs))
+    doc_idxs, starts, ends, span_labels, n_subtokens, confidences = (
+        field[order] for field in (doc_idxs, starts, ends, span_labels, n_subtokens, confidences)
+    )
+    new_span = np.ones(len(starts), dtype=bool)
+    new_span[1:] = (
+        (doc_idxs[1:] != doc_idxs[:-1]) |
+        (span_labels[1:] != span_labels[:-1]) |
+        (starts[1:] - ends[:-1] > 1)
+    )
+    span_ids = np.cumsum(new_span) - 1
+    first = np.flatnonzero(new_span)
+    merged_ends = np.zeros(len(first), dtype=np.int64)
+    np.maximum.at(merged_ends, span_ids, ends)
+    weights = np.zeros(len(first))
+    np.add.at(weights, span_ids, n_subtokens)
+    merged_confidences = np.zeros([len(first), n_classes])
+    np.add.at(merged_confidences, span_ids, confidences * n_subtokens[:, None])
+    merged_confidences /= np.maximum(weights, 1)[:, None]
+
+    merged = {
+        'doc_idx': doc_idxs[first],
+        'start': starts[first],
+        'end': merged_ends,
+        'label_idx': span_labels[first],
+        'confidence': merged_confidences.astype(np.float32),
+    }
+    order = np.lexsort((merged['label_idx'], merged['start'], merged['doc_idx']))
+    non_empty = merged['end'][order] > merged['start'][order]
+    return {key: value[order][non_empty] for key, value in merged.items()}
+
+
 class SequencePipeline(BasePipeline):
     def __init__(self, config, multi_label):
         super(SequencePipeline, self).__init__(config)
@@ -99,105 +197,75 @@ class SequenceLabeler(BaseModel):
     def _get_input_pipeline(self):
         return SequencePipeline(config=self.config, multi_label=self.config.multi_label_sequences)
 
-    def _initialize(self):
+    def _initialize_state(self):
         self.multi_label = self.config.multi_label_sequences
-        return super()._initialize()
+        super()._initialize_state()
 
     def finetune(self, Xs, Y=None, batch_size=None):
         Xs, Y_new = indico_to_finetune_sequence(Xs, labels=Y, multi_label=self.multi_label, none_value="<PAD>")
         Y = Y_new if Y is not None else None
         return super().finetune(Xs, Y=Y, batch_size=batch_size)
 
-    def _inference(self, Xs, mode=None):
-        Xs = [[x] for x in Xs]
-        return super()._inference(Xs, mode=mode)
+    def _inference(self, Xs, mode=None, encoded=False):
+        if not encoded:
+            Xs = [[x] for x in Xs]
+        return super()._inference(Xs, mode=mode, encoded=encoded)
 
-    def predict(self, X):
+    def predict(self, X, as_array=False):
         """
         Produces a list of most likely class labels as determined by the fine-tuned model.
 
         :param X: A list / array of text, shape [batch]
-        :returns: list of class labels.
+        :param as_array: If True, return predicted spans as flat arrays rather than as lists of dictionaries.
+            Adjacent spans of the same class are merged, and confidences are averaged over the subtokens of each span.
+        :returns: list of class labels.  If `as_array=True`, a dictionary of arrays with one entry per predicted span:
+            `doc_idx`, `start`, `end`, `label_idx` (an index into `classes_`) and `confidence` of shape
+            [n_spans, n_classes].
         """
-        chunk_size = self.config.max_length - 2
-        step_size = chunk_size // 3
         arr_encoded = list(itertools.chain.from_iterable(self.input_pipeline._text_to_ids([x]) for x in X))
-        labels, batch_probas = [], []
-        for pred in self._inference(X, mode=None):
-            labels.append(self.input_pipeline.label_encoder.inverse_transform(pred[PredictMode.NORMAL]))
-            batch_probas.append(pred[PredictMode.PROBAS])
+        predictions = self._inference(arr_encoded, mode=[PredictMode.NORMAL, PredictMode.PROBAS], encoded=True)
+        doc_predictions = self._stitch_chunks(arr_encoded, predictions)
+        if as_array:
+            return columnar_spans(
+                raw_texts=X,
+                doc_predictions=doc_predictions,
+                pad_idx=self.input_pipeline.pad_idx,
+                multi_label=self.multi_label,
+                subtoken_predictions=self.config.subtoken_predictions
+            )
 
+        classes = self.input_pipeline.label_encoder.classes_
         all_subseqs = []
         all_labels = []
         all_probs = []
+        for text, (label_idxs, probas, char_locs) in zip(X, doc_predictions):
+            if not len(label_idxs):
+                all_subseqs.append([])
+                all_labels.append([])
+                all_probs.append([])
+                continue
+
+            # runs of consecutive subtokens with the same prediction
+            changed = label_idxs[1:] != label_idxs[:-1]
+            if self.multi_label:
+                changed = changed.any(axis=-1)
+            run_starts = np.flatnonzero(np.concatenate([[True], changed]))
+            run_lengths = np.diff(np.append(run_starts, len(label_idxs)))
+
+            # each run spans from the end of the previous subtoken to the end of its own last subtoken
+            prev_char_locs = np.concatenate([[0], char_locs[:-1]])
+            span_starts = prev_char_locs[run_starts]
+            span_ends = char_locs[run_starts + run_lengths - 1]
+            all_subseqs.append([text[start:end] for start, end in zip(span_starts, span_ends)])
+            all_labels.append(list(self.input_pipeline.label_encoder.inverse_transform(label_idxs[run_starts])))
+
+            mean_probas = np.add.reduceat(probas, run_starts, axis=0) / run_lengths[:, None]
+            prob_dicts = [dict(zip(classes, probs)) for probs in mean_probas]
+            if self.multi_label:
+                for prob_dict in prob_dicts:
+                    del prob_dict[self.config.pad_token]
+            all_probs.append(prob_dicts)
 
-        doc_idx = -1
-        for chunk_idx, (label_seq, proba_seq) in enumerate(zip(labels, batch_probas)):
-
-            position_seq = arr_encoded[chunk_idx].char_locs
-            start_of_doc = arr_encoded[chunk_idx].token_ids[0][0] == ENCODER.start
-            end_of_doc = (
-                    chunk_idx + 1 >= len(arr_encoded) or
-                    arr_encoded[chunk_idx + 1].token_ids[0][0] == ENCODER.start
-            )
-            """
-            Chunk idx for prediction.  Dividers at `step_size` increments.
-            [  1  |  1  |  2  |  3  |  3  ]
-            """
-            start, end = 0, None
-            if start_of_doc:
-                # if this is the first chunk in a document, start accumulating from scratch
-                doc_subseqs = []
-                doc_labels = []
-                doc_probs = []
-                doc_idx += 1
-                start_of_token = 0
-                if not end_of_doc:
-                    end = step_size * 2
-            else:
-                if end_of_doc:
-                    # predict on the rest of sequence
-                    start = step_size
-                else:
-                    # predict only on middle third
-                    start, end = step_size, step_size * 2
-            
-            label_seq = label_seq[start:end]
-            position_seq = position_seq[start:end]
-            proba_seq = proba_seq[start:end]
-
-            for label, position, proba in zip(label_seq, position_seq, proba_seq):
-                if position == -1:
-                    # indicates padding / special tokens
-                    continue
-
-                # if there are no current subsequence
-                # or the current subsequence has the wrong label
-                if not doc_subseqs or label != doc_labels[-1]:
-                    # start new subsequence
-                    doc_subseqs.append(X[doc_idx][start_of_token:position])
-                    doc_labels.append(label)
-                    doc_probs.append([proba])
-                else:
-                    # continue appending to current subsequence
-                    doc_subseqs[-1] += X[doc_idx][start_of_token:position]
-                    doc_probs[-1].append(proba)
-
-                start_of_token = position
-
-            if end_of_doc:
-                # last chunk in a document
-                prob_dicts = []
-                for prob_seq in doc_probs:
-                    # format probabilities as dictionary
-                    probs = np.mean(np.vstack(prob_seq), axis=0)
-                    prob_dicts.append(dict(zip(self.input_pipeline.label_encoder.classes_, probs)))
-                    if self.multi_label:
-                        del prob_dicts[-1][self.config.pad_token]
-
-                all_subseqs.append(doc_subseqs)
-                all_labels.append(doc_labels)
-                all_probs.append(prob_dicts)
         _, doc_annotations = finetune_to_indico_sequence(
             raw_texts=X,
             subseqs=all_subseqs,
@@ -208,6 +276,48 @@ class SequenceLabeler(BaseModel):
 
         return doc_annotations
 
+    def _stitch_chunks(self, arr_encoded, predictions):
+        """
+        Joins the predictions for each chunk of a document, keeping the prediction from a single chunk for each
+        subtoken and dropping special tokens.
+
+        :returns: A list with one (label_idxs, probas, char_locs) tuple of arrays per document.
+        """
+        _, stride, context = self.input_pipeline.chunk_params()
+        docs = []
+        for chunk_idx, (encoded, pred) in enumerate(zip(arr_encoded, predictions)):
+            start_of_doc = encoded.token_ids[0][0] == ENCODER.start
+            end_of_doc = (
+                chunk_idx + 1 >= len(arr_encoded) or
+                arr_encoded[chunk_idx + 1].token_ids[0][0] == ENCODER.start
+            )
+            start, end = 0, None
+            if start_of_doc:
+                doc_chunks = []
+                if not end_of_doc:
+                    end = context + stride
+            elif end_of_doc:
+                start = context
+            else:
+                start, end = context, context + stride
+
+            seq_length = len(encoded.char_locs)
+            doc_chunks.append((
+                pred[PredictMode.NORMAL][:seq_length][start:end],
+                pred[PredictMode.PROBAS][:seq_length][start:end],
+                np.asarray(encoded.char_locs, dtype=np.int64)[start:end]
+            ))
+
+            if end_of_doc:
+                label_idxs, probas, char_locs = (np.concatenate(field) for field in zip(*doc_chunks))
+                not_special = char_locs != -1
+                docs.append((
+                    label_idxs[not_special],
+                    probas.reshape(len(probas), -1)[not_special],
+                    char_locs[not_special]
+                ))
+        return docs
+
     def featurize(self, X):
         """
         Embeds inputs in learned feature space. Can be called before or after calling :meth:`finetune`.
@@ -242,15 +352,10 @@ class SequenceLabeler(BaseModel):
     def _predict_op(self, logits, **kwargs):
         trans_mats = kwargs.get("transition_matrix")
         if self.multi_label:
-            logits = tf.unstack(logits, axis=-1)
-            label_idxs = []
-            label_probas = []
-            for logits_i, trans_mat_i in zip(logits, trans_mats):
-                idx, prob = sequence_decode(logits_i, trans_mat_i)
-                label_idxs.append(idx)
-                label_probas.append(prob[:, :, 1:])
-            label_idxs = tf.stack(label_idxs, axis=-1)
-            label_probas = tf.stack(label_probas, axis=-1)
+            # decode the binary CRF of every label at once: [batch, labels, seq, 2] with [labels, 2, 2] transitions
+            label_idxs, label_probas = sequence_decode(tf.transpose(logits, [0, 3, 1, 2]), trans_mats)
+            label_idxs = tf.transpose(label_idxs, [0, 2, 1])
+            label_probas = tf.transpose(label_probas[:, :, :, 1:], [0, 2, 3, 1])
         else:
             label_idxs, label_probas = sequence_decode(logits, trans_mats)
         return label_idxs, label_probas
@@ -0,0 +1,294 @@
+"""
+Serve a loaded model to many concurrent clients, grouping single-document requests into micro-batches.
+
+Usage:
+    python -m finetune.serving path/to/saved-model --port 8000 --max-batch-size 32 --max-latency-ms 10
+
+Endpoints:
+    POST /<method>   JSON body of {"texts": [...]} or {"text": "..."}, where <method> is `predict`, `predict_proba`
+                     or `featurize`.
+    GET /metrics     Latency percentiles, batch sizes and queue depth of each method.
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+
+from finetune.errors import FinetuneError
+
+LOGGER = logging.getLogger('finetune')
+
+_Request = collections.namedtuple("_Request", ["x", "future", "enqueued"])
+
+
+@contextlib.contextmanager
+def _default_batch_size(batch_size):
+    yield
+
+
+class BatchingPredictor:
+    """
+    Queues requests for a single document and runs them through a model method in micro-batches.
+
+    A batch is run once it holds `max_batch_size` documents, or `max_latency_ms` after its first request was queued,
+    whichever comes first.
+
+    :param model: A loaded finetune model.
+    :param method: Name of the model method to call on each batch, e.g. `predict`, `predict_proba` or `featurize`.
+        The method must accept a list of documents and return one result per document, otherwise every request of
+        the batch fails.
+    :param max_batch_size: Maximum number of documents per batch.
+    :param max_latency_ms: Maximum time a request waits in the queue for its batch to fill.
+    :param n_workers: Number of threads forming and running batches.  Batches from different workers run
+        concurrently on the model's shared session.
+    :param metrics_window: Number of most recent requests used to compute latency percentiles.
+    """
+
+    def __init__(self, model, method="predict", max_batch_size=32, max_latency_ms=10, n_workers=1,
+                 metrics_window=10000):
+        self.model = model
+        self.method = method
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.
+        self.queue = queue.Queue()
+        self.latencies = collections.deque(maxlen=metrics_window)
+        self.batch_sizes = collections.deque(maxlen=metrics_window)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.metrics_lock = threading.Lock()
+        self.closed = threading.Event()
+
+        # runs each micro-batch through the model in a single session call, without modifying its config
+        self._batch_size_context = getattr(model, "inference_batch_size", _default_batch_size)
+
+        self.workers = [
+            threading.Thread(target=self._worker, name="finetune-batching-{}".format(i), daemon=True)
+            for i in range(n_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, x):
+        """
+        Queues a single document.
+
+        :param x: A single document, in the format expected by one entry of the model method's input.
+        :returns: A `concurrent.futures.Future` that resolves to the result for `x`.
+        """
+        if self.closed.is_set():
+            raise FinetuneError("Cannot submit requests to a closed BatchingPredictor.")
+        future = Future()
+        self.queue.put(_Request(x=x, future=future, enqueued=time.perf_counter()))
+        return future
+
+    def predict(self, x, timeout=None):
+        """
+        Blocking prediction for a single document.
+        """
+        return self.submit(x).result(timeout=timeout)
+
+    async def predict_async(self, x):
+        """
+        Prediction for a single document that can be awaited from an asyncio event loop.
+        """
+        return await asyncio.wrap_future(self.submit(x))
+
+    def _next_batch(self):
+        try:
+            first = self.queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first.enqueued + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        method = getattr(self.model, self.method)
+        while not (self.closed.is_set() and self.queue.empty()):
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                with self._batch_size_context(self.max_batch_size):
+                    results = list(method([request.x for request in batch]))
+                if len(results) != len(batch):
+                    raise FinetuneError("`{}` returned {} results for a batch of {} requests.".format(
+                        self.method, len(results), len(batch)
+                    ))
+                for request, result in zip(batch, results):
+                    request.future.set_result(result)
+                errored = False
+            except Exception as e:
+                LOGGER.exception("Batch of {} requests failed.".format(len(batch)))
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                errored = True
+
+            finished = time.perf_counter()
+            with self.metrics_lock:
+                self.n_requests += len(batch)
+                self.n_errors += len(batch) if errored else 0
+                self.batch_sizes.append(len(batch))
+                self.latencies.extend(finished - request.enqueued for request in batch)
+
+    def metrics(self):
+        """
+        Summary of recent serving performance.
+
+        :returns: A dict containing the current queue depth, the number of requests served and failed, the mean
+            batch size and the p50 / p90 / p99 request latencies in milliseconds (from queueing to result).
+        """
+        with self.metrics_lock:
+            latencies = np.asarray(self.latencies) * 1000.
+            batch_sizes = list(self.batch_sizes)
+            n_requests, n_errors = self.n_requests, self.n_errors
+
+        percentiles = [50, 90, 99]
+        if len(latencies):
+            latency_percentiles = np.percentile(latencies, percentiles)
+        else:
+            latency_percentiles = [None] * len(percentiles)
+        return {
+            "queue_depth": self.queue.qsize(),
+            "requests": n_requests,
+            "errors": n_errors,
+            "mean_batch_size": float(np.mean(batch_sizes)) if batch_sizes else None,
+            "latency_ms": {
+                "p{}".format(p): (float(value) if value is not None else None)
+                for p, value in zip(percentiles, latency_percentiles)
+            },
+        }
+
+    def close(self, timeout=None):
+        """
+        Stops accepting requests and waits for queued requests to be served.
+        """
+        self.closed.set()
+        for worker in self.workers:
+            worker.join(timeout=timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def make_server(model, host="127.0.0.1", port=8000, methods=("predict", "predict_proba", "featurize"), **kwargs):
+    """
+    Builds an HTTP server with one :py:class:`BatchingPredictor` per model method.
+
+    :param model: A loaded finetune model.
+    :param host: Interface to bind to.
+    :param port: Port to bind to.  Use 0 to pick a free port.
+    :param methods: Model methods to expose, each at `POST /<method>`.
+    :param kwargs: Passed to each :py:class:`BatchingPredictor`.
+    :returns: A threading `HTTPServer`.  Call `serve_forever()` to start serving and `server_close()` to stop.
+    """
+    predictors = {method: BatchingPredictor(model, method=method, **kwargs) for method in methods}
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _respond(self, status, body):
+            payload = json.dumps(body, default=_json_default).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                return self._respond(404, {"error": "Unknown path {}".format(self.path)})
+            self._respond(200, {method: predictor.metrics() for method, predictor in predictors.items()})
+
+        def do_POST(self):
+            predictor = predictors.get(self.path.strip("/"))
+            if predictor is None:
+                return self._respond(404, {"error": "Unknown path {}".format(self.path)})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+                single = "text" in body
+                texts = [body["text"]] if single else body["texts"]
+            except (ValueError, KeyError, TypeError):
+                return self._respond(400, {"error": 'Expected a JSON body of {"text": ...} or {"texts": [...]}'})
+            try:
+                results = [future.result() for future in [predictor.submit(text) for text in texts]]
+            except Exception as e:
+                return self._respond(500, {"error": str(e)})
+            self._respond(200, {"result": results[0]} if single else {"results": results})
+
+        def log_message(self, format, *args):
+            LOGGER.debug(format % args)
+
+    class BatchingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+        def server_close(self):
+            super().server_close()
+            for predictor in predictors.values():
+                predictor.close()
+
+    server = BatchingHTTPServer((host, port), Handler)
+    server.predictors = predictors
+    return server
+
+
+def main(argv=None):
+    from finetune.base import BaseModel
+
+    parser = argparse.ArgumentParser(description="Serve a saved finetune model over HTTP.")
+    parser.add_argument("model_path", help="Path previously passed to `model.save`.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-latency-ms", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=1, help="Threads forming and running batches per method.")
+    args = parser.parse_args(argv)
+
+    model = BaseModel.load(args.model_path)
+    model.config.verbose = False
+    server = make_server(
+        model,
+        host=args.host,
+        port=args.port,
+        max_batch_size=args.max_batch_size,
+        max_latency_ms=args.max_latency_ms,
+        n_workers=args.workers
+    )
+    LOGGER.info("Serving {} on http://{}:{}".format(args.model_path, *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
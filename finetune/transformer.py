@@ -1,8 +1,11 @@
+import functools
+
 import numpy as np
 import tensorflow as tf
 
 from finetune.utils import shape_list
 from finetune.activations import act_fns
+from finetune.recompute_grads import recompute_grad
 
 
 def norm(x, scope, axis=[-1], e=1e-5):
@@ -24,9 +27,10 @@ def dropout(x, pdrop, train):
 
 
 def mask_attn_weights(w):
-    n = shape_list(w)[-1]
-    b = tf.matrix_band_part(tf.ones([n, n]), -1, 0)
-    b = tf.reshape(b, [1, 1, n, n])
+    # queries are the last `nd` of the `ns` positions that are attended to
+    nd, ns = shape_list(w)[-2:]
+    b = tf.matrix_band_part(tf.ones([nd, ns]), -1, ns - nd)
+    b = tf.reshape(b, [1, 1, nd, ns])
     w = w * b + -1e9 * (1 - b)
     return w
 
@@ -85,19 +89,31 @@ def conv1d(x, scope, nf, rf, w_init=tf.random_normal_initializer(stddev=0.02), b
         return c
 
 
-def attn(x, scope, n_state, n_head, resid_pdrop, attn_pdrop, train=False, scale=False, mask=True):
+def attn(x, scope, n_state, n_head, resid_pdrop, attn_pdrop, train=False, scale=False, mask=True, past=None):
+    """
+    :param past: Optional. The keys and values of the positions preceding x, with shape
+        [batch, 2, n_head, n_past, n_state // n_head].  When given, the keys and values of x are returned along with
+        the output so that they can be appended to `past` for the next call.
+    """
     assert n_state % n_head == 0
     with tf.variable_scope(scope):
         c = conv1d(x, 'c_attn', n_state * 3, 1, train=train)
         q, k, v = tf.split(c, 3, 2)
         q = split_heads(q, n_head)
-        k = split_heads(k, n_head, k=True)
-        v = split_heads(v, n_head)
+        if past is None:
+            k = split_heads(k, n_head, k=True)
+            v = split_heads(v, n_head)
+        else:
+            present = tf.stack([split_heads(k, n_head), split_heads(v, n_head)], axis=1)
+            k, v = tf.unstack(tf.concat([past, present], axis=-2), axis=1)
+            k = tf.transpose(k, [0, 1, 3, 2])
         a = _attn(q, k, v, attn_pdrop=attn_pdrop, train=train, scale=scale,
                   mask=mask)
         a = merge_heads(a)
         a = conv1d(a, 'c_proj', n_state, 1, train=train)
         a = dropout(a, resid_pdrop, train)
+        if past is not None:
+            return a, present
         return a
 
 
@@ -111,18 +127,33 @@ def mlp(x, scope, n_state, act_fn, resid_pdrop, train=False):
         return h2
 
 
-def block(x, n_head, act_fn, resid_pdrop, attn_pdrop, scope, train=False, scale=False):
+def block(x, n_head, act_fn, resid_pdrop, attn_pdrop, scope, train=False, scale=False, past=None,
+          recompute_attn=False):
+    """
+    :param recompute_attn: Recompute the attention sublayer on the backward pass rather than keeping its
+        activations, which hold the attention weights of every head.
+    """
     with tf.variable_scope(scope):
         nx = shape_list(x)[-1]
-        a = attn(x, 'attn', nx, n_head, resid_pdrop, attn_pdrop, train=train, scale=scale)
+        attn_fn = functools.partial(attn, scope='attn', n_state=nx, n_head=n_head, resid_pdrop=resid_pdrop,
+                                    attn_pdrop=attn_pdrop, train=train, scale=scale, past=past)
+        if recompute_attn:
+            attn_fn = recompute_grad(attn_fn, use_entire_scope=True)
+        a = attn_fn(x)
+        if past is not None:
+            a, present = a
         n = norm(x + a, 'ln_1')
         m = mlp(n, 'mlp', nx * 4, act_fn, resid_pdrop, train=train)
         h = norm(n + m, 'ln_2')
+        if past is not None:
+            return h, present
         return h
 
 
-def embed(X, we):
+def embed(X, we, pdrop=0., train=False):
     e = tf.gather(we, X)
+    # dropout on the gathered rows rather than on we keeps the gradient of we row-sparse
+    e = dropout(e, pdrop, train)
     #    h = add_timing_signal_1d(e[:, :, 0])
     h = tf.reduce_sum(e, 2)
     return h
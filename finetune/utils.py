@@ -1,10 +1,12 @@
 import os
+import bisect
+import itertools
 import warnings
 import numpy as np
 import tensorflow as tf
 from scipy import interpolate
 
-from finetune.encoding import NLP
+from finetune.encoding import tokenize
 from finetune import config
 
 def merge_leading_dims(X, target_rank):
@@ -76,23 +78,43 @@ def list_transpose(l):
     return [list(i) for i in zip(*l)]
 
 
+def pad_stack(arrays):
+    """
+    Stacks arrays along a new first axis, zero padding each of them to the largest size along every axis.
+    """
+    arrays = [np.asarray(array) for array in arrays]
+    shapes = {array.shape for array in arrays}
+    if len(shapes) == 1:
+        return np.stack(arrays)
+    shape = tuple(np.max(list(shapes), axis=0))
+    padded = np.zeros((len(arrays),) + shape, dtype=arrays[0].dtype)
+    for i, array in enumerate(arrays):
+        padded[(i,) + tuple(slice(0, dim) for dim in array.shape)] = array
+    return padded
+
+
 def sample_with_temperature(logits, temperature):
     """Either argmax or random sampling.
     Args:
       logits: a Tensor.
-      temperature: a float  0.0=argmax 1.0=random
+      temperature: a float  0.0=argmax 1.0=random, or a scalar Tensor, in which case the choice is made at run time.
     Returns:
       a Tensor with one fewer dimension than logits.
     """
     logits_shape = shape_list(logits)
+
+    def sample():
+        reshaped_logits = tf.reshape(logits, [-1, logits_shape[-1]]) / temperature
+        choices = tf.multinomial(reshaped_logits, 1)
+        return tf.reshape(choices, logits_shape[:-1])
+
+    if isinstance(temperature, tf.Tensor):
+        return tf.cond(temperature > 0.0, sample, lambda: tf.argmax(logits, axis=-1))
     if temperature == 0.0:
         return tf.argmax(logits, axis=-1)
     else:
         assert temperature > 0.0
-        reshaped_logits = tf.reshape(logits, [-1, logits_shape[-1]]) / temperature
-        choices = tf.multinomial(reshaped_logits, 1)
-        choices = tf.reshape(choices, logits_shape[:-1])
-        return choices
+        return sample()
 
 
 def truncate_text(text, max_chars=100):
@@ -101,6 +123,40 @@ def truncate_text(text, max_chars=100):
     return text
 
 
+class TokenBoundaries(object):
+    """
+    Sorted character offsets of the starts and ends of the spacy tokens of a document, used to round character spans
+    out to whole tokens with binary search.
+    """
+
+    def __init__(self, starts, ends, text_length):
+        self.starts = starts
+        self.ends = ends
+        self.text_length = text_length
+
+    @classmethod
+    def from_text(cls, text):
+        tokens = tokenize(text)
+        return cls(starts=tokens.starts, ends=tokens.ends, text_length=len(text))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def round_start(self, start):
+        """ The last token start at or before `start`, or 0 if there is none. """
+        if start <= 0:
+            return start
+        idx = bisect.bisect_right(self.starts, start) - 1
+        return self.starts[idx] if idx >= 0 else 0
+
+    def round_end(self, end):
+        """ The first token end at or after `end`, or the end of the text if there is none. """
+        if end >= self.text_length:
+            return end
+        idx = bisect.bisect_left(self.ends, end)
+        return self.ends[idx] if idx < len(self.ends) else self.text_length
+
+
 def finetune_to_indico_sequence(raw_texts, subseqs, labels, probs=None, none_value=config.PAD_TOKEN,
                                 subtoken_predictions=False):
     """
@@ -131,12 +187,10 @@ def finetune_to_indico_sequence(raw_texts, subseqs, labels, probs=None, none_val
     """
     annotations = []
     for raw_text, doc_seq, label_seq, prob_seq in zip(raw_texts, subseqs, labels, probs or [None] * len(raw_texts)):
-        tokens = NLP(raw_text)
-        token_starts = [token.idx for token in tokens]
-        token_ends = [token.idx + len(token.text) for token in tokens]
-        n_tokens = len(tokens)
-
-        doc_annotations = []
+        boundaries = None
+        # annotations of each label in the order they were added, to find the annotation a span should merge into
+        label_annotations = {}
+        annotation_order = itertools.count()
         annotation_ranges = set()
         start_idx = 0
         end_idx = 0
@@ -155,10 +209,11 @@ def finetune_to_indico_sequence(raw_texts, subseqs, labels, probs=None, none_val
 
                 raw_annotation_start = raw_text.find(stripped_text, raw_annotation_start)
                 raw_annotation_end = raw_annotation_start + len(stripped_text)
-                for i, item in enumerate(doc_annotations):
-                    if item["label"] == label and raw_annotation_start - item["end"] <= 1:
+                same_label = label_annotations.get(label, [])
+                for i, (_, item) in enumerate(same_label):
+                    if raw_annotation_start - item["end"] <= 1:
                         raw_annotation_start = item["start"]
-                        doc_annotations.pop(i)
+                        same_label.pop(i)
                         break
 
                 if raw_annotation_start == -1:
@@ -177,13 +232,16 @@ def finetune_to_indico_sequence(raw_texts, subseqs, labels, probs=None, none_val
                         start_idx = 0
                         end_idx = 0
                     if label != none_value:
+                        if boundaries is None:
+                            boundaries = TokenBoundaries.from_text(raw_text)
                         # round to nearest token
-                        while start_idx < n_tokens and annotation_start >= token_starts[start_idx]:
-                            start_idx += 1
-                        annotation_start = token_starts[start_idx - 1]
-                        while end_idx < (n_tokens - 1) and annotation_end > token_ends[end_idx]:
-                            end_idx += 1
-                        annotation_end = token_ends[end_idx]
+                        start_idx = max(start_idx, bisect.bisect_right(boundaries.starts, annotation_start))
+                        annotation_start = boundaries.starts[start_idx - 1]
+                        end_idx = max(
+                            end_idx,
+                            min(bisect.bisect_left(boundaries.ends, annotation_end), len(boundaries) - 1)
+                        )
+                        annotation_end = boundaries.ends[end_idx]
 
                 text = raw_text[annotation_start:annotation_end]
 
@@ -200,8 +258,12 @@ def finetune_to_indico_sequence(raw_texts, subseqs, labels, probs=None, none_val
                     # prevent duplicate annotation edge case
                     if (annotation_start, annotation_end, label) not in annotation_ranges:
                         annotation_ranges.add((annotation_start, annotation_end, label))
-                        doc_annotations.append(annotation)
+                        label_annotations.setdefault(label, []).append((next(annotation_order), annotation))
 
+        doc_annotations = [
+            annotation for _, annotation in
+            sorted(itertools.chain.from_iterable(label_annotations.values()), key=lambda x: x[0])
+        ]
         doc_annotations = sorted([dict(items) for items in doc_annotations], key=lambda x: x['start'])
         annotations.append(doc_annotations)
     return raw_texts, annotations
@@ -244,11 +306,7 @@ def indico_to_finetune_sequence(texts, labels=None, multi_label=True, none_value
         labels = [[]] * len(texts)
 
     for text, label_seq in zip(texts, labels):
-        tokens = NLP(text)
-        token_starts = [token.idx for token in tokens]
-        token_ends = [token.idx + len(token.text) for token in tokens]
-        n_tokens = len(tokens)
-
+        boundaries = None
         label_seq = sorted(label_seq, key=lambda x: x["start"])
         last_loc = 0
         doc_subseqs = []
@@ -270,11 +328,11 @@ def indico_to_finetune_sequence(texts, labels=None, multi_label=True, none_value
 
             if not subtoken_labels:
                 if label != none_value:
+                    if boundaries is None:
+                        boundaries = TokenBoundaries.from_text(text)
                     # round to nearest token
-                    while start > 0 and start not in token_starts:
-                        start -= 1
-                    while end < len(text) and end not in token_ends:
-                        end += 1
+                    start = boundaries.round_start(start)
+                    end = boundaries.round_end(end)
 
             if start > last_loc:
                 doc_subseqs.append(text[last_loc:start])
@@ -0,0 +1,49 @@
+import unittest
+
+from finetune.metrics import (
+    sequence_labeling_token_counts, sequence_labeling_overlaps,
+    sequence_labeling_overlap_precision, sequence_labeling_overlap_recall, annotation_report
+)
+
+
+class TestSequenceLabelingMetrics(unittest.TestCase):
+
+    def setUp(self):
+        text = "Indico Is the best hey"
+        self.true = [[
+            {'start': 0, 'end': 6, 'label': 'org', 'text': text[0:6]},
+            {'start': 14, 'end': 22, 'label': 'misc', 'text': text[14:22]},
+        ]]
+        self.pred = [[
+            {'start': 0, 'end': 9, 'label': 'org', 'text': text[0:9]},
+            {'start': 19, 'end': 22, 'label': 'org', 'text': text[19:22]},
+            {'start': 10, 'end': 13, 'label': 'misc', 'text': text[10:13]},
+        ]]
+
+    def test_token_counts(self):
+        counts = sequence_labeling_token_counts(self.true, self.pred)
+        self.assertEqual([token['text'] for token in counts['org']['correct']], ['Indico'])
+        self.assertEqual(
+            sorted(token['text'] for token in counts['org']['false_positives']), ['Is', 'hey']
+        )
+        self.assertEqual([token['text'] for token in counts['misc']['false_negatives']], ['best', 'hey'])
+        self.assertEqual([token['text'] for token in counts['misc']['false_positives']], ['the'])
+
+    def test_overlaps(self):
+        counts = sequence_labeling_overlaps(self.true, self.pred)
+        self.assertEqual(len(counts['org']['correct']), 1)
+        # "hey" overlaps the true "best hey" span with the wrong label, and also overlaps no true org span
+        self.assertEqual(len(counts['misc']['false_negatives']), 1)
+        self.assertEqual(len(counts['org']['false_positives']), 2)
+        self.assertEqual(len(counts['misc']['false_positives']), 1)
+        self.assertEqual(sequence_labeling_overlap_precision(self.true, self.pred), {'org': 1. / 3, 'misc': 0.})
+        self.assertEqual(sequence_labeling_overlap_recall(self.true, self.pred), {'org': 1., 'misc': 0.})
+
+    def test_annotation_report(self):
+        report = annotation_report(self.true, self.pred)
+        self.assertIn('org', report)
+        self.assertIn('Weighted Summary', report)
+
+
+if __name__ == '__main__':
+    unittest.main()
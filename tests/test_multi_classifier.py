@@ -19,6 +19,7 @@ import numpy as np
 from finetune import MultiLabelClassifier
 from finetune.datasets import generic_download
 from finetune.config import get_config
+from finetune.metrics import multi_label_threshold_curve
 
 SST_FILENAME = "SST-binary.csv"
 
@@ -96,3 +97,41 @@ class TestMultiLabelClassifier(unittest.TestCase):
             self.assertIn(3, prediction)
             self.assertIn(6, prediction)
 
+
+    def test_post_hoc_thresholds(self):
+        """
+        Ensure thresholds can be applied to cached probabilities
+        Ensure per-class thresholds are respected
+        """
+        model = MultiLabelClassifier(config=self.default_config())
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        train_targets = [[t, 6, 3] for t in train_sample.Target]
+        model.fit(train_sample.Text, train_targets)
+
+        probabilities = model.predict_proba(valid_sample.Text)
+        self.assertEqual(model.apply_threshold(probabilities), model.predict(valid_sample.Text))
+
+        # nothing can be predicted with a threshold of 1, everything is predicted with a threshold of 0
+        all_labels = model.apply_threshold(probabilities, threshold={3: 1.0, 6: 0.0})
+        for labels in all_labels:
+            self.assertNotIn(3, labels)
+            self.assertIn(6, labels)
+
+        sweep = model.threshold_sweep(valid_sample.Text, [[t, 6, 3] for t in valid_sample.Target], thresholds=[0., 1.])
+        n_classes = len(model.input_pipeline.label_encoder.classes_)
+        self.assertEqual(sweep['precision'].shape, (2, n_classes))
+        self.assertEqual(sweep['micro_recall'][0], 1.)
+        self.assertEqual(sweep['micro_recall'][1], 0.)
+
+    def test_threshold_curve(self):
+        """
+        Ensure the threshold curve matches thresholding probabilities directly
+        """
+        y_true = np.array([[1, 0], [1, 1], [0, 1], [0, 0]])
+        probas = np.array([[0.9, 0.2], [0.4, 0.6], [0.7, 0.8], [0.1, 0.3]])
+        curve = multi_label_threshold_curve(y_true, probas, thresholds=[0.5])
+        np.testing.assert_allclose(curve['precision'][0], [0.5, 1.0])
+        np.testing.assert_allclose(curve['recall'][0], [0.5, 1.0])
+        np.testing.assert_allclose(curve['micro_precision'], [0.75])
+        np.testing.assert_allclose(curve['micro_recall'], [0.75])
@@ -0,0 +1,109 @@
+import os
+import json
+import shutil
+import unittest
+import warnings
+
+# prevent excessive warning logs
+warnings.filterwarnings('ignore')
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import tensorflow as tf
+import numpy as np
+
+from finetune import MultiTask, Classifier, Regressor, SequenceLabeler
+from finetune.config import get_config
+from finetune.errors import FinetuneError
+
+TESTDATA = os.path.join(os.path.dirname(__file__), "testdata.json")
+
+
+class TestMultiTask(unittest.TestCase):
+
+    def setUp(self):
+        with open(TESTDATA, "rt") as fp:
+            texts, labels = json.load(fp)
+        self.texts = texts * 5
+        self.entities = labels * 5
+        self.animal = ["dog" in text for text in self.texts]
+        self.length = [float(len(text)) / 100. for text in self.texts]
+        try:
+            os.mkdir("tests/saved-models")
+        except FileExistsError:
+            warnings.warn("tests/saved-models still exists, it is possible that some test is not cleaning up properly.")
+        tf.reset_default_graph()
+
+    def tearDown(self):
+        shutil.rmtree("tests/saved-models/")
+
+    def default_config(self, **kwargs):
+        return get_config(
+            batch_size=2,
+            max_length=32,
+            n_epochs=1,
+            val_size=0,
+            verbose=False,
+            **kwargs
+        )
+
+    def tasks(self):
+        return {"animal": Classifier, "length": Regressor, "entities": SequenceLabeler}
+
+    def test_fit_predict(self):
+        """
+        Ensure every task is trained and predicted by a single model
+        Ensure saving + loading does not change predictions
+        """
+        model = MultiTask(self.tasks(), task_weights={"length": 0.5}, config=self.default_config())
+        model.fit(self.texts, {"animal": self.animal, "length": self.length, "entities": self.entities})
+
+        predictions = model.predict(self.texts)
+        self.assertEqual(set(predictions), {"animal", "length", "entities"})
+        self.assertEqual(len(predictions["animal"]), len(self.texts))
+        self.assertEqual(len(predictions["length"]), len(self.texts))
+        for annotations in predictions["entities"]:
+            for annotation in annotations:
+                self.assertIn(annotation["label"], {"ANIMAL"})
+
+        probas = model.predict_proba(self.texts)
+        self.assertEqual(set(probas), {"animal", "entities"})
+        self.assertEqual(model.featurize(self.texts).shape, (len(self.texts), model.config.n_embed))
+
+        save_file = 'tests/saved-models/test-multi-task'
+        model.save(save_file)
+        loaded = MultiTask.load(save_file)
+        loaded_predictions = loaded.predict(self.texts)
+        self.assertEqual(list(predictions["animal"]), list(loaded_predictions["animal"]))
+        np.testing.assert_allclose(predictions["length"], loaded_predictions["length"], atol=1e-5)
+        spans = lambda docs: [[(a["start"], a["end"], a["label"]) for a in annotations] for annotations in docs]
+        self.assertEqual(spans(predictions["entities"]), spans(loaded_predictions["entities"]))
+
+    def test_export(self):
+        """
+        Ensure an exported model restores the state of its tasks, such as `multi_label` of a sequence labeling task
+        """
+        model = MultiTask(self.tasks(), config=self.default_config())
+        model.fit(self.texts, {"animal": self.animal, "length": self.length, "entities": self.entities})
+        predictions = model.predict(self.texts)
+
+        export_path = 'tests/saved-models/test-multi-task-export'
+        model.export(export_path)
+        exported = MultiTask.load_exported(export_path)
+        self.assertFalse(exported.tasks["entities"].multi_label)
+        exported_predictions = exported.predict(self.texts)
+        self.assertEqual(list(predictions["animal"]), list(exported_predictions["animal"]))
+        spans = lambda docs: [[(a["start"], a["end"], a["label"]) for a in annotations] for annotations in docs]
+        self.assertEqual(spans(predictions["entities"]), spans(exported_predictions["entities"]))
+
+    def test_missing_targets(self):
+        model = MultiTask(self.tasks(), config=self.default_config())
+        with self.assertRaises(FinetuneError):
+            model.fit(self.texts, {"animal": self.animal, "length": self.length})
+
+    def test_multiple_sequence_tasks(self):
+        with self.assertRaises(FinetuneError):
+            MultiTask({"a": SequenceLabeler, "b": SequenceLabeler}, config=self.default_config())
+
+
+if __name__ == '__main__':
+    unittest.main()
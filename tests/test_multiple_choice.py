@@ -6,6 +6,7 @@ from pathlib import Path
 import codecs
 import json
 
+import numpy as np
 import tensorflow as tf
 # required for tensorflow logging control
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
@@ -46,3 +47,39 @@ class TestQuestionAnswer(unittest.TestCase):
 
         self.assertEqual(["orange"], model.predict(["Dog, cat, fish, orange, what is the odd one out?"],
                                                    [["orange", "Dog", "fish", "cat"]]))
+
+    def test_ragged_answers(self):
+        """
+        Ensure questions with different numbers of answers can be trained on and predicted together
+        Ensure padding answers get no probability
+        """
+        model = MultipleChoice(n_epochs=1, val_size=0, max_length=32, batch_size=3)
+        questions = [
+            "Dog, cat, fish, orange, what is the odd one out?",
+            "Stocks, Chicken, what is the odd one out?",
+            "England, US, Finland, Penguin, Spain, what is the odd one out?",
+        ]
+        answers = [
+            ["orange", "Dog", "fish", "cat"],
+            ["Chicken", "Stocks"],
+            ["Penguin", "England", "US", "Finland", "Spain"],
+        ]
+        model.finetune(questions, answers, ["orange", "Chicken", "Penguin"])
+
+        predictions = model.predict(questions, answers)
+        for prediction, answers_per_sample in zip(predictions, answers):
+            self.assertIn(prediction, answers_per_sample)
+
+        probas = model.predict_proba(questions, answers)
+        for probas_per_sample, answers_per_sample in zip(probas, answers):
+            self.assertEqual(set(probas_per_sample), set(answers_per_sample))
+            self.assertAlmostEqual(sum(probas_per_sample.values()), 1.0, places=4)
+
+        probas = model.predict_proba(questions, answers, as_array=True)
+        self.assertEqual(probas.shape, (3, 5))
+        self.assertTrue(np.all(probas[1, 2:] == 0))
+        self.assertEqual(model.featurize(questions, answers).shape, (3, 5, model.config.n_embed))
+
+        # a question scores the same whether or not it is batched with questions that have more answers
+        alone = model.predict_proba(questions[1:2], answers[1:2], as_array=True)
+        np.testing.assert_allclose(alone[0], probas[1, :2], atol=1e-4)
@@ -19,11 +19,17 @@ from bs4.element import Tag
 
 from finetune import SequenceLabeler
 from finetune.utils import indico_to_finetune_sequence, finetune_to_indico_sequence
+from finetune.crf import sequence_decode, viterbi_decode, crf_log_likelihood
 from finetune.metrics import (
     sequence_labeling_token_precision, sequence_labeling_token_recall,
     sequence_labeling_overlap_precision, sequence_labeling_overlap_recall
 )
 
+
+def spans(doc_annotations):
+    return [[(a["start"], a["end"], str(a["label"])) for a in annotations] for annotations in doc_annotations]
+
+
 class TestSequenceLabeler(unittest.TestCase):
 
     n_sample = 100
@@ -140,10 +146,95 @@ class TestSequenceLabeler(unittest.TestCase):
         self.assertIn('Named Entity', token_recall)
         self.assertIn('Named Entity', overlap_precision)
         self.assertIn('Named Entity', overlap_recall)
+
+        spans = self.model.predict(test_texts, as_array=True)
+        n_spans = len(spans['doc_idx'])
+        for field in ['start', 'end', 'label_idx']:
+            self.assertEqual(spans[field].shape, (n_spans,))
+        self.assertEqual(spans['confidence'].shape, (n_spans, len(self.model.classes_)))
+        self.assertTrue(np.all(spans['end'] > spans['start']))
+        self.assertTrue(np.all(spans['label_idx'] != self.model.input_pipeline.pad_idx))
+
         self.model.save(self.save_file)
         model = SequenceLabeler.load(self.save_file)
         predictions = model.predict(test_texts)
 
+        export_path = os.path.join(os.path.dirname(self.save_file), "test-sequence-export")
+        self.model.export(export_path)
+        exported = SequenceLabeler.load_exported(export_path)
+        self.assertFalse(exported.multi_label)
+        self.assertEqual(spans(exported.predict(test_texts)), spans(predictions))
+
+    def test_chunk_stride(self):
+        """
+        Ensure windows cover long documents for any stride and that stitched predictions cover every subtoken once
+        """
+        raw_docs = ["".join(text) for text in self.texts]
+        texts, annotations = finetune_to_indico_sequence(raw_docs, self.texts, self.labels)
+        self.model.fit(texts[:10], annotations[:10])
+        long_doc = " ".join(texts)
+        pipeline = self.model.input_pipeline
+
+        n_windows = {}
+        for stride, context in [(None, None), (127, 63), (254, 0)]:
+            self.model.config.chunk_stride = stride
+            self.model.config.chunk_context = context
+            arr_encoded = list(pipeline._text_to_ids([long_doc]))
+            n_windows[stride] = len(arr_encoded)
+            doc_predictions = self.model._stitch_chunks(
+                arr_encoded, self.model._inference(arr_encoded, encoded=True)
+            )
+            self.assertEqual(len(doc_predictions), 1)
+            char_locs = doc_predictions[0][2]
+            self.assertTrue(np.all(np.diff(char_locs) >= 0))
+            self.assertEqual(char_locs[-1], max(max(encoded.char_locs) for encoded in arr_encoded))
+            self.assertIsInstance(self.model.predict([long_doc])[0], list)
+        self.assertTrue(n_windows[None] > n_windows[127] > n_windows[254])
+
+        self.model.config.chunk_stride = 200
+        self.model.config.chunk_context = 100
+        with self.assertRaises(ValueError):
+            pipeline.chunk_params()
+
+    def test_viterbi_decode(self):
+        """
+        Ensure the in-graph decode matches the numpy decode, both for a single CRF and for a batch of binary CRFs
+        """
+        rng = np.random.RandomState(0)
+        cases = [
+            (rng.randn(3, 17, 5).astype(np.float32), rng.randn(5, 5).astype(np.float32)),
+            (rng.randn(3, 4, 17, 2).astype(np.float32), rng.randn(4, 2, 2).astype(np.float32)),
+        ]
+        for logits, transitions in cases:
+            expected_idxs, expected_probas = viterbi_decode(logits, transitions)
+            with tf.Graph().as_default(), tf.Session() as sess:
+                idxs, probas = sess.run(sequence_decode(tf.constant(logits), tf.constant(transitions)))
+            np.testing.assert_array_equal(idxs, expected_idxs)
+            np.testing.assert_allclose(probas, expected_probas, rtol=1e-5, atol=1e-6)
+
+    def test_batched_crf_log_likelihood(self):
+        """
+        Ensure the batch of binary CRFs used by multi-label models matches one contrib CRF per label
+        """
+        rng = np.random.RandomState(0)
+        batch, n_labels, seq_len = 3, 4, 17
+        logits = rng.randn(batch, n_labels, seq_len, 2).astype(np.float32)
+        tags = rng.randint(0, 2, size=(batch, n_labels, seq_len)).astype(np.int32)
+        transitions = rng.randn(n_labels, 2, 2).astype(np.float32)
+        with tf.Graph().as_default(), tf.Session() as sess:
+            batched = crf_log_likelihood(tf.constant(logits), tf.constant(tags), tf.constant(transitions))
+            per_label = tf.stack([
+                tf.contrib.crf.crf_log_likelihood(
+                    tf.constant(logits[:, i]),
+                    tf.constant(tags[:, i]),
+                    seq_len * tf.ones(batch, dtype=tf.int32),
+                    transition_params=tf.constant(transitions[i])
+                )[0]
+                for i in range(n_labels)
+            ], axis=1)
+            batched, per_label = sess.run([batched, per_label])
+        np.testing.assert_allclose(batched, per_label, rtol=1e-5, atol=1e-4)
+
     def test_reasonable_predictions(self):
         test_sequence = ["I am a dog. A dog that's incredibly bright. I can talk, read, and write!"]
         path = os.path.join(os.path.dirname(__file__), "testdata.json")
@@ -203,4 +294,10 @@ class TestSequenceLabeler(unittest.TestCase):
         self.assertIsInstance(probas[0][0]['confidence'], dict)
         self.model.save(self.save_file)
         model = SequenceLabeler.load(self.save_file)
-        model.predict(test_texts)
\ No newline at end of file
+        model.predict(test_texts)
+
+        export_path = os.path.join(os.path.dirname(self.save_file), "test-multi-label-export")
+        self.model.export(export_path)
+        exported = SequenceLabeler.load_exported(export_path)
+        self.assertTrue(exported.multi_label)
+        self.assertEqual(spans(exported.predict(test_texts)), spans(predictions))
\ No newline at end of file
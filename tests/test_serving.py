@@ -0,0 +1,130 @@
+import asyncio
+import contextlib
+import json
+import threading
+import time
+import unittest
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from finetune.config import get_config
+from finetune.errors import FinetuneError
+from finetune.serving import BatchingPredictor, make_server
+
+
+class FakeModel:
+    """
+    Stands in for a finetune model, recording the size of each batch it is called with.
+    """
+
+    def __init__(self, delay=0.):
+        self.config = get_config()
+        self.delay = delay
+        self.batch_sizes = []
+        self.inference_batch_sizes = []
+
+    @contextlib.contextmanager
+    def inference_batch_size(self, batch_size):
+        self.inference_batch_sizes.append(batch_size)
+        yield
+
+    def predict(self, Xs):
+        self.batch_sizes.append(len(Xs))
+        time.sleep(self.delay)
+        return [len(x) for x in Xs]
+
+    def predict_proba(self, Xs):
+        raise ValueError("predict_proba failed")
+
+    def featurize(self, Xs):
+        # drops the last result
+        return [len(x) for x in Xs][:-1]
+
+
+class TestServing(unittest.TestCase):
+
+    def test_batches_concurrent_requests(self):
+        """
+        Ensure concurrent single-document requests are grouped into batches and each receives its own result
+        """
+        model = FakeModel(delay=0.01)
+        texts = ["a" * i for i in range(64)]
+        with BatchingPredictor(model, max_batch_size=8, max_latency_ms=50) as predictor:
+            with ThreadPoolExecutor(max_workers=32) as pool:
+                results = list(pool.map(predictor.predict, texts))
+            metrics = predictor.metrics()
+
+        self.assertEqual(results, [len(text) for text in texts])
+        self.assertTrue(max(model.batch_sizes) > 1)
+        self.assertTrue(max(model.batch_sizes) <= 8)
+        self.assertEqual(sum(model.batch_sizes), len(texts))
+        self.assertEqual(metrics["requests"], len(texts))
+        self.assertEqual(metrics["errors"], 0)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertTrue(metrics["latency_ms"]["p50"] <= metrics["latency_ms"]["p99"])
+        self.assertEqual(set(model.inference_batch_sizes), {8})
+        self.assertIsNone(model.config.predict_batch_size)
+
+    def test_latency_bound(self):
+        """
+        Ensure a lone request is served once `max_latency_ms` elapses rather than waiting for a full batch
+        """
+        model = FakeModel()
+        with BatchingPredictor(model, max_batch_size=1000, max_latency_ms=5) as predictor:
+            self.assertEqual(predictor.predict("abc", timeout=5), 3)
+        self.assertEqual(model.batch_sizes, [1])
+
+    def test_predict_async(self):
+        model = FakeModel()
+        with BatchingPredictor(model, max_batch_size=4, max_latency_ms=20) as predictor:
+            async def gather():
+                return await asyncio.gather(*[predictor.predict_async("a" * i) for i in range(4)])
+            results = asyncio.get_event_loop().run_until_complete(gather())
+        self.assertEqual(list(results), [0, 1, 2, 3])
+
+    def test_errors(self):
+        """
+        Ensure a failing batch propagates the exception to each request and a closed predictor rejects requests
+        """
+        model = FakeModel()
+        predictor = BatchingPredictor(model, method="predict_proba", max_latency_ms=1)
+        with self.assertRaises(ValueError):
+            predictor.predict("abc", timeout=5)
+        self.assertEqual(predictor.metrics()["errors"], 1)
+        predictor.close()
+        with self.assertRaises(FinetuneError):
+            predictor.submit("abc")
+
+    def test_missing_results(self):
+        """
+        Ensure requests fail rather than hang when the model returns fewer results than the batch holds
+        """
+        model = FakeModel()
+        with BatchingPredictor(model, method="featurize", max_batch_size=4, max_latency_ms=50) as predictor:
+            futures = [predictor.submit("a" * i) for i in range(4)]
+            for future in futures:
+                with self.assertRaises(FinetuneError):
+                    future.result(timeout=5)
+            self.assertTrue(predictor.workers[0].is_alive())
+
+    def test_http_server(self):
+        model = FakeModel()
+        server = make_server(model, port=0, methods=("predict",), max_latency_ms=1)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://{}:{}".format(*server.server_address[:2])
+        try:
+            request = urllib.request.Request(
+                url + "/predict",
+                data=json.dumps({"texts": ["a", "abc"]}).encode("utf-8"),
+                headers={"Content-Type": "application/json"}
+            )
+            with urllib.request.urlopen(request) as response:
+                self.assertEqual(json.loads(response.read()), {"results": [1, 3]})
+
+            with urllib.request.urlopen(url + "/metrics") as response:
+                metrics = json.loads(response.read())
+            self.assertEqual(metrics["predict"]["requests"], 2)
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -1,9 +1,19 @@
+import functools
 import unittest
 
 import numpy as np
+import tensorflow as tf
 
-from finetune.utils import indico_to_finetune_sequence, finetune_to_indico_sequence
+from finetune.transformer import block
+from finetune.network_modules import (
+    featurizer, chunked_logsumexp, recompute_plan, block_activation_mb, sequence_labeler_activation_mb
+)
+from finetune.config import get_config
+from finetune.utils import indico_to_finetune_sequence, finetune_to_indico_sequence, TokenBoundaries, shape_list
+from finetune.model import cached_decode
 from finetune.imbalance import compute_class_weights
+from finetune.encoding import tokenize
+from finetune.input_pipeline import ENCODER
 
 
 class TestFinetuneIndicoConverters(unittest.TestCase):
@@ -86,6 +96,34 @@ class TestFinetuneIndicoConverters(unittest.TestCase):
         self.assertCountEqual(finetuney[0][1], finetuney_pred[0][1])
         self.assertCountEqual(finetuney[0][2], finetuney_pred[0][2])
 
+    def test_token_boundaries(self):
+        raw = ["Indico Is the best hey"]
+        boundaries = TokenBoundaries.from_text(raw[0])
+        self.assertEqual(list(boundaries.starts), [0, 7, 10, 14, 19])
+        self.assertEqual(list(boundaries.ends), [6, 9, 13, 18, 22])
+        self.assertEqual(boundaries.round_start(9), 7)
+        self.assertEqual(boundaries.round_start(7), 7)
+        self.assertEqual(boundaries.round_end(16), 18)
+        self.assertEqual(boundaries.round_end(22), 22)
+
+        indicoy = [[{'start': 2, 'end': 12, 'label': '1'}]]
+        finetunex, finetuney = indico_to_finetune_sequence(raw, indicoy, multi_label=False)
+        self.assertEqual(finetunex, [["Indico Is the", " best hey"]])
+        _, annotations = finetune_to_indico_sequence(raw, finetunex, finetuney)
+        self.assertEqual(annotations, [[{'start': 0, 'end': 13, 'label': '1', 'text': 'Indico Is the'}]])
+
+    def test_tokenization_cache(self):
+        text = "Indico Is the best hey"
+        self.assertIs(tokenize(text), tokenize(text))
+        self.assertEqual(tokenize(text).texts, ("Indico", "Is", "the", "best", "hey"))
+
+        first = ENCODER._encode([text])
+        second = ENCODER._encode([text])
+        self.assertEqual(first, second)
+        # callers receive their own lists rather than the cached tuples
+        first.token_ids[0].append(-1)
+        self.assertEqual(ENCODER._encode([text]).token_ids, second.token_ids)
+
     def test_compute_class_weights(self):
         # regression test for issue #181
         np.random.seed(0)
@@ -93,6 +131,191 @@ class TestFinetuneIndicoConverters(unittest.TestCase):
         weights = compute_class_weights('log', y)
         self.assertEqual(weights[1], 1.0)
 
+
+class TestCachedAttention(unittest.TestCase):
+
+    def test_cached_block_matches_full_sequence(self):
+        with tf.Graph().as_default():
+            x = tf.random_normal([2, 6, 16])
+            block_fn = lambda h, past=None: block(
+                h, n_head=4, act_fn='gelu', resid_pdrop=0., attn_pdrop=0., scope='h0', scale=True, past=past
+            )
+            with tf.variable_scope('model', reuse=tf.AUTO_REUSE):
+                full = block_fn(x)
+                # prompt in one step, then one position at a time
+                h, past = block_fn(x[:, :4], past=tf.zeros([2, 2, 4, 0, 4]))
+                steps = [h]
+                for i in range(4, 6):
+                    h, present = block_fn(x[:, i:i + 1], past=past)
+                    past = tf.concat([past, present], axis=-2)
+                    steps.append(h)
+                cached = tf.concat(steps, axis=1)
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                full, cached = sess.run([full, cached])
+        np.testing.assert_allclose(full, cached, atol=1e-5)
+
+
+class TestSharedPrefixFeaturizer(unittest.TestCase):
+
+    def test_shared_prefix_featurizer(self):
+        config = get_config(n_layer=2, n_heads=2, n_embed=16, max_length=12, num_layers_trained=1)
+        n_answers, question = 3, [ENCODER.start, 10, 11, 12, ENCODER.delimiter]
+        tokens = np.zeros([2, n_answers, config.max_length, 2], dtype=np.int32)
+        tokens[..., 1] = np.arange(ENCODER.vocab_size, ENCODER.vocab_size + config.max_length)
+        for example in range(2):
+            for answer in range(n_answers):
+                sequence = question[:4 - example] + [20 + answer, 21, ENCODER.clf_token]
+                tokens[example, answer, :len(sequence), 0] = sequence
+
+        with tf.Graph().as_default():
+            X = tf.constant(tokens)
+            shared = featurizer(X, encoder=ENCODER, config=config)
+            full = featurizer(tf.reshape(X, [-1, config.max_length, 2]), encoder=ENCODER, config=config, reuse=True)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                shared, full = sess.run([shared, full])
+
+        for key in ["features", "sequence_features", "frozen_hidden"]:
+            np.testing.assert_allclose(
+                shared[key].reshape(full[key].shape), full[key], atol=1e-5
+            )
+
+
+class TestChunkedLogsumexp(unittest.TestCase):
+
+    def test_chunked_logsumexp(self):
+        h = np.random.randn(5, 8).astype(np.float32)
+        weights = np.random.randn(23, 8).astype(np.float32)
+        dy = np.random.randn(5).astype(np.float32)
+        with tf.Graph().as_default():
+            h_t, weights_t = tf.constant(h), tf.constant(weights)
+            chunked = chunked_logsumexp(h_t, weights_t, chunk_size=10)
+            full = tf.reduce_logsumexp(tf.matmul(h_t, weights_t, transpose_b=True), -1)
+            chunked_grads = tf.gradients(chunked, [h_t, weights_t], grad_ys=dy)
+            full_grads = tf.gradients(full, [h_t, weights_t], grad_ys=dy)
+            with tf.Session() as sess:
+                chunked, full, chunked_grads, full_grads = sess.run([chunked, full, chunked_grads, full_grads])
+        np.testing.assert_allclose(chunked, full, rtol=1e-5)
+        for chunked_grad, full_grad in zip(chunked_grads, full_grads):
+            np.testing.assert_allclose(chunked_grad, full_grad, rtol=1e-4, atol=1e-5)
+
+
+class TestRecompute(unittest.TestCase):
+
+    def test_recompute_attention_gradients(self):
+        x = np.random.randn(2, 6, 16).astype(np.float32)
+        with tf.Graph().as_default():
+            x_t = tf.constant(x)
+            block_fn = lambda h, recompute_attn: block(
+                h, n_head=4, act_fn='gelu', resid_pdrop=0., attn_pdrop=0., scope='h0', scale=True,
+                recompute_attn=recompute_attn
+            )
+            with tf.variable_scope('model', reuse=tf.AUTO_REUSE):
+                full = block_fn(x_t, recompute_attn=False)
+                variables = tf.trainable_variables()
+                recomputed = block_fn(x_t, recompute_attn=True)
+            full_grads = tf.gradients(tf.reduce_sum(full ** 2), [x_t] + variables)
+            recomputed_grads = tf.gradients(tf.reduce_sum(recomputed ** 2), [x_t] + variables)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                full_grads, recomputed_grads = sess.run([full_grads, recomputed_grads])
+        for full_grad, recomputed_grad in zip(full_grads, recomputed_grads):
+            np.testing.assert_allclose(full_grad, recomputed_grad, rtol=1e-4, atol=1e-5)
+
+    def test_recompute_plan(self):
+        layers = range(8, 12)
+        self.assertEqual(set(recompute_plan(get_config(), layers, batch_size=2).values()), {None})
+        config = get_config(low_memory_mode=True)
+        self.assertEqual(set(recompute_plan(config, layers, batch_size=2).values()), {"block"})
+        config = get_config(low_memory_mode=True, recompute_policy="attention")
+        self.assertEqual(set(recompute_plan(config, layers, batch_size=2).values()), {"attention"})
+        config = get_config(low_memory_mode=True, recompute_policy="every_k", recompute_every_k=2)
+        self.assertEqual(recompute_plan(config, layers, batch_size=2), {8: "block", 9: None, 10: "block", 11: None})
+
+        kept_mb = block_activation_mb(config, batch_size=2)
+        recomputed_mb = block_activation_mb(config, batch_size=2, recompute="block")
+        self.assertLess(recomputed_mb, block_activation_mb(config, batch_size=2, recompute="attention"))
+        config = get_config(
+            low_memory_mode=True, recompute_policy="budget", recompute_memory_budget=2 * kept_mb + 2 * recomputed_mb + 1
+        )
+        self.assertEqual(recompute_plan(config, layers, batch_size=2), {8: "block", 9: "block", 10: None, 11: None})
+
+    def test_recompute_plan_head(self):
+        layers = range(8, 12)
+        head_mb = lambda config, recompute: sequence_labeler_activation_mb(config, 2, 3, recompute=recompute)
+        for policy, expected in [("all", "block"), ("attention", "attention"), ("every_k", "block")]:
+            config = get_config(low_memory_mode=True, recompute_policy=policy)
+            plan = recompute_plan(config, layers, batch_size=2, head_mb=functools.partial(head_mb, config))
+            self.assertEqual(plan.pop("head"), expected)
+            self.assertEqual(plan, recompute_plan(config, layers, batch_size=2))
+
+        config = get_config()
+        self.assertLess(head_mb(config, "block"), head_mb(config, "attention"))
+        self.assertLess(head_mb(config, "attention"), head_mb(config, None))
+        layers_mb = 2 * block_activation_mb(config, batch_size=2) + 2 * block_activation_mb(
+            config, batch_size=2, recompute="block"
+        )
+        head_costs = {None: 30., "attention": 20., "block": 10.}
+        for head_budget, expected in [(0, "block"), (25, "attention"), (35, None)]:
+            config = get_config(
+                low_memory_mode=True, recompute_policy="budget", recompute_memory_budget=layers_mb + head_budget + 1
+            )
+            plan = recompute_plan(config, layers, batch_size=2, head_mb=lambda recompute: head_costs[recompute])
+            # the layers spend the budget first and the head only keeps what fits in the remainder
+            self.assertEqual(plan, {8: "block", 9: "block", 10: None, 11: None, "head": expected})
+
+
+class TestCachedDecode(unittest.TestCase):
+    vocab_size = 8
+    eos = 7
+
+    def decode(self, forced_token, decode_length):
+        """
+        Decodes two prompts, of 2 and 4 tokens, with a step function whose logits always favour `forced_token`.
+        """
+        tokens = np.zeros([2, 10, 2], dtype=np.int32)
+        tokens[0, :2, 0] = [1, 2]
+        tokens[1, :4, 0] = [1, 3, 4, 5]
+        mask = np.zeros([2, 10], dtype=np.float32)
+        mask[0, :1] = 1
+        mask[1, :3] = 1
+
+        def step_fn(X, past):
+            batch_size, n_tokens = shape_list(X)[:2]
+            logits = tf.tile(100. * tf.one_hot([forced_token], self.vocab_size), [batch_size, 1])
+            return {"logits": logits, "present": tf.zeros([batch_size, 1, n_tokens, 1])}
+
+        with tf.Graph().as_default():
+            decoded = cached_decode(
+                tf.constant(tokens), tf.constant(mask),
+                step_fn=step_fn,
+                empty_past=tf.zeros([2, 1, 0, 1]),
+                logit_mask=tf.zeros([1, self.vocab_size]),
+                temperature=0.0,
+                decode_length=decode_length,
+                eos_token=self.eos,
+                position_offset=self.vocab_size
+            )
+            with tf.Session() as sess:
+                return sess.run(decoded)
+
+    def test_stops_at_end_token(self):
+        # the first sequence ends while the second is still fed its prompt, and is padded with end tokens
+        np.testing.assert_array_equal(
+            self.decode(forced_token=self.eos, decode_length=10),
+            [[1, 2, self.eos, self.eos, self.eos],
+             [1, 3, 4, 5, self.eos]]
+        )
+
+    def test_stops_at_decode_length(self):
+        np.testing.assert_array_equal(
+            self.decode(forced_token=6, decode_length=6),
+            [[1, 2, 6, 6, 6, 6],
+             [1, 3, 4, 5, 6, 6]]
+        )
+
  
 if __name__ == '__main__':
     unittest.main()